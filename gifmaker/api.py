@@ -0,0 +1,104 @@
+# Modules
+from .config import Configuration, default, current
+from .argparser import ArgParser
+from . import utils
+from . import words
+from . import media
+from . import main
+
+# Libraries
+from PIL import Image  # type: ignore
+
+# Standard
+import threading
+from io import BytesIO
+from typing import List, Dict, Callable, TypeVar, Any
+
+
+# The same keys as a script or a server job
+Options = Dict[str, Any]
+
+T = TypeVar("T")
+
+# Arguments that don't make sense for a call, the output is returned and nothing is printed
+REJECTED = ["output", "stdout", "count", "arguments", "probe", "framecache_stats",
+            "profile", "profilestats", "profiletrace"]
+
+# Paths and the manifest are filled once for all the calls
+setup_lock = threading.Lock()
+
+
+class RenderError(Exception):
+    # A call that failed, with the message the program would print
+    pass
+
+
+def setup() -> None:
+    with setup_lock:
+        if Configuration.Internal.root is None:
+            default.fill_root(main.__file__)
+            default.get_manifest()
+
+
+def call(options: Options, func: Callable[[], T], conf: Configuration) -> T:
+    # Runs with a configuration of its own, so calls on other threads don't share any state
+    # Nothing is saved to the cache directory unless 'nocache' is set to false
+    for key in options:
+        if ArgParser.dash_to_under(key) in REJECTED:
+            raise RenderError(f"'{key}' can't be used with the api")
+
+    setup()
+    conf.Internal.quiet = True
+    token = current.set(conf)
+
+    try:
+        conf.parse_args([], {"nocache": True, **options})
+
+        # A script can still ask for many outputs
+        if conf.count > 1:
+            utils.exit("'count' can't be used with the api")
+
+        return func()
+    except utils.Exit as e:
+        raise RenderError(e.message) from None
+    except SystemExit as e:
+        raise RenderError(e.code if isinstance(e.code, str) else "Invalid options") from None
+    finally:
+        current.reset(token)
+
+
+def render(options: Options) -> bytes:
+    # Makes the output like the program would, in memory, and returns its bytes
+    # The format comes from 'format', gif by default
+    conf = Configuration()
+    buffer = BytesIO()
+    conf.Internal.output_file = buffer
+    call(options, lambda: main.run(main.get_time()), conf)
+    data = buffer.getvalue()
+
+    if not data:
+        raise RenderError("No frames")
+
+    return data
+
+
+def process(frames: List[Image.Image], options: Options) -> List[Image.Image]:
+    # The frames go through the filters, deep fry, words, and resize, and are returned
+    # Options about the input, the frames picked, or the output are not used
+    # The given frames are not changed
+    conf = Configuration()
+    conf.Internal.given_frames = True
+
+    def run() -> List[Image.Image]:
+        ans = [frame.copy() for frame in frames]
+        conf.frames = len(ans)
+        words.process_words()
+
+        if not conf.remake:
+            ans = media.apply_filters(ans)
+            ans = media.deep_fry(ans)
+            ans = media.word_frames(ans)
+
+        return media.resize_frames(ans)
+
+    return call(options, run, conf)
@@ -2,13 +2,14 @@
 import re
 import sys
 import argparse
-from typing import List, Any, Dict, Union
+from typing import List, Any, Dict, Union, Optional
 from pathlib import Path
 
 
 class ArgParser:
     # Generic class to get arguments from the terminal
-    def __init__(self, title: str, argdefs: Dict[str, Any], aliases: Dict[str, List[str]], obj: Any):
+    def __init__(self, title: str, argdefs: Dict[str, Any], aliases: Dict[str, List[str]], obj: Any,
+                 argv: Optional[List[str]] = None):
         parser = argparse.ArgumentParser(description=title)
         argdefs["string_arg"] = {"nargs": "*"}
 
@@ -35,7 +36,8 @@ class ArgParser:
                     value in item.items() if value is not None}
             parser.add_argument(*names, **tail)
 
-        self.args = parser.parse_args()
+        # No argv means the arguments of the program
+        self.args = parser.parse_args(argv)
         self.obj = obj
 
     def string_arg(self) -> str:
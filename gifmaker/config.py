@@ -3,15 +3,25 @@ from . import utils
 from .argparser import ArgParser
 
 # Standard
+import os
+import glob
 import json
 import codecs
 import textwrap
 import random
+import threading
+from io import BytesIO
+from contextvars import ContextVar
+from collections import OrderedDict
 from argparse import Namespace
-from typing import List, Union, Dict, Tuple, Any
-from PIL import ImageFont  # type: ignore
+from typing import List, Union, Dict, Tuple, Type, Any, Optional, BinaryIO, TYPE_CHECKING, cast
 from pathlib import Path
 
+# Pillow is loaded when a font is needed
+if TYPE_CHECKING:
+    from PIL import ImageFont  # type: ignore
+    from .words import WordFile, Sampler
+
 
 class Configuration:
     # Class to hold all the configuration of the program
@@ -20,6 +30,7 @@ class Configuration:
     def __init__(self) -> None:
         self.delay = 700
         self.input: Union[Path, None] = None
+        self.inputs: List[Path] = []
         self.output: Union[Path, None] = None
         self.randomfile: Union[Path, None] = None
         self.frames: Union[int, None] = None
@@ -55,8 +66,8 @@ class Configuration:
         self.filterlist: List[str] = []
         self.filteropts: List[str] = []
         self.filter = "none"
-        self.framelist: List[str] = []
-        self.frameopts: List[str] = []
+        self.framelist: List[Union[int, str]] = []
+        self.frameopts: List[Union[int, str]] = []
         self.repeatrandom = False
         self.repeatfilter = False
         self.fillwords = False
@@ -75,20 +86,83 @@ class Configuration:
         self.vertical = False
         self.horizontal = False
         self.word_color_mode = "normal"
-
-    class Internal:
+        self.stream = False
+        self.stdout = False
+        self.workers = 1
+        self.count = 1
+        self.framecache: Union[Path, None] = None
+        self.framecache_size = 2048
+        self.reusepalette = False
+        self.nocache = False
+        self.localindex = False
+        self.codec: Union[str, None] = None
+        self.preset: Union[str, None] = None
+        self.crf: Union[int, None] = None
+        self.encoder_threads: Union[int, None] = None
+        self.pixel_format = "yuv420p"
+        self.crop: List[int] = []
+        self.grid: List[int] = []
+        self.profile: Union[Path, None] = None
+        self.profilestats: Union[Path, None] = None
+        self.profiletrace: Union[Path, None] = None
+
+        # Each configuration gets its own internal state so calls on other threads don't share it
+        # What is the same for every call, like the paths and the arguments, stays on the base class
+        self.Internal = internal_state({"fonts": OrderedDict()})
+
+    class InternalState:
         # The path where the main file is located
         root: Union[Path, None] = None
 
         # The path where the fonts are located
         fontspath: Union[Path, None] = None
 
-        # List to keep track of used random words
-        randwords: List[str] = []
+        # Keeps track of used random words
+        word_sampler: Union["Sampler", None] = None
 
         # Counter for [count]
         wordcount = 0
 
+        # Fonts that come with the program
+        font_files = {
+            "sans": "Roboto-Regular.ttf",
+            "serif": "RobotoSerif-Regular.ttf",
+            "mono": "RobotoMono-Regular.ttf",
+            "italic": "Roboto-Italic.ttf",
+            "bold": "Roboto-Bold.ttf",
+            "cursive": "Pacifico-Regular.ttf",
+            "comic": "ComicNeue-Regular.ttf",
+            "nova": "NovaSquare-Regular.ttf",
+        }
+
+        # Loaded fonts by path and size, oldest first
+        fonts: "OrderedDict[Tuple[str, int], ImageFont.FreeTypeFont]" = OrderedDict()
+
+        # Contents of the font files that were read, oldest first
+        # Shared by every configuration, so it's locked
+        font_data: "OrderedDict[str, bytes]" = OrderedDict()
+        font_lock = threading.Lock()
+
+        # Max number of fonts kept in memory
+        max_fonts = 16
+
+        # Font cache stats
+        font_hits = 0
+        font_misses = 0
+
+        # Frame cache stats of the last run
+        frame_hits = 0
+        frame_misses = 0
+
+        # Still images decoded in the last run, and the frames copied from them
+        still_decodes: List[Dict[str, Any]] = []
+        shared_frames = 0
+
+        # Random word files that were opened
+        # Shared by every configuration, so it's locked
+        word_files: Dict[str, "WordFile"] = {}
+        word_lock = threading.Lock()
+
         # Last font color used
         last_fontcolor: Union[Tuple[int, int, int], None] = None
 
@@ -98,6 +172,9 @@ class Configuration:
         random_filters: Union[random.Random, None] = None
         random_colors: Union[random.Random, None] = None
 
+        # Digits of [number] have their own so they don't move the random words
+        random_digits: Union[random.Random, None] = None
+
         # Last word printed
         last_words = ""
 
@@ -107,6 +184,25 @@ class Configuration:
         # Response string
         response = ""
 
+        # Where the output goes instead of a file or stdout, like the buffer of an api call
+        output_file: Union[BinaryIO, None] = None
+
+        # The frames are given by the caller, like the api, so there is no input or output
+        given_frames = False
+
+        # Errors are raised without printing them
+        quiet = False
+
+        # Files that are used when the input is a directory
+        media_extensions = ["webm", "mp4", "mkv", "mov", "avi", "gif", "jpg", "jpeg", "png"]
+
+        # Frames can be decoded smaller than the source
+        # Sizes given for the source, like the font size, are multiplied by this
+        decode_scale = 1.0
+
+        # The final size of the frames when it's known before decoding
+        output_size: Union[Tuple[int, int], None] = None
+
         # Strings for info
         rgbstr = "3 numbers from 0 to 255, separated by commas. Names like 'yellow' are also supported"
         commastr = "Separated by commas"
@@ -116,7 +212,7 @@ class Configuration:
 
         # Argument definitions
         arguments: Dict[str, Any] = {
-            "input": {"type": str, "help": "Path to a video or image file. Separated by commas"},
+            "input": {"type": str, "help": "Path to a video or image file, a directory, or a glob pattern. Separated by commas"},
             "words": {"type": str, "help": "Lines of words to use on the frames"},
             "wordfile": {"type": str, "help": "Path of file with word lines"},
             "delay": {"type": str, "help": "The delay in ms between frames"},
@@ -152,8 +248,9 @@ class Configuration:
                                    "anyhue", "anyhue2", "gray", "grey", "blur", "invert", "random", "random2", "none"]},
             "filterlist": {"type": str, "help": f"Filters to use per frame. {commastr}"},
             "filteropts": {"type": str, "help": f"The list of allowed filters when picking randomly. {commastr}"},
-            "framelist": {"type": str, "help": f"List of frame indices to use. {commastr}"},
-            "frameopts": {"type": str, "help": f"The list of allowed frame indices when picking randomly. {commastr}"},
+            "crop": {"type": str, "help": "Crop the source to x,y,w,h before anything else. Separated by commas"},
+            "framelist": {"type": str, "help": f"List of frame indices or timestamps like 00:01:05 to use. {commastr}"},
+            "frameopts": {"type": str, "help": f"The list of allowed frame indices or timestamps when picking randomly. {commastr}"},
             "repeatrandom": {"action": "store_true", "help": "Repeating random words is ok"},
             "repeatfilter": {"action": "store_true", "help": "Repeating random filters is ok"},
             "fillwords": {"action": "store_true", "help": "Fill the rest of the frames with the last word line"},
@@ -175,8 +272,28 @@ class Configuration:
             "deepfry": {"action": "store_true", "help": "Compress the frames heavily"},
             "vertical": {"action": "store_true", "help": "Append images vertically"},
             "horizontal": {"action": "store_true", "help": "Append images horizontally"},
+            "grid": {"type": str, "help": "Join the frames into a grid of this many columns and rows, like 4x3"},
             "arguments": {"action": "store_true", "help": "Print argument information"},
+            "probe": {"type": str, "help": "Print what is known about this media file as json, like fps and number of frames"},
             "word-color-mode": {"type": str, "choices": ["normal", "random"], "help": "Color mode for words"},
+            "stream": {"action": "store_true", "help": "Process and encode frames one at a time instead of keeping all of them in memory"},
+            "stdout": {"action": "store_true", "help": "Write the output to stdout as it is produced. Implies stream"},
+            "workers": {"type": int, "help": "Number of processes to use for the per frame operations"},
+            "count": {"type": int, "help": "Number of outputs to make from one decode, each with its own random picks"},
+            "framecache": {"type": str, "help": "Directory where decoded frames are saved so later runs don't decode them again"},
+            "framecache-size": {"type": int, "help": "Max size of the frame cache in MB"},
+            "framecache-stats": {"type": str, "help": "Print the size and contents of this frame cache directory as json"},
+            "reusepalette": {"action": "store_true", "help": "Save the gif palette and use it again on the next runs with the same input"},
+            "nocache": {"action": "store_true", "help": "Don't save probes or word indices to the cache directory"},
+            "localindex": {"action": "store_true", "help": "Save the index of a word file next to it instead of in the cache directory"},
+            "codec": {"type": str, "choices": ["libx264", "libx265", "libvpx", "libvpx-vp9"], "help": "The codec of mp4 and webm videos"},
+            "preset": {"type": str, "choices": ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"], "help": "Trade quality for speed when encoding videos"},
+            "crf": {"type": int, "help": "Quality of videos, lower is better"},
+            "encoder-threads": {"type": int, "help": "Number of threads ffmpeg uses to encode videos"},
+            "pixel-format": {"type": str, "choices": ["yuv420p", "yuv422p", "yuv444p", "yuva420p"], "help": "The pixel format of videos"},
+            "profile": {"type": str, "help": "Save timings and memory use of each stage and frame to this json file"},
+            "profilestats": {"type": str, "help": "Save a cProfile dump to this file"},
+            "profiletrace": {"type": str, "help": "Save a Chrome trace of the stages and frames to this json file"},
         }
 
         aliases = {
@@ -184,7 +301,11 @@ class Configuration:
             "output": ["--o", "-o"],
         }
 
-    def parse_args(self) -> None:
+    # The state shared by every configuration, each one gets a subclass of it
+    Internal: Type[InternalState] = InternalState
+
+    def parse_args(self, argv: Optional[List[str]] = None, data: Optional[Dict[str, Any]] = None) -> None:
+        # Arguments can also come as a dict with the same keys as a script
         v_title = self.Internal.manifest["title"]
         v_version = self.Internal.manifest["version"]
         v_info = f"{v_title} {v_version}"
@@ -192,7 +313,7 @@ class Configuration:
         self.Internal.arguments["version"] = {"action": "version",
                                               "help": "Check the version of the program", "version": v_info}
 
-        ap = ArgParser(self.Internal.manifest["title"], self.Internal.arguments, self.Internal.aliases, self)
+        ap = ArgParser(self.Internal.manifest["title"], self.Internal.arguments, self.Internal.aliases, self, argv)
 
         # ---
 
@@ -200,11 +321,22 @@ class Configuration:
             self.Internal.response = self.arguments_json()
             return
 
+        if getattr(ap.args, "probe"):
+            self.Internal.response = self.probe_json(ap.args.probe)
+            return
+
+        if getattr(ap.args, "framecache_stats"):
+            self.Internal.response = self.framecache_json(ap.args.framecache_stats, ap.args.framecache_size)
+            return
+
         # ---
 
         ap.path("script")
         self.check_script(ap.args)
 
+        if data:
+            self.apply_data(ap.args, data)
+
         # ---
 
         string_arg = ap.string_arg()
@@ -224,8 +356,9 @@ class Configuration:
 
         # ---
 
-        ap.commas("framelist", int)
-        ap.commas("frameopts", int)
+        ap.commas("framelist", utils.frame_index)
+        ap.commas("crop", int)
+        ap.commas("frameopts", utils.frame_index)
         ap.commas("filterlist", str)
         ap.commas("filteropts", str)
         ap.commas("fontcolor", int, allow_string=True, is_tuple=True)
@@ -239,18 +372,21 @@ class Configuration:
                    "repeatfilter", "fillwords", "nogrow", "align", "nowrap", "no_outline_left",
                    "no_outline_right", "no_outline_top", "no_outline_bottom", "verbose", "fillgen",
                    "descender", "seed", "frameseed", "wordseed", "filterseed", "colorseed",
-                   "deepfry", "vertical", "horizontal", "word_color_mode"]
+                   "deepfry", "vertical", "horizontal", "word_color_mode", "stream", "stdout",
+                   "workers", "count", "framecache_size", "reusepalette", "nocache", "localindex", "codec", "preset", "crf", "encoder_threads", "pixel_format"]
 
         for normal in normals:
             ap.normal(normal)
 
         # ---
 
-        paths = ["input", "output", "wordfile", "randomfile"]
+        paths = ["output", "wordfile", "randomfile", "framecache", "profile", "profilestats", "profiletrace"]
 
         for path in paths:
             ap.path(path)
 
+        self.fill_inputs(ap.args.input)
+
         # ---
 
         self.fill_paths()
@@ -261,17 +397,25 @@ class Configuration:
             return [codecs.decode(utils.clean_lines(item), "unicode-escape")
                     for item in value.split(self.separator)]
 
-        if not self.input:
-            utils.exit("You need to provide an input file")
-            return
+        if not self.Internal.given_frames:
+            if (not self.input) and (args.input is None):
+                utils.exit("You need to provide an input file")
+                return
+
+            if not self.input:
+                utils.exit("No input files found")
+                return
 
-        if not self.output:
+        if self.stdout:
+            self.stream = True
+        elif (not self.output) and (self.Internal.output_file is None) and (not self.Internal.given_frames):
             utils.exit("You need to provide an output path")
             return
 
-        if (not self.input.exists()) or (not self.input.is_file()):
-            utils.exit("Input file does not exist")
-            return
+        for path in self.inputs:
+            if (not path.exists()) or (not path.is_file()):
+                utils.exit("Input file does not exist")
+                return
 
         if self.wordfile:
             if not self.wordfile.exists() or not self.wordfile.is_file():
@@ -294,7 +438,49 @@ class Configuration:
         if not self.nowrap:
             self.wrap_text("words")
 
-        if self.vertical or self.horizontal:
+        if self.crop:
+            if (len(self.crop) != 4) or (min(self.crop[:2]) < 0) or (min(self.crop[2:]) <= 0):
+                utils.exit("Crop must be x,y,w,h with a positive width and height")
+                return
+
+        if self.count < 1:
+            utils.exit("Value for 'count' is too low")
+            return
+
+        if (self.count > 1) and (self.stdout or self.remake):
+            utils.exit("'count' can't be used with 'stdout' or 'remake'")
+            return
+
+        if self.reusepalette and self.nocache:
+            utils.exit("'reusepalette' can't be used with 'nocache'")
+            return
+
+        if self.framecache_size < 1:
+            utils.exit("Value for 'framecache-size' is too low")
+            return
+
+        if (self.crf is not None) and ((self.crf < 0) or (self.crf > 63)):
+            utils.exit("Value for 'crf' must be between 0 and 63")
+            return
+
+        if (self.encoder_threads is not None) and (self.encoder_threads < 1):
+            utils.exit("Value for 'encoder-threads' is too low")
+            return
+
+        if args.grid:
+            size = [part.strip() for part in args.grid.lower().split("x")]
+
+            if (len(size) != 2) or (not all(part.isdigit() and int(part) > 0 for part in size)):
+                utils.exit("Grid must be columns and rows, like 4x3")
+                return
+
+            if self.vertical or self.horizontal:
+                utils.exit("'grid' can't be used with 'vertical' or 'horizontal'")
+                return
+
+            self.grid = [int(part) for part in size]
+
+        if self.vertical or self.horizontal or self.grid:
             if self.format not in ["jpg", "png"]:
                 self.format = "png"
 
@@ -322,21 +508,67 @@ class Configuration:
         data = utils.read_toml(Path(self.script))
 
         if data:
-            for key in data:
-                k = ArgParser.dash_to_under(key)
-                setattr(args, k, data[key])
+            self.apply_data(args, data)
+
+    def apply_data(self, args: Namespace, data: Dict[str, Any]) -> None:
+        for key in data:
+            k = ArgParser.dash_to_under(key)
+            setattr(args, k, data[key])
 
     def read_wordfile(self) -> None:
         if self.wordfile:
             self.words = self.wordfile.read_text().splitlines()
 
     def fill_root(self, main_file: str) -> None:
-        self.Internal.root = Path(main_file).parent
-        self.Internal.fontspath = ArgParser.full_path(Path(self.Internal.root, "fonts"))
+        # These are the same for every configuration
+        Configuration.Internal.root = Path(main_file).parent
+        Configuration.Internal.fontspath = ArgParser.full_path(Path(Configuration.Internal.root, "fonts"))
 
     def get_manifest(self):
         with open(Path(self.Internal.root, "manifest.json"), "r") as file:
-            self.Internal.manifest = json.load(file)
+            Configuration.Internal.manifest = json.load(file)
+
+    def reset(self) -> None:
+        # Back to the defaults, with new internal state
+        self.__init__()  # type: ignore
+
+    def fill_inputs(self, value: Any) -> None:
+        # The input can be many files, directories, or glob patterns
+        # A script can also use a list
+        if value is None:
+            return
+
+        if isinstance(value, list):
+            items = [str(item) for item in value]
+        elif ArgParser.resolve_path(str(value)).is_file():
+            items = [str(value)]
+        else:
+            items = str(value).split(",")
+
+        inputs: List[Path] = []
+
+        for item in items:
+            item = item.strip()
+
+            if not item:
+                continue
+
+            if any(char in item for char in "*?["):
+                matches = sorted(glob.glob(os.path.expanduser(item)))
+                inputs.extend(ArgParser.resolve_path(match) for match in matches if os.path.isfile(match))
+                continue
+
+            path = ArgParser.resolve_path(item)
+
+            if path.is_dir():
+                files = [file for file in path.iterdir() if file.is_file()]
+                files = [file for file in files if utils.get_extension(file) in self.Internal.media_extensions]
+                inputs.extend(sorted(ArgParser.resolve_path(file) for file in files))
+            else:
+                inputs.append(path)
+
+        self.inputs = inputs
+        self.input = inputs[0] if inputs else None
 
     def fill_paths(self) -> None:
         assert isinstance(self.Internal.root, Path)
@@ -387,16 +619,20 @@ class Configuration:
 
         return ans
 
-    def set_random(self) -> None:
+    def set_random(self, variant: int = 0) -> None:
+        # Each variant made by --count gets seeds derived from the given ones
         def set_rng(attr: str, rng_name: str) -> None:
             value = getattr(self, attr)
 
-            if value is not None:
-                rand = random.Random(value)
-            elif self.seed is not None:
-                rand = random.Random(self.seed)
-            else:
+            if value is None:
+                value = self.seed
+
+            if value is None:
                 rand = random.Random()
+            elif variant:
+                rand = random.Random(f"{value}:{variant}")
+            else:
+                rand = random.Random(value)
 
             setattr(self.Internal, rng_name, rand)
 
@@ -404,27 +640,28 @@ class Configuration:
         set_rng("wordseed", "random_words")
         set_rng("filterseed", "random_filters")
         set_rng("colorseed", "random_colors")
+        set_rng("wordseed", "random_digits")
 
-    def get_font(self) -> ImageFont.FreeTypeFont:
-        fonts = {
-            "sans": "Roboto-Regular.ttf",
-            "serif": "RobotoSerif-Regular.ttf",
-            "mono": "RobotoMono-Regular.ttf",
-            "italic": "Roboto-Italic.ttf",
-            "bold": "Roboto-Bold.ttf",
-            "cursive": "Pacifico-Regular.ttf",
-            "comic": "ComicNeue-Regular.ttf",
-            "nova": "NovaSquare-Regular.ttf",
-        }
+    def get_font(self) -> "ImageFont.FreeTypeFont":
+        fonts = self.Internal.font_files
 
         def random_font() -> str:
             return random.choice(list(fonts.keys()))
 
+        def font_path(font_file: str) -> Path:
+            assert isinstance(self.Internal.fontspath, Path)
+            return Path(self.Internal.fontspath, font_file)
+
         if self.font == "random":
             font = random_font()
             font_file = fonts[font]
             self.font = font
         elif self.font == "random2":
+            # Every frame can use a different font so load them all once
+            if not self.Internal.fonts:
+                for name in fonts:
+                    self.load_font(font_path(fonts[name]), self.font_size())
+
             font = random_font()
             font_file = fonts[font]
         elif ".ttf" in self.font:
@@ -434,12 +671,66 @@ class Configuration:
         else:
             font_file = fonts["sans"]
 
+        return self.load_font(font_path(font_file), self.font_size())
+
+    def font_size(self) -> int:
+        # The text shrinks with frames that were decoded smaller
+        return max(1, int(round(self.fontsize * self.Internal.decode_scale)))
+
+    def preload_fonts(self) -> None:
+        # Load the bundled fonts at the default size
         assert isinstance(self.Internal.fontspath, Path)
-        path = Path(self.Internal.fontspath, font_file)
-        return ImageFont.truetype(path, size=self.fontsize)
+
+        for font_file in self.Internal.font_files.values():
+            self.load_font(Path(self.Internal.fontspath, font_file), self.fontsize)
+
+        self.Internal.font_hits = 0
+        self.Internal.font_misses = 0
+
+    def load_font(self, path: Path, size: int) -> "ImageFont.FreeTypeFont":
+        # Fonts are kept in memory since parsing the file for every frame is slow
+        # The file is read once and shared by all the sizes that use it
+        from PIL import ImageFont  # type: ignore
+        key = (str(path.resolve()), size)
+        fonts = self.Internal.fonts
+
+        if key in fonts:
+            self.Internal.font_hits += 1
+            fonts.move_to_end(key)
+            return fonts[key]
+
+        self.Internal.font_misses += 1
+        font = ImageFont.truetype(BytesIO(self.read_font(path, key[0])), size=size)
+        fonts[key] = font
+
+        while len(fonts) > self.Internal.max_fonts:
+            fonts.popitem(last=False)
+
+        return font
+
+    def read_font(self, path: Path, key: str) -> bytes:
+        # Pillow keeps the bytes it reads from the buffer as they are
+        # so every size of a font uses this one copy
+        data = self.Internal.font_data
+        lock = self.Internal.font_lock
+
+        with lock:
+            if key in data:
+                data.move_to_end(key)
+                return data[key]
+
+        content = path.read_bytes()
+
+        with lock:
+            data[key] = content
+
+            while len(data) > self.Internal.max_fonts:
+                data.popitem(last=False)
+
+        return content
 
     def arguments_json(self) -> str:
-        filter_out = ["string_arg", "arguments"]
+        filter_out = ["string_arg", "arguments", "probe", "framecache-stats"]
 
         new_dict = {
             key: {k: v for k, v in value.items() if (k != "type" and k != "action")}
@@ -452,6 +743,49 @@ class Configuration:
 
         return json.dumps(new_dict)
 
+    def probe_json(self, value: str) -> str:
+        from .probe import Index
+
+        path = ArgParser.resolve_path(value)
+
+        if (not path.exists()) or (not path.is_file()):
+            utils.exit("Probe file does not exist")
+
+        return json.dumps(Index(path).get_info_dict(), indent=2)
+
+    def framecache_json(self, value: str, size: Union[int, None]) -> str:
+        from .framecache import FrameCache
+
+        path = ArgParser.resolve_path(value)
+
+        if not path.is_dir():
+            utils.exit("Frame cache directory does not exist")
+
+        return json.dumps(FrameCache(path, size or self.framecache_size).stats(), indent=2)
+
+
+def internal_state(attrs: Dict[str, Any]) -> Type[Configuration.InternalState]:
+    # The attributes given here are the configuration's own, the rest come from the base
+    return type("Internal", (Configuration.InternalState,), attrs)
+
+
+class Context:
+    # Stands in for the configuration of the current call
+    # Modules import it once and always reach the configuration that is in use
+    # Calls made through the api set their own, everything else uses the default one
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(current.get(), name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(current.get(), name, value)
+
+
+# The configuration of the program, and of calls that don't set their own
+default = Configuration()
+
+# The configuration in use, api calls set their own while they run
+current: ContextVar[Configuration] = ContextVar("config", default=default)
 
 # Main configuration object
-config = Configuration()
+config = cast(Configuration, Context())
@@ -0,0 +1,332 @@
+# Libraries
+import numpy as np
+import numpy.typing as npt
+from PIL import Image, ImageFilter  # type: ignore
+
+# Standard
+from typing import List, Dict, Union, Tuple
+
+
+# Hue filters go from hue1 to hue8
+MIN_HUE = 1
+MAX_HUE = 8
+HUE_STEP = 20
+
+# Filters that only depend on the color of each pixel
+# These can be joined into a single pass
+COLOR_FILTERS = [f"hue{i}" for i in range(MIN_HUE, MAX_HUE + 1)] + ["gray", "grey", "invert"]
+
+# Pixels processed at once, this bounds the temporary arrays
+# Small chunks keep them in the cpu cache
+CHUNK_PIXELS = 1 << 16
+
+# Spread of the blur kernel, used to blur frames that were decoded smaller
+BLUR_SIGMA = (44 / 16) ** 0.5
+
+Batch = npt.NDArray[np.uint8]
+
+hue_luts: Dict[int, npt.NDArray[np.uint8]] = {}
+
+
+def hue_lut(n: int) -> npt.NDArray[np.uint8]:
+    # Shift applied to the hue channel, one small table per hue
+    if n not in hue_luts:
+        hue_luts[n] = np.array([(i + HUE_STEP * n) % 180 for i in range(256)], dtype=np.uint8)
+
+    return hue_luts[n]
+
+
+def split_chain(filtr: str) -> List[str]:
+    # Filters can be joined like hue2+gray
+    return [name.strip() for name in filtr.split("+") if name.strip()]
+
+
+def fused_segments(names: List[str]) -> List[List[str]]:
+    # Consecutive color filters are joined so they run as one pass
+    # Other filters like blur run on their own
+    segments: List[List[str]] = []
+
+    for name in names:
+        if name in COLOR_FILTERS:
+            if segments and (segments[-1][0] in COLOR_FILTERS):
+                segments[-1].append(name)
+            else:
+                segments.append([name])
+        elif name == "blur":
+            segments.append([name])
+
+    return segments
+
+
+def gray(rgb: Batch) -> Batch:
+    # Same integer formula Pillow uses for RGB to L
+    r = rgb[..., 0].astype(np.uint32)
+    g = rgb[..., 1].astype(np.uint32)
+    b = rgb[..., 2].astype(np.uint32)
+    lum = ((r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16).astype(np.uint8)
+    return np.repeat(lum[..., None], 3, axis=-1)
+
+
+def invert(rgb: Batch) -> Batch:
+    return np.subtract(255, rgb, dtype=np.uint8)
+
+
+def rgb_to_hsv(rgb: Batch) -> Tuple[Batch, Batch, Batch]:
+    # Same steps and float types as Pillow's RGB to HSV, so the result is the same
+    r = rgb[..., 0].astype(np.float32)
+    g = rgb[..., 1].astype(np.float32)
+    b = rgb[..., 2].astype(np.float32)
+    maxc = np.maximum(np.maximum(r, g), b)
+    minc = np.minimum(np.minimum(r, g), b)
+    flat = maxc == minc
+    cr = np.where(flat, np.float32(1), maxc - minc)
+    s = cr / np.where(flat, np.float32(1), maxc)
+    rc = ((maxc - r) / cr).astype(np.float64)
+    gc = ((maxc - g) / cr).astype(np.float64)
+    bc = ((maxc - b) / cr).astype(np.float64)
+    h = np.where(r == maxc, (bc - gc).astype(np.float32), np.where(g == maxc, 2 + rc - bc, 4 + gc - rc))
+    h = np.fmod(h.astype(np.float32).astype(np.float64) / 6 + 1, 1).astype(np.float32)
+    uh = np.where(flat, 0, np.clip((h.astype(np.float64) * 255).astype(np.int32), 0, 255)).astype(np.uint8)
+    us = np.where(flat, 0, np.clip((s.astype(np.float64) * 255).astype(np.int32), 0, 255)).astype(np.uint8)
+    return uh, us, maxc.astype(np.uint8)
+
+
+class HueTables:
+    # Small tables built with the same steps as Pillow's HSV conversions
+    # so the hue filters only do lookups and integer operations per pixel
+    # The results are the same as Pillow's, the tables take about 1MB
+
+    # Bits of the fixed point factors, with 23 bits every result is exact
+    BITS = 23
+
+    def __init__(self) -> None:
+        # The hue only depends on which channel is the max
+        # and on how far the other two are from it
+        d1, d2 = np.divmod(np.arange(1 << 16, dtype=np.uint32), 256)
+        d1 = (255 - d1).astype(np.uint8)
+        d2 = (255 - d2).astype(np.uint8)
+        top = np.full(1 << 16, 255, dtype=np.uint8)
+        colors = [(top, d1, d2), (d1, top, d2), (d1, d2, top)]
+        self.hue = np.concatenate([rgb_to_hsv(np.stack(c, axis=-1))[0] for c in colors])
+        self.hues: Dict[int, Batch] = {}
+
+        # The saturation only depends on the max and on the distance to the min
+        maxc, cr = np.divmod(np.arange(1 << 16, dtype=np.int32), 256)
+        minc = np.clip(maxc - cr, 0, 255).astype(np.uint8)
+        self.sat = rgb_to_hsv(np.stack([maxc.astype(np.uint8), minc, minc], axis=-1))[1]
+
+        # Going back, like Pillow's HSV to RGB, each channel is the value, p, or one of q and t
+        # p depends on the value and the saturation
+        # q and t are the value times a factor that depends on the saturation and the hue
+        s, h = np.divmod(np.arange(1 << 16, dtype=np.int32), 256)
+        hf = h * 6 / 255
+        i = np.floor(hf)
+        f = (hf - i).astype(np.float32).astype(np.float64)
+        fs = (s / 255).astype(np.float32).astype(np.float64)
+        sector = i.astype(np.int32) % 6
+        factor = np.where(sector % 2 == 1, 1 - fs * f, 1 - fs * (1 - f))
+        self.factor = np.floor(factor * (1 << self.BITS) + 0.5).astype(np.uint32)
+        v = np.arange(256, dtype=np.float64)[:, None]
+        self.p = np.floor(v * (1 - fs.reshape(256, 256)[:, 0]) + 0.5).astype(np.uint8).reshape(-1)
+
+        # Bit shifts that put the value, p, and the other one in their channels
+        # There's one of each for each hue, from the 6 sectors of the hue circle
+        place = np.array([[0, 2, 1], [1, 2, 0], [1, 0, 2], [2, 0, 1], [2, 1, 0], [0, 1, 2]])
+        self.shifts = [(place[sector[:256], i] * 8).astype(np.uint32) for i in range(3)]
+
+        # Which of the differences to the max are zero tells which channel is the max
+        self.branch = np.array([2, 0, 1, 0], dtype=np.uint32) << 16
+
+    def hue_table(self, n: int) -> Batch:
+        # The hue table with the shift of hue n already applied
+        if n not in self.hues:
+            self.hues[n] = hue_lut(n)[self.hue]
+
+        return self.hues[n]
+
+    def shift(self, rgb: Batch, n: int) -> Batch:
+        r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+        maxc = np.maximum(np.maximum(r, g), b)
+        minc = np.minimum(np.minimum(r, g), b)
+        dr = maxc - r
+        dg = maxc - g
+        db = maxc - b
+        zero = (dr == 0).view(np.uint8) | ((dg == 0).view(np.uint8) << 1)
+        branch = self.branch[zero]
+        d1 = np.where(zero & 1, dg, dr).astype(np.uint32)
+        d2 = np.where(branch == (2 << 16), dg, db)
+        h = self.hue_table(n)[branch | (d1 << 8) | d2]
+        v = maxc.astype(np.uint32)
+        s = self.sat[(v << 8) | (maxc - minc)]
+        p = self.p[(v << 8) | s].astype(np.uint32)
+        other = (v * self.factor[(s.astype(np.uint32) << 8) | h] + (1 << (self.BITS - 1))) >> self.BITS
+        words = (v << self.shifts[0][h]) | (p << self.shifts[1][h]) | (other << self.shifts[2][h])
+
+        # The last byte of each word is left out
+        ans: Batch = words.astype("<u4", copy=False).view(np.uint8).reshape(rgb.shape[:-1] + (4,))
+        return ans[..., :3]
+
+
+hue_tables: Union[HueTables, None] = None
+
+
+def hue(rgb: Batch, n: int) -> Batch:
+    # Only the hue channel changes, through a 256 entry table
+    # Two threads can build the tables at the same time, they are the same
+    global hue_tables
+
+    if hue_tables is None:
+        hue_tables = HueTables()
+
+    return hue_tables.shift(rgb, n)
+
+
+def color_filter(rgb: Batch, name: str) -> Batch:
+    if name.startswith("hue"):
+        return hue(rgb, int(name[3:]))
+    elif name in ["gray", "grey"]:
+        return gray(rgb)
+    elif name == "invert":
+        return invert(rgb)
+
+    return rgb
+
+
+def apply_colors(batch: Batch, names: List[str]) -> Batch:
+    # The colors are changed in place, alpha is kept as it was
+    channels = batch.shape[-1]
+    pixels = batch.size // channels
+    flat = batch.reshape(pixels, channels)
+
+    for start in range(0, pixels, CHUNK_PIXELS):
+        rgb = flat[start:start + CHUNK_PIXELS, :3]
+        new_rgb = rgb
+
+        for name in names:
+            new_rgb = color_filter(new_rgb, name)
+
+        rgb[...] = new_rgb
+
+    return batch
+
+
+def blur(batch: Batch, scale: float = 1.0) -> Batch:
+    # Frames are blurred one at a time to bound the temporary arrays
+    if batch.ndim == 4:
+        return np.stack([blur(frame, scale) for frame in batch])
+
+    if scale < 1:
+        return scaled_blur(batch, scale)
+
+    return blur_frame(batch)
+
+
+def scaled_blur(batch: Batch, scale: float) -> Batch:
+    # The blur is meant for the source size so smaller frames get a smaller blur
+    # A gaussian with the same spread as the kernel, scaled down
+    rgb = Image.fromarray(np.ascontiguousarray(batch[..., :3]), mode="RGB")
+    rgb = rgb.filter(ImageFilter.GaussianBlur(BLUR_SIGMA * scale))
+    return with_rgb(batch, np.asarray(rgb))
+
+
+def blur_frame(batch: Batch) -> Batch:
+    # Same as ImageFilter.BLUR, a 5x5 ring kernel divided by 16
+    # Pillow leaves the 2 pixels of the border as they are
+    rgb = batch[..., :3]
+    height, width = rgb.shape[-3], rgb.shape[-2]
+
+    if (height < 5) or (width < 5):
+        return batch
+
+    wide = rgb.astype(np.uint16)
+    inner = (slice(None),) * (rgb.ndim - 3)
+    total = np.zeros(wide[inner + (slice(2, -2), slice(2, -2))].shape, dtype=np.uint16)
+
+    for dy in range(5):
+        for dx in range(5):
+            if (dy in [0, 4]) or (dx in [0, 4]):
+                total += wide[inner + (slice(dy, height - 4 + dy), slice(dx, width - 4 + dx))]
+
+    new_rgb = rgb.copy()
+    new_rgb[inner + (slice(2, -2), slice(2, -2))] = (total + 8) // 16
+    return with_rgb(batch, new_rgb)
+
+
+def with_rgb(batch: Batch, rgb: Batch) -> Batch:
+    # Alpha is kept as it was for every filter
+    if batch.shape[-1] == 4:
+        return np.concatenate([rgb, batch[..., 3:]], axis=-1)
+
+    return np.ascontiguousarray(rgb)
+
+
+def apply(batch: Batch, filtr: str, scale: float = 1.0) -> Batch:
+    # Batch is a contiguous array of frames shaped (N, H, W, C)
+    # Color filters change it in place, blur returns a new one
+    # Scale is the size of the frames compared to the source
+    for segment in fused_segments(split_chain(filtr)):
+        if segment[0] == "blur":
+            batch = blur(batch, scale)
+        else:
+            batch = apply_colors(batch, segment)
+
+    return batch
+
+
+class FrameBuffer:
+    # One contiguous array that holds a batch of frames while they are filtered
+    # It's reused for every batch of a job and only replaced when a bigger batch comes
+    # Frames are copied in once and the filtered pixels are copied out once
+
+    def __init__(self) -> None:
+        self.array: Batch = np.empty(0, dtype=np.uint8)
+
+    def ensure(self, shape: Tuple[int, ...]) -> Batch:
+        size = int(np.prod(shape))
+
+        if self.array.size < size:
+            self.array = np.empty(size, dtype=np.uint8)
+
+        return self.array[:size].reshape(shape)
+
+    def load(self, frames: List[Image.Image]) -> Batch:
+        # Frames must have the same size and mode
+        width, height = frames[0].size
+        batch = self.ensure((len(frames), height, width, len(frames[0].getbands())))
+
+        for slot, frame in zip(batch, frames):
+            slot[...] = np.asarray(frame)
+
+        return batch
+
+
+def apply_frames(frames: List[Image.Image], filtr: str, scale: float = 1.0,
+                 buffer: Union[FrameBuffer, None] = None) -> List[Image.Image]:
+    # Frames of the same size and mode are filtered together
+    # The buffer can be given so many batches use the same memory
+    # The pixels are filtered in the buffer, so the given frames and the list are not changed
+    # Filtered frames are new images, without a filter the same frames are returned
+    if not fused_segments(split_chain(filtr)):
+        return list(frames)
+
+    buffer = buffer or FrameBuffer()
+    ans: List[Union[Image.Image, None]] = [None] * len(frames)
+    groups: Dict[Tuple[Tuple[int, int], str], List[int]] = {}
+    loaded: List[Image.Image] = []
+
+    for i, frame in enumerate(frames):
+        if frame.mode not in ["RGB", "RGBA"]:
+            frame = frame.convert("RGBA" if "A" in frame.getbands() else "RGB")
+
+        loaded.append(frame)
+        groups.setdefault((frame.size, frame.mode), []).append(i)
+
+    for (size, mode), indices in groups.items():
+        batch = buffer.load([loaded[i] for i in indices])
+        batch = apply(batch, filtr, scale)
+
+        # The buffer is used again by the next batch so the images get their own copy
+        for i, array in zip(indices, batch):
+            ans[i] = Image.frombytes(mode, size, array)
+
+    return [frame for frame in ans if frame is not None]
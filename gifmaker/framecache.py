@@ -0,0 +1,178 @@
+# Libraries
+import numpy as np
+import numpy.typing as npt
+
+# Standard
+import os
+import time
+import fcntl
+import threading
+from pathlib import Path
+from typing import List, Dict, Tuple, Union, Any
+
+
+Frame = npt.NDArray[np.uint8]
+
+# Frames saved by an older version are decoded again
+VERSION = 1
+
+# Eviction goes a bit below the cap so it doesn't run on every write
+EVICT_TO = 0.9
+
+# Frames written between checks of the size
+EVICT_EVERY = 64
+
+# Temporary files older than this many seconds were left by a process that died
+STALE_SECONDS = 3600
+
+# A saved frame as its last use, size and path
+Entry = Tuple[float, int, Path]
+
+
+class FrameCache:
+    # Decoded frames saved as .npy files, one per frame, so reading one is a plain copy
+    # Frames of the same input and decode view go in the same directory
+    # The modification time of a file is its last use, the oldest go first when the cache is full
+    # Files are written to a temporary name and renamed so other processes never read half a frame
+    # Only one process evicts at a time, the others skip it
+
+    def __init__(self, path: Path, size: int) -> None:
+        # Size is the cap in MB
+        self.path = path
+        self.max_bytes = size * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def frame_path(self, key: str, index: int) -> Path:
+        return Path(self.path, key[:2], key, f"{index}.npy")
+
+    def get(self, key: str, index: int) -> Union[Frame, None]:
+        path = self.frame_path(key, index)
+
+        try:
+            frame: Frame = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError, EOFError):
+            with self.lock:
+                self.misses += 1
+
+            return None
+
+        with self.lock:
+            self.hits += 1
+
+        return frame
+
+    def put(self, key: str, index: int, frame: Frame) -> None:
+        path = self.frame_path(key, index)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+            with open(tmp, "wb") as file:
+                np.save(file, frame)
+
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                tmp.unlink()
+            except OSError:
+                pass
+
+            return
+
+        with self.lock:
+            self.writes += 1
+            check = (self.writes % EVICT_EVERY) == 0
+
+        if check:
+            self.evict()
+
+    def entries(self) -> List[Entry]:
+        ans: List[Entry] = []
+        now = time.time()
+
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                path = Path(root, name)
+
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+
+                if name.endswith(".npy"):
+                    ans.append((stat.st_mtime, stat.st_size, path))
+                elif name.endswith(".tmp") and (now - stat.st_mtime > STALE_SECONDS):
+                    try:
+                        path.unlink()
+                    except OSError:
+                        pass
+
+        return ans
+
+    def evict(self) -> None:
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            lockfile = open(Path(self.path, ".lock"), "w")
+        except OSError:
+            return
+
+        with lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+
+            if total <= self.max_bytes:
+                return
+
+            entries.sort(key=lambda entry: entry[0])
+
+            for _, size, path in entries:
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+
+                total -= size
+
+                # Directories are removed once they are empty
+                try:
+                    path.parent.rmdir()
+                    path.parent.parent.rmdir()
+                except OSError:
+                    pass
+
+    def close(self) -> None:
+        # Frames written since the last check could be over the cap
+        if self.writes % EVICT_EVERY:
+            self.evict()
+
+    def stats(self) -> Dict[str, Any]:
+        entries = self.entries()
+        groups = set(path.parent.name for _, _, path in entries)
+        times = [mtime for mtime, _, _ in entries]
+
+        return {
+            "path": str(self.path),
+            "max_bytes": self.max_bytes,
+            "bytes": sum(size for _, size, _ in entries),
+            "frames": len(entries),
+            "views": len(groups),
+            "oldest": min(times) if times else None,
+            "newest": max(times) if times else None,
+        }
+
+    def info(self) -> Dict[str, int]:
+        # What this process did with the cache
+        return {"hits": self.hits, "misses": self.misses, "writes": self.writes}
@@ -0,0 +1,308 @@
+# Libraries
+import numpy as np
+import numpy.typing as npt
+from PIL import Image  # type: ignore
+
+# Standard
+import struct
+from io import BytesIO
+from pathlib import Path
+from typing import List, Dict, Union, Tuple
+
+
+# Used when a frame has no palette at all
+GRAY_PALETTE = bytes(i for i in range(256) for _ in range(3))
+
+# Bytes read at once when skipping the pixel data of a frame
+SKIP_CHUNK = 1 << 16
+
+
+class GifFrame:
+    # Position and metadata of a frame inside the gif file
+
+    def __init__(self) -> None:
+        self.left = 0
+        self.top = 0
+        self.width = 0
+        self.height = 0
+        self.disposal = 0
+        self.transparency: Union[int, None] = None
+        self.duration = 0
+        self.palette: Union[bytes, None] = None
+        self.interlace = False
+        self.data_start = 0
+        self.data_end = 0
+        self.key = False
+
+        # Where the control block and the descriptor start, -1 when there is no control block
+        self.control_start = -1
+        self.desc_start = 0
+
+
+class GifReader:
+    # Reads single frames from a gif without decoding the whole file
+    # The block structure is indexed once, which doesn't require decoding pixels
+    # Frames are composited from the closest previous key frame
+    # A key frame covers the whole screen without transparency so it doesn't depend on earlier frames
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.file = open(path, "rb")
+        self.frames: List[GifFrame] = []
+        self.width = 0
+        self.height = 0
+        self.palette: Union[bytes, None] = None
+        self.background = 0
+
+        # Where the blocks start, after the global palette
+        # and the span of the loop block, -1 when there is none
+        self.header_end = 0
+        self.loop_start = -1
+        self.loop_end = -1
+
+        self.build_index()
+        self.alpha = any(frame.transparency is not None for frame in self.frames)
+        self.channels = 4 if self.alpha else 3
+        self.pos = -1
+        self.canvas = self.blank()
+        self.saved: Union[Image.Image, None] = None
+
+    def read_exact(self, num: int) -> bytes:
+        data = self.file.read(num)
+
+        if len(data) != num:
+            raise EOFError("Truncated gif file")
+
+        return data
+
+    def skip_blocks(self) -> None:
+        # The sizes of the sub blocks are followed in memory, a chunk at a time
+        while True:
+            start = self.file.tell()
+            chunk = self.file.read(SKIP_CHUNK)
+
+            if not chunk:
+                raise EOFError("Truncated gif file")
+
+            pos = 0
+
+            while pos < len(chunk):
+                size = chunk[pos]
+
+                if size == 0:
+                    self.file.seek(start + pos + 1)
+                    return
+
+                pos += size + 1
+
+            self.file.seek(start + pos)
+
+    def build_index(self) -> None:
+        header = self.read_exact(13)
+
+        if header[:3] != b"GIF":
+            raise ValueError("Not a gif file")
+
+        self.width, self.height, packed, self.background = struct.unpack("<HHBB", header[6:12])
+
+        if packed & 0x80:
+            self.palette = self.read_exact(3 * (2 ** ((packed & 7) + 1)))
+
+        self.header_end = self.file.tell()
+        control = GifFrame()
+
+        while True:
+            start = self.file.tell()
+            s = self.file.read(1)
+
+            if (not s) or (s == b";"):
+                break
+
+            if s == b"!":
+                label = self.read_exact(1)[0]
+
+                if label == 0xF9:
+                    size = self.read_exact(1)[0]
+                    block = self.read_exact(size)
+
+                    if size >= 4:
+                        control.disposal = (block[0] >> 2) & 7
+                        control.duration = struct.unpack("<H", block[1:3])[0] * 10
+                        control.control_start = start
+
+                        if block[0] & 1:
+                            control.transparency = block[3]
+                elif label == 0xFF:
+                    size = self.read_exact(1)[0]
+                    name = self.read_exact(size)
+
+                    # The loop count is a sub block of 3 bytes that starts with 1
+                    if name in [b"NETSCAPE2.0", b"ANIMEXTS1.0"]:
+                        if self.read_exact(2) == b"\x03\x01":
+                            self.loop_start = start
+                            self.file.seek(2, 1)
+                        else:
+                            self.file.seek(-2, 1)
+
+                self.skip_blocks()
+
+                if self.loop_start == start:
+                    self.loop_end = self.file.tell()
+            elif s == b",":
+                frame = control
+                control = GifFrame()
+                frame.desc_start = start
+                desc = self.read_exact(9)
+                frame.left, frame.top, frame.width, frame.height, packed = struct.unpack("<HHHHB", desc)
+                frame.interlace = bool(packed & 0x40)
+
+                if packed & 0x80:
+                    frame.palette = self.read_exact(3 * (2 ** ((packed & 7) + 1)))
+                else:
+                    frame.palette = self.palette
+
+                frame.data_start = self.file.tell()
+                self.read_exact(1)
+                self.skip_blocks()
+                frame.data_end = self.file.tell()
+
+                full = (frame.left == 0) and (frame.top == 0) and \
+                    (frame.width >= self.width) and (frame.height >= self.height)
+
+                # Restoring to the previous state needs the frames before it
+                frame.key = full and (frame.transparency is None) and (frame.disposal != 3)
+                self.frames.append(frame)
+            else:
+                # Unknown data, stop at what was indexed so far
+                break
+
+        if self.frames:
+            self.frames[0].key = True
+
+    def count(self) -> int:
+        return len(self.frames)
+
+    def blank(self) -> Image.Image:
+        if self.alpha:
+            return Image.new("RGBA", (self.width, self.height), (0, 0, 0, 0))
+
+        return Image.new("RGB", (self.width, self.height), self.background_color())
+
+    def background_color(self) -> Tuple[int, int, int]:
+        if self.palette and (len(self.palette) >= (self.background + 1) * 3):
+            i = self.background * 3
+            return self.palette[i], self.palette[i + 1], self.palette[i + 2]
+
+        return 0, 0, 0
+
+    def decode(self, frame: GifFrame) -> Image.Image:
+        # Wrap the frame data in a minimal gif so Pillow only decodes this frame
+        self.file.seek(frame.data_start)
+        data = self.read_exact(frame.data_end - frame.data_start)
+        palette = frame.palette or GRAY_PALETTE
+        size = len(palette) // 3
+        bits = max(0, size.bit_length() - 2)
+        screen = struct.pack("<HHBBB", frame.width, frame.height, 0x80 | bits, 0, 0)
+        desc = struct.pack("<HHHHB", 0, 0, frame.width, frame.height, 0x40 if frame.interlace else 0)
+        mini = b"GIF89a" + screen + palette + b"," + desc + data + b";"
+
+        with Image.open(BytesIO(mini)) as im:
+            im.load()
+
+            if frame.transparency is not None:
+                im.info["transparency"] = frame.transparency
+                return im.convert("RGBA")
+
+            return im.convert(self.canvas.mode)
+
+    def dispose(self, frame: GifFrame) -> None:
+        if frame.disposal == 2:
+            box = (frame.left, frame.top, frame.left + frame.width, frame.top + frame.height)
+
+            if self.alpha:
+                self.canvas.paste((0, 0, 0, 0), box)
+            else:
+                self.canvas.paste(self.background_color(), box)
+        elif (frame.disposal == 3) and (self.saved is not None):
+            self.canvas = self.saved
+
+        self.saved = None
+
+    def draw(self, index: int) -> None:
+        frame = self.frames[index]
+
+        if frame.key:
+            self.canvas = self.blank()
+            self.saved = None
+        elif index > 0:
+            self.dispose(self.frames[index - 1])
+
+        # The first frame has no previous state so it is kept
+        if (frame.disposal == 3) and (index > 0):
+            self.saved = self.canvas.copy()
+
+        image = self.decode(frame)
+        position = (frame.left, frame.top)
+
+        # Transparent pixels keep what is under them
+        if frame.transparency is not None:
+            self.canvas.paste(image, position, image)
+        else:
+            self.canvas.paste(image, position)
+
+        self.pos = index
+
+    def snapshot(self) -> npt.NDArray[np.uint8]:
+        array = np.array(self.canvas)
+
+        # Opaque frames don't need the alpha channel
+        if self.alpha and (array[:, :, 3] == 255).all():
+            return array[:, :, :3].copy()
+
+        return array
+
+    def seek(self, index: int) -> None:
+        # Start from the closest key frame unless the current position is closer
+        start = index
+
+        while not self.frames[start].key:
+            start -= 1
+
+        if (self.pos < start) or (self.pos > index):
+            self.draw(start)
+
+        for i in range(self.pos + 1, index + 1):
+            self.draw(i)
+
+    def read(self, indices: List[int]) -> Dict[int, Union[npt.NDArray[np.uint8], None]]:
+        ans: Dict[int, Union[npt.NDArray[np.uint8], None]] = {}
+
+        for index in sorted(indices):
+            if (index < 0) or (index >= len(self.frames)):
+                ans[index] = None
+                continue
+
+            try:
+                self.seek(index)
+                ans[index] = self.snapshot()
+            except Exception:
+                self.pos = -1
+                ans[index] = None
+
+        return ans
+
+    def time_to_index(self, seconds: float) -> int:
+        elapsed = 0
+        target = seconds * 1000
+
+        for index, frame in enumerate(self.frames):
+            elapsed += frame.duration
+
+            if elapsed > target:
+                return index
+
+        return max(0, len(self.frames) - 1)
+
+    def close(self) -> None:
+        self.file.close()
+
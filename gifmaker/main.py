@@ -1,13 +1,23 @@
 # Modules
 from .config import config
 from . import words
-from . import media
 from . import utils
+from .profiler import profiler
 
 # Standard
+import sys
 import time
+from pathlib import Path
+from typing import Iterator, TYPE_CHECKING
+
+# The media modules load numpy, imageio and Pillow
+# They are imported once the arguments are valid so things like --version start fast
+if TYPE_CHECKING:
+    from PIL import Image  # type: ignore
+    from .writers import Target
 
 # Performance
+STREAM_BATCH = 8
 last_time = 0.0
 
 
@@ -21,7 +31,42 @@ def show_seconds(name: str, start: float, end: float) -> None:
     utils.msg(f"{label}: {num} seconds")
 
 
+def show_cache() -> None:
+    hits = config.Internal.font_hits
+    misses = config.Internal.font_misses
+
+    if hits or misses:
+        label = utils.colortext("blue", "Font Cache")
+        utils.msg(f"{label}: {hits} hits, {misses} misses")
+
+    hits = config.Internal.frame_hits
+    misses = config.Internal.frame_misses
+
+    if hits or misses:
+        label = utils.colortext("blue", "Frame Cache")
+        utils.msg(f"{label}: {hits} hits, {misses} misses")
+
+
+def show_decodes() -> None:
+    # Still images are decoded once, smaller when the output is smaller
+    for decode in config.Internal.still_decodes:
+        full_w, full_h = decode["full"]
+        width, height = decode["decoded"]
+        label = utils.colortext("blue", "Still Decode")
+
+        if (width, height) == (full_w, full_h):
+            size = f"{full_w}x{full_h} at full size"
+        else:
+            fewer = round((full_w * full_h) / max(1, width * height), 1)
+            size = f"{full_w}x{full_h} decoded at {width}x{height}, {fewer}x fewer pixels"
+
+        utils.msg(f"{label}: {size}, {round(decode['seconds'], 3)} seconds, "
+                  f"{config.Internal.shared_frames} repeated frames copied")
+
+
 def check_time(name: str) -> None:
+    profiler.stage(name)
+
     if not config.verbose:
         return
 
@@ -40,8 +85,15 @@ def main() -> None:
     config.fill_root(__file__)
     config.get_manifest()
 
+    # Keep running and take jobs instead
+    if sys.argv[1:2] == ["serve"]:
+        from . import server
+        server.serve(sys.argv[2:], serve_job)
+        return
+
     # Check the provided arguments
     config.parse_args()
+    start_profile(start_time)
     check_time("Parse Args")
 
     # Print response if not empty then exit
@@ -49,19 +101,69 @@ def main() -> None:
         utils.respond(config.Internal.response)
         return
 
+    output = run(start_time)
+    profiler.finish(output)
+
+    # Print the output path as the response
+    if output:
+        utils.respond(str(output))
+
+
+def serve_job() -> "Target":
+    # Used by the server after a job was loaded into the config
+    global last_time
+    last_time = get_time()
+    start_profile(last_time)
+    output = run(last_time)
+    profiler.finish(output)
+    return output
+
+
+def start_profile(start_time: float) -> None:
+    if config.profile or config.profilestats or config.profiletrace:
+        profiler.start(start_time, config.profile, config.profilestats, config.profiletrace)
+
+
+def run(start_time: float) -> "Target":
+    from . import media
+    from . import remake
+    from . import parallel
+
+    # The media modules are loaded here, after the arguments were checked
+    check_time("Imports")
+
+    if config.count > 1:
+        make_variants(start_time)
+        return None
+
+    # Only the delay or loop of a gif changes, the bytes are patched
+    if remake.can_patch():
+        output = remake.patch()
+        check_time("Patch")
+        return output
+
     # Process words
     words.process_words()
     check_time("Process Words")
 
+    if config.stream:
+        return stream(start_time)
+
     # Extract the required frames from the file
     frames = media.get_frames()
     check_time("Get Frames")
 
     if not frames:
         utils.msg("No frames")
-        return
+        return None
 
-    if config.remake:
+    if config.workers > 1:
+        # Filters, deep fry and resize run on a process pool
+        with parallel.FramePool(config.workers) as pool:
+            frames = list(parallel.stream_frames(frames, pool))
+
+        check_time("Process Frames")
+    elif config.remake:
         # Only resize the frames
         frames = media.resize_frames(frames)
         check_time("Resize Frames")
@@ -91,11 +193,85 @@ def main() -> None:
         utils.msg("")
         label = utils.colortext("blue", "Frames")
         utils.msg(f"{label}: {len(frames)}")
+        show_cache()
+        show_decodes()
         show_seconds("Total", get_time(), start_time)
         utils.msg("")
 
-    # Print the output path as the response
-    utils.respond(str(output))
+    return output
+
+
+def make_variants(start_time: float) -> None:
+    from . import variants
+
+    # Frames are decoded once and shared by all the outputs
+    variants.prepare(config.count)
+    check_time("Get Frames")
+
+    # Each output path is printed when it's ready
+    outputs = variants.run(config.count)
+    check_time("Variants")
+
+    # End stats
+    if config.verbose:
+        utils.msg("")
+        label = utils.colortext("blue", "Outputs")
+        utils.msg(f"{label}: {len(outputs)} of {config.count}")
+        show_cache()
+        show_decodes()
+        show_seconds("Total", get_time(), start_time)
+        utils.msg("")
+
+
+def stream(start_time: float) -> "Target":
+    from . import media
+    from . import parallel
+
+    num_frames = 0
+
+    def counted(frames: Iterator["Image.Image"]) -> Iterator["Image.Image"]:
+        nonlocal num_frames
+
+        for frame in frames:
+            num_frames += 1
+            yield frame
+
+    # Each stage pulls one frame at a time from the previous one
+    frames = media.stream_frames(STREAM_BATCH)
+
+    if config.workers > 1:
+        with parallel.FramePool(config.workers) as pool:
+            frames = parallel.stream_frames(frames, pool)
+            output = media.render_stream(counted(frames))
+    else:
+        if config.remake:
+            frames = media.stream_resize(frames)
+        else:
+            frames = media.stream_filters(frames)
+            frames = media.stream_deep_fry(frames)
+            frames = media.stream_words(frames)
+            frames = media.stream_resize(frames)
+
+        output = media.render_stream(counted(frames))
+
+    check_time("Stream")
+
+    if not num_frames:
+        utils.msg("No frames")
+        return None
+
+    # End stats
+    if config.verbose:
+        utils.msg("")
+        label = utils.colortext("blue", "Frames")
+        utils.msg(f"{label}: {num_frames}")
+        show_cache()
+        show_decodes()
+        show_seconds("Total", get_time(), start_time)
+        utils.msg("")
+
+    # None when the output itself went to stdout
+    return output
 
 
 if __name__ == "__main__":
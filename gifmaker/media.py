@@ -2,90 +2,228 @@
 from .config import config
 from . import utils
 from . import words
+from . import sources
+from . import writers
+from . import filters
+from . import framecache
+from . import gifreader
+from .profiler import profiler
 
 # Libraries
 import imageio  # type: ignore
 import numpy as np
 import numpy.typing as npt
-from PIL import Image, ImageFilter, ImageOps, ImageDraw, ImageFont  # type: ignore
+from PIL import Image, ImageDraw, ImageFont  # type: ignore
 
 # Standard
+import os
+import math
 import random
+import hashlib
+import itertools
+import threading
 from io import BytesIO
 from pathlib import Path
-from typing import List, Dict, Union
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Union, Iterable, Iterator, Any
+
+
+# Frames filtered together in one batch
+# Big frames make smaller batches
+FILTER_BATCH = 16
+FILTER_BATCH_PIXELS = 1 << 24
+
+# Threads used to encode gifs
+GIF_THREADS = 8
+
+# Text layers kept in memory
+MAX_TEXT_LAYERS = 32
+
+# A drawn text and where it goes on the frame
+TextLayer = Tuple[Union[Image.Image, None], Tuple[int, int]]
+
+text_layers: "OrderedDict[Tuple[Any, ...], TextLayer]" = OrderedDict()
+text_lock = threading.Lock()
 
 
 def get_frames() -> List[Image.Image]:
+    return list(stream_frames())
+
+
+def stream_frames(batch_size: int = 0) -> Iterator[Image.Image]:
+    cache = frame_cache()
+    source = open_source(cache)
+
+    try:
+        yield from source_frames(source, batch_size)
+    finally:
+        close_source(source)
+        close_cache(cache)
+
+
+def open_source(cache: Union[framecache.FrameCache, None] = None) -> sources.Source:
     count_frames()
 
-    assert isinstance(config.frames, int)
     assert isinstance(config.input, Path)
 
-    frames = []
-    path = config.input
-    ext = utils.get_extension(path)
-
-    if (ext == "jpg") or (ext == "jpeg") or (ext == "png"):
-        reader = imageio.imread(path)
-        max_frames = 1
-        mode = "image"
-    elif ext == "gif":
-        reader = imageio.mimread(path)
-        max_frames = len(reader)
-        mode = "gif"
-    else:
-        reader = imageio.get_reader(path)
-        max_frames = reader.count_frames()
-        mode = "video"
+    source = sources.open_sources(config.inputs or [config.input], cache)
+    config.Internal.shared_frames = 0
+    set_view(source)
+    return source
 
-    num_frames = max_frames if config.remake else config.frames
-    order = "normal" if (config.remake or config.framelist) else config.order
-    framelist = config.framelist if config.framelist else range(max_frames)
-    current = 0
 
-    # Sometimes it fails to read the frames so it needs more tries
-    for _ in range(0, num_frames * 25):
-        if order == "normal":
-            index = framelist[current]
-        elif order == "random":
-            if config.frameopts:
-                index = random.choice(config.frameopts)
-            else:
-                assert isinstance(config.Internal.random_frames, random.Random)
-                index = config.Internal.random_frames.randint(0, len(framelist))
+def close_source(source: sources.Source) -> None:
+    config.Internal.still_decodes = source.decodes()
+    source.close()
 
-        try:
-            if mode == "image":
-                img = reader
-            elif mode == "video":
-                img = reader.get_data(index)
-            elif mode == "gif":
-                img = reader[index]
 
-            frames.append(to_pillow(img))
-        except Exception as e:
-            pass
+def frame_cache() -> Union[framecache.FrameCache, None]:
+    if not config.framecache:
+        return None
+
+    return framecache.FrameCache(config.framecache, config.framecache_size)
+
+
+def close_cache(cache: Union[framecache.FrameCache, None]) -> None:
+    if not cache:
+        return
+
+    cache.close()
+    config.Internal.frame_hits = cache.hits
+    config.Internal.frame_misses = cache.misses
 
-        if len(frames) == num_frames:
-            break
 
+def frame_draws(source: sources.Source) -> Iterator[int]:
+    # The indices of the frames to use, in order
+    order = "normal" if (config.remake or config.framelist) else config.order
+
+    if config.framelist:
+        framelist = sources.resolve_indices(source, config.framelist)
+    else:
+        framelist = list(range(source.count()))
+
+    frameopts = sources.resolve_indices(source, config.frameopts)
+    current = 0
+
+    while True:
         if order == "normal":
+            if not framelist:
+                return
+
+            yield framelist[current]
             current += 1
 
             if current >= len(framelist):
                 current = 0
+        elif frameopts:
+            assert isinstance(config.Internal.random_frames, random.Random)
+            yield config.Internal.random_frames.choice(frameopts)
+        elif framelist:
+            # The draw can be one past the last frame, it reads nothing and is drawn again
+            # The range is kept like this so the same seed picks the same frames
+            assert isinstance(config.Internal.random_frames, random.Random)
+            yield config.Internal.random_frames.randint(0, len(framelist))
+        else:
+            return
+
+
+def source_frames(source: sources.Source, batch_size: int = 0) -> Iterator[Image.Image]:
+    num_frames, max_tries = frame_tries(source)
+    yield from pillow_frames(sources.stream(source, frame_draws(source), num_frames, max_tries, batch_size))
+
+
+def frame_indices(source: sources.Source) -> List[int]:
+    # The indices of the frames that source_frames would give, without making images of them
+    num_frames, max_tries = frame_tries(source)
+    return [index for index, _ in sources.stream_items(source, frame_draws(source), num_frames, max_tries)]
 
-    if mode == "video":
-        reader.close()
 
-    return frames
+def frame_tries(source: sources.Source) -> Tuple[int, int]:
+    # Sometimes it fails to read the frames so it needs more tries
+    assert isinstance(config.frames, int)
+    num_frames = source.count() if config.remake else config.frames
+    return num_frames, num_frames * 25
+
+
+def pillow_frames(arrays: Iterable[sources.Frame]) -> Iterator[Image.Image]:
+    used = set()
+
+    # The last read only frame that was picked again, and its pixels
+    shared: Tuple[Any, Union[Image.Image, None]] = (None, None)
+    start = profiler.now()
+
+    for i, array in enumerate(arrays):
+        # The same frame can be picked more than once
+        # Later stages draw in place so repeats get their own buffer
+        # Read only frames, like a still image, are made into a Pillow image once and copied from it
+        if id(array) not in used:
+            frame = to_pillow(array)
+        elif array.flags.writeable:
+            frame = to_pillow(array.copy())
+        else:
+            if shared[0] is not array:
+                shared = (array, to_pillow(array))
+
+            assert isinstance(shared[1], Image.Image)
+            frame = shared[1].copy()
+            config.Internal.shared_frames += 1
+
+        used.add(id(array))
+        profiler.frame("decode", i, start)
+        yield frame
+        start = profiler.now()
+
+
+def set_view(source: sources.Source) -> None:
+    # Crop and downscale while decoding so every later stage works on smaller frames
+    # Only when the frames would be made smaller by the resize at the end
+    full = source.size()
+    crop = crop_box(full)
+    config.Internal.decode_scale = 1.0
+    config.Internal.output_size = None
+
+    if (not full[0]) or (not full[1]):
+        # The size is not known, the crop is used as it is
+        source.set_view(crop, None)
+        return
+
+    cropped = (crop[2], crop[3]) if crop else full
+    size = resize_size(cropped)
+    config.Internal.output_size = size
+
+    if (not size) or (size[0] > cropped[0]) or (size[1] > cropped[1]) or (size == cropped):
+        source.set_view(crop, None)
+        return
+
+    # Deep fry makes JPEG blocks of a fixed number of pixels, so it's done at full size
+    # like before, and the frames are made smaller by the resize at the end
+    if config.deepfry:
+        source.set_view(crop, None)
+        return
+
+    config.Internal.decode_scale = size[0] / cropped[0]
+    source.set_view(crop, size)
+
+
+def crop_box(full: Tuple[int, int]) -> Union[sources.Box, None]:
+    # The crop is kept inside the frame when the size is known
+    if not config.crop:
+        return None
+
+    x, y, w, h = config.crop
+    return sources.clip_box((x, y, w, h), full)
+
+
+def text_scaled(value: Any) -> Any:
+    # Sizes and positions of the text are given for the source size
+    if (value is None) or (config.Internal.decode_scale == 1):
+        return value
+
+    return int(round(value * config.Internal.decode_scale))
 
 
 def draw_text(frame: Image.Image, line: str) -> Image.Image:
-    draw = ImageDraw.Draw(frame, "RGBA")
     font = config.get_font()
-    data = get_text_data(frame, line, font)
     get_colors = True
 
     if line == config.Internal.last_words:
@@ -107,15 +245,68 @@ def draw_text(frame: Image.Image, line: str) -> Image.Image:
     config.Internal.last_colors = [fontcolor, bgcolor, ocolor]
     config.Internal.last_words = line
 
+    # The same text on frames of the same size is only drawn once
+    key = (line, font, fontcolor, bgcolor, ocolor, frame.size, text_settings())
+
+    # Calls on other threads share the layers, a layer is drawn outside the lock
+    with text_lock:
+        cached = text_layers.get(key)
+
+        if cached is not None:
+            text_layers.move_to_end(key)
+
+    if cached is None:
+        cached = text_layer(frame.size, line, font, fontcolor, bgcolor, ocolor)
+
+        with text_lock:
+            text_layers[key] = cached
+
+            while len(text_layers) > MAX_TEXT_LAYERS:
+                text_layers.popitem(last=False)
+
+    layer, position = cached
+
+    if layer is None:
+        return frame
+
+    if frame.mode == "RGBA":
+        frame.alpha_composite(layer, position)
+    else:
+        if frame.mode != "RGB":
+            frame = frame.convert("RGB")
+
+        frame.paste(layer, position, layer)
+
+    return frame
+
+
+def text_settings() -> Tuple[Any, ...]:
+    # Settings that change how the text looks or where it goes
+    return (config.Internal.decode_scale, config.padding, config.top, config.bottom, config.left, config.right,
+            config.descender, config.align, bool(config.bgcolor), config.opacity,
+            config.radius, bool(config.outline), config.outlinewidth,
+            config.no_outline_top, config.no_outline_left,
+            config.no_outline_bottom, config.no_outline_right)
+
+
+def text_layer(size: Tuple[int, int], line: str, font: ImageFont.FreeTypeFont,
+               fontcolor: Any, bgcolor: Any, ocolor: Any) -> TextLayer:
+    # Draw the text on a transparent layer the size of the frame
+    # The layer is cropped to what was drawn and returned with its position
+    layer = Image.new("RGBA", size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer, "RGBA")
+    data = get_text_data(layer, line, font)
+
     min_x = data["min_x"]
     min_y = data["min_y"]
     max_x = data["max_x"]
     max_y = data["max_y"]
+    padding = text_scaled(config.padding)
 
-    min_x_p = min_x - config.padding
-    min_y_p = min_y - config.padding + data["ascender"]
-    max_x_p = max_x + config.padding
-    max_y_p = max_y + config.padding
+    min_x_p = min_x - padding
+    min_y_p = min_y - padding + data["ascender"]
+    max_x_p = max_x + padding
+    max_y_p = max_y + padding
 
     if not config.descender:
         max_y_p -= data["descender"]
@@ -123,42 +314,75 @@ def draw_text(frame: Image.Image, line: str) -> Image.Image:
     if config.bgcolor:
         alpha = utils.add_alpha(bgcolor, config.opacity)
         rect_pos = (min_x_p, min_y_p), (max_x_p, max_y_p)
-        draw.rounded_rectangle(rect_pos, fill=alpha, radius=config.radius)
+        draw.rounded_rectangle(rect_pos, fill=alpha, radius=text_scaled(config.radius))
 
     if config.outline:
-        owidth = config.outlinewidth
-        owidth = utils.divisible(owidth, 2)
-        halfwidth = owidth / 2
+        owidth = utils.divisible(config.outlinewidth, 2)
+        box = (min_x_p, min_y_p, max_x_p, max_y_p)
 
-        if not config.no_outline_top:
-            draw.line([(min_x_p, min_y_p - halfwidth),
-                       (max_x_p, min_y_p - halfwidth)], fill=ocolor, width=owidth)
+        if config.Internal.decode_scale == 1:
+            draw_outline(draw, box, owidth, ocolor)
+        else:
+            layer.alpha_composite(outline_layer(size, box, owidth, ocolor))
 
-        if not config.no_outline_left:
-            draw.line([(min_x_p - halfwidth, min_y_p - owidth + 1),
-                       (min_x_p - halfwidth, max_y_p + owidth)], fill=ocolor, width=owidth)
+    # The text is drawn as a mask so its soft edges blend over the layer
+    mask = Image.new("L", size, 0)
+    ImageDraw.Draw(mask).multiline_text((min_x, min_y), line, fill=255, font=font, align=config.align)
+    text = Image.new("RGBA", size, tuple(fontcolor[:3]) + (255,))
+    text.putalpha(mask)
+    layer.alpha_composite(text)
 
-        if not config.no_outline_bottom:
-            draw.line([(min_x_p, max_y_p + halfwidth),
-                       (max_x_p, max_y_p + halfwidth)], fill=ocolor, width=owidth)
+    box = layer.getbbox()
 
-        if not config.no_outline_right:
-            draw.line([(max_x_p + halfwidth, min_y_p - owidth + 1),
-                       (max_x_p + halfwidth, max_y_p + owidth)], fill=ocolor, width=owidth)
+    if box is None:
+        return None, (0, 0)
 
-    draw.multiline_text((min_x, min_y), line, fill=fontcolor, font=font, align=config.align)
+    return layer.crop(box), (box[0], box[1])
 
-    return frame
+
+def draw_outline(draw: ImageDraw.ImageDraw, box: Tuple[float, float, float, float], owidth: int, ocolor: Any) -> None:
+    min_x_p, min_y_p, max_x_p, max_y_p = box
+    halfwidth = owidth / 2
+
+    if not config.no_outline_top:
+        draw.line([(min_x_p, min_y_p - halfwidth),
+                   (max_x_p, min_y_p - halfwidth)], fill=ocolor, width=owidth)
+
+    if not config.no_outline_left:
+        draw.line([(min_x_p - halfwidth, min_y_p - owidth + 1),
+                   (min_x_p - halfwidth, max_y_p + owidth)], fill=ocolor, width=owidth)
+
+    if not config.no_outline_bottom:
+        draw.line([(min_x_p, max_y_p + halfwidth),
+                   (max_x_p, max_y_p + halfwidth)], fill=ocolor, width=owidth)
+
+    if not config.no_outline_right:
+        draw.line([(max_x_p + halfwidth, min_y_p - owidth + 1),
+                   (max_x_p + halfwidth, max_y_p + owidth)], fill=ocolor, width=owidth)
+
+
+def outline_layer(size: Tuple[int, int], box: Tuple[float, float, float, float],
+                  owidth: int, ocolor: Any) -> Image.Image:
+    # Frames that were decoded smaller get the outline drawn at the source size
+    # and then made smaller like the frames, so a thin outline stays thin
+    scale = config.Internal.decode_scale
+    source_size = (math.ceil(size[0] / scale), math.ceil(size[1] / scale))
+    source_box = (box[0] / scale, box[1] / scale, box[2] / scale, box[3] / scale)
+    mask = Image.new("L", source_size, 0)
+    draw_outline(ImageDraw.Draw(mask), source_box, owidth, 255)
+    outline = Image.new("RGBA", size, tuple(ocolor[:3]) + (255,))
+    outline.putalpha(mask.resize(size, Image.Resampling.BICUBIC))
+    return outline
 
 
 def get_text_data(frame: Image.Image, line: str, font: ImageFont.FreeTypeFont) -> Dict[str, int]:
     draw = ImageDraw.Draw(frame)
     width, height = frame.size
 
-    p_top = config.top
-    p_bottom = config.bottom
-    p_left = config.left
-    p_right = config.right
+    p_top = text_scaled(config.top)
+    p_bottom = text_scaled(config.bottom)
+    p_left = text_scaled(config.left)
+    p_right = text_scaled(config.right)
 
     b_left, b_top, b_right, b_bottom = draw.multiline_textbbox((0, 0), line, font=font)
     ascender = font.getbbox(line.split("\n")[0])[1]
@@ -192,7 +416,7 @@ def get_text_data(frame: Image.Image, line: str, font: ImageFont.FreeTypeFont) -
     else:
         # Center Vertical
         if not config.descender:
-            text_y = (height - b_bottom + descender - ascender - (config.padding / 2)) // 2
+            text_y = (height - b_bottom + descender - ascender - (text_scaled(config.padding) / 2)) // 2
         else:
             text_y = (height - b_bottom - ascender) // 2
 
@@ -215,13 +439,19 @@ def get_text_data(frame: Image.Image, line: str, font: ImageFont.FreeTypeFont) -
 
 
 def word_frames(frames: List[Image.Image]) -> List[Image.Image]:
+    return list(stream_words(frames))
+
+
+def stream_words(frames: Iterable[Image.Image]) -> Iterator[Image.Image]:
     if not config.words:
-        return frames
+        yield from frames
+        return
 
-    worded = []
     num_words = len(config.words)
 
     for i, frame in enumerate(frames):
+        start = profiler.now()
+
         if config.fillgen:
             line = words.generate(config.words[0], False)[0]
         else:
@@ -231,7 +461,7 @@ def word_frames(frames: List[Image.Image]) -> List[Image.Image]:
                 if config.fillwords:
                     index = num_words - 1
                 else:
-                    worded.append(frame)
+                    yield frame
                     continue
 
             line = config.words[index]
@@ -239,19 +469,61 @@ def word_frames(frames: List[Image.Image]) -> List[Image.Image]:
         if line:
             frame = draw_text(frame, line)
 
-        worded.append(frame)
-
-    return worded
+        profiler.frame("words", i, start, text=line)
+        yield frame
 
 
 def resize_frames(frames: List[Image.Image]) -> List[Image.Image]:
+    return list(stream_resize(frames))
+
+
+def stream_resize(frames: Iterable[Image.Image]) -> Iterator[Image.Image]:
+    frames = iter(frames)
+
+    if (not config.width) and (not config.height):
+        yield from frames
+        return
+
+    # The size is based on the first frame
+    first = next(frames, None)
+
+    if first is None:
+        return
+
+    frames = itertools.chain([first], frames)
+    size = output_size(first.size)
+
+    if size is None:
+        yield from frames
+        return
+
+    for i, frame in enumerate(frames):
+        start = profiler.now()
+
+        # Frames that were decoded at this size are kept as they are
+        if frame.size != size:
+            frame = frame.resize(size)
+
+        profiler.frame("resize", i, start)
+        yield frame
+
+
+def output_size(original: Tuple[int, int]) -> Union[Tuple[int, int], None]:
+    # The size is known before decoding, see set_view
+    if config.Internal.output_size:
+        return config.Internal.output_size
+
+    return resize_size(original)
+
+
+def resize_size(original: Tuple[int, int]) -> Union[Tuple[int, int], None]:
+    # None means the frames keep their size
     if (not config.width) and (not config.height):
-        return frames
+        return None
 
-    new_frames = []
     new_width = config.width
     new_height = config.height
-    w, h = frames[0].size
+    w, h = original
     ratio = w / h
 
     if new_width and (not new_height):
@@ -263,29 +535,38 @@ def resize_frames(frames: List[Image.Image]) -> List[Image.Image]:
     assert isinstance(new_height, int)
 
     if (new_width <= 0) or (new_height <= 0):
-        return frames
+        return None
 
     if config.nogrow:
         if (new_width > w) or (new_height > h):
-            return frames
-
-    size = (new_width, new_height)
-
-    for frame in frames:
-        new_frames.append(frame.resize(size))
+            return None
 
-    return new_frames
+    return new_width, new_height
 
 
-def render(frames: List[Image.Image]) -> Union[Path, None]:
-    assert isinstance(config.output, Path)
-    ext = utils.get_extension(config.output)
+def get_format() -> str:
+    ext = "" if config.stdout else utils.get_extension(Path(str(config.output)))
     fmt = ext if ext else config.format
 
-    if config.vertical or config.horizontal:
+    if strip_layout():
         if fmt not in ["jpg", "png"]:
             fmt = "png"
 
+    return fmt
+
+
+def get_output() -> writers.Target:
+    # None means the output goes to stdout
+    # Calls that give an open file, like the api, get it instead of a path
+    if config.Internal.output_file is not None:
+        return config.Internal.output_file
+
+    if config.stdout:
+        return None
+
+    assert isinstance(config.output, Path)
+    ext = utils.get_extension(config.output)
+
     def makedir(path: Path) -> None:
         try:
             path.mkdir(parents=False, exist_ok=True)
@@ -302,74 +583,340 @@ def render(frames: List[Image.Image]) -> Union[Path, None]:
         file_name = f"{rand}.{config.format}"
         output = Path(config.output, file_name)
 
-    if config.vertical:
-        frames = [append_frames(frames, "vertical")]
+    return output
+
+
+def render(frames: List[Image.Image]) -> writers.Target:
+    fmt = get_format()
+    output = get_output()
+    to_file = isinstance(output, Path)
 
-    if config.horizontal:
-        frames = [append_frames(frames, "horizontal")]
+    # When profiling, files are encoded to memory first so encoding and writing are timed apart
+    split = profiler.enabled and to_file and (fmt in ["png", "jpg"])
+    target = output if (to_file and not split) else "<bytes>"
+    data = None
+    start = profiler.now()
+
+    if strip_layout() and frames:
+        return render_strip(frames, output, fmt)
 
     if fmt == "gif":
-        frames = to_array_all(frames)
-        loop = None if config.loop <= -1 else config.loop
-        imageio.mimsave(output, frames, format="GIF", duration=config.delay, loop=loop)
+        # The palette is made from frames of the whole animation
+        writer = gif_writer(output)
+        writer.sample(frames)
+
+        for frame in frames:
+            writer.append(frame)
+
+        writer.close()
+        show_gif(writer)
+        profiler.render(fmt, writer.encode_seconds, writer.io_seconds, frames=writer.frames, **gif_info(writer))
+        return output
     elif fmt == "png":
         frame = frames[0]
         frame = to_array(frame)
-        imageio.imsave(output, frame, format="PNG")
+        data = imageio.imsave(target, frame, format="PNG")
     elif fmt == "jpg":
         frame = frames[0]
-        frame = frame.convert("RGB")
+
+        if frame.mode != "RGB":
+            frame = frame.convert("RGB")
+
         frame = to_array(frame)
-        imageio.imsave(output, frame, format="JPEG")
+        data = imageio.imsave(target, frame, format="JPEG")
     elif fmt == "mp4" or fmt == "webm":
-        frames = to_array_all(frames)
-        fps = 1000 / config.delay
+        # Frames are piped into ffmpeg as they are
+        return render_stream(frames)
+    else:
+        utils.exit("Invalid format")
+        return None
 
-        if fmt == "mp4":
-            codec = "libx264"
-        elif fmt == "webm":
-            codec = "libvpx"
+    encode = profiler.now() - start
+    start = profiler.now()
 
-        writer = imageio.get_writer(output, fps=fps, codec=codec)
+    if split and isinstance(output, Path) and data:
+        output.write_bytes(data)
+    elif (not to_file) and data:
+        writers.open_target(output).write(data)
 
-        for frame in frames:
-            writer.append_data(frame)
+    io = profiler.now() - start
+    profiler.render(fmt, encode, io if (split or not to_file) else None, frames=len(frames))
+    return output
 
-        writer.close()
-    else:
-        utils.exit("Invalid format")
+
+def render_stream(frames: Iterable[Image.Image]) -> writers.Target:
+    # Frames are encoded as they arrive instead of being collected first
+    fmt = get_format()
+    frames = iter(frames)
+    first = next(frames, None)
+
+    if first is None:
         return None
 
+    frames = itertools.chain([first], frames)
+
+    if strip_layout():
+        return stream_strip(first, frames)
+
+    if fmt not in ["gif", "mp4", "webm"]:
+        # Still images need all the frames
+        return render(list(frames))
+
+    output = get_output()
+    writer: Union[writers.GifWriter, writers.VideoWriter]
+
+    if fmt == "gif":
+        writer = gif_writer(output)
+    else:
+        writer = video_writer(output, fmt)
+
+    for frame in frames:
+        writer.append(frame)
+
+    writer.close()
+    info: Dict[str, Any] = {}
+
+    if isinstance(writer, writers.GifWriter):
+        show_gif(writer)
+        info = gif_info(writer)
+
+    profiler.render(fmt, writer.encode_seconds, writer.io_seconds, frames=writer.frames, **info)
     return output
 
 
+def strip_layout() -> Union[Tuple[int, int], None]:
+    # Columns and rows of frames joined into one image, 0 means as many as there are frames
+    if config.grid:
+        return config.grid[0], config.grid[1]
+    elif config.vertical:
+        return 1, 0
+    elif config.horizontal:
+        return 0, 1
+
+    return None
+
+
+def strip_mode(frames: List[Image.Image], fmt: str) -> str:
+    # Alpha is kept when the format has it
+    if (fmt == "png") and any(frame.mode in ["RGBA", "LA", "PA"] for frame in frames):
+        return "RGBA"
+
+    return "RGB"
+
+
+def render_strip(frames: List[Image.Image], output: writers.Target, fmt: str) -> writers.Target:
+    # All the sizes are known so the image has the size of what it holds
+    layout = strip_layout()
+    assert layout is not None
+    columns, rows = layout
+    widths, heights = zip(*(frame.size for frame in frames))
+    cell = None
+
+    if config.grid:
+        frames = frames[:columns * rows]
+        cell = (max(widths), max(heights))
+        width, height = columns * cell[0], rows * cell[1]
+    elif config.vertical:
+        width, height = max(widths), sum(heights)
+    else:
+        columns = len(frames)
+        width, height = sum(widths), max(heights)
+
+    writer = writers.StripWriter(output, fmt, strip_mode(frames, fmt), columns, width, height, cell)
+    return write_strip(writer, frames)
+
+
+def stream_strip(first: Image.Image, frames: Iterable[Image.Image]) -> writers.Target:
+    # Frames are written as they arrive, each frame gets the size of the first one
+    # A row of the image has every frame of a horizontal strip, and jpg is joined in memory,
+    # so those need all the frames, like stdout when the height is not known
+    fmt = get_format()
+    output = get_output()
+    layout = strip_layout()
+    assert layout is not None
+    columns, rows = layout
+    width, height = first.size
+
+    if (fmt != "png") or config.horizontal or ((output is None) and (not config.grid)):
+        return render(list(frames))
+
+    if config.grid:
+        writer = writers.StripWriter(output, fmt, strip_mode([first], fmt), columns,
+                                     columns * width, rows * height, (width, height))
+
+        frames = itertools.islice(frames, columns * rows)
+    else:
+        writer = writers.StripWriter(output, fmt, strip_mode([first], fmt), 1, width)
+
+    return write_strip(writer, frames)
+
+
+def write_strip(writer: writers.StripWriter, frames: Iterable[Image.Image]) -> writers.Target:
+    for frame in frames:
+        writer.append(frame)
+
+    writer.close()
+    profiler.render(writer.fmt, writer.encode_seconds, writer.io_seconds, frames=writer.frames)
+    return writer.path
+
+
+def gif_writer(output: writers.Target) -> writers.GifWriter:
+    loop = None if config.loop <= -1 else config.loop
+    threads = min(os.cpu_count() or 1, GIF_THREADS)
+    # Frames are also compressed whole only when the savings are shown
+    measure = bool(config.verbose) or profiler.enabled
+    return writers.GifWriter(output, config.delay, loop, threads, palette_path(), remake_palette(), measure)
+
+
+def video_writer(output: writers.Target, fmt: str) -> writers.VideoWriter:
+    if config.codec and (config.codec not in writers.VIDEO_CODECS[fmt]):
+        utils.exit(f"Codec '{config.codec}' can't be used with {fmt}")
+
+    if config.pixel_format.startswith("yuva") and (fmt != "webm"):
+        utils.exit(f"Pixel format '{config.pixel_format}' can only be used with webm")
+
+    return writers.VideoWriter(output, fmt, 1000 / config.delay, config.codec, config.preset,
+                               config.crf, config.encoder_threads, config.pixel_format)
+
+
+def remake_palette() -> Union[bytes, None]:
+    # A gif that is remade keeps its colors when all its frames use the global palette
+    if (not config.remake) or (len(config.inputs) > 1) or (not config.input):
+        return None
+
+    if utils.get_extension(config.input) != "gif":
+        return None
+
+    reader = gifreader.GifReader(config.input)
+
+    try:
+        if all(frame.palette is reader.palette for frame in reader.frames):
+            return reader.palette
+    finally:
+        reader.close()
+
+    return None
+
+
+def palette_path() -> Union[Path, None]:
+    # Palettes are saved for an input file and the filters used on it
+    paths = config.inputs or ([config.input] if config.input else [])
+
+    if (not config.reusepalette) or (not paths) or (not all(path.exists() for path in paths)):
+        return None
+
+    source = ""
+
+    for path in paths:
+        stat = path.stat()
+        source += f"{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}:"
+
+    source += f"{config.filter}:{config.deepfry}"
+    key = hashlib.sha1(source.encode()).hexdigest()
+    return Path(utils.cache_dir("palettes"), f"{key}.pal")
+
+
+def gif_info(writer: writers.GifWriter) -> Dict[str, Any]:
+    ratio = writer.byte_ratio()
+
+    return {
+        "pixels_written": round(writer.pixel_ratio(), 4),
+        "bytes_written": writer.bytes_written,
+        "bytes_ratio": None if ratio is None else round(ratio, 4),
+        "merged_frames": writer.merged,
+        "local_palettes": writer.local_palettes,
+        "reused_palette": writer.reused_palette,
+    }
+
+
+def show_gif(writer: writers.GifWriter) -> None:
+    if not config.verbose:
+        return
+
+    label = utils.colortext("blue", "GIF")
+    size = ""
+
+    if isinstance(writer.path, Path) and writer.path.exists():
+        size = f", {writer.path.stat().st_size} bytes"
+
+    pixels = round(writer.pixel_ratio() * 100, 1)
+    ratio = writer.byte_ratio()
+    saved = "" if ratio is None else f" ({round((1 - ratio) * 100, 1)}% of the frame bytes saved)"
+    palette = "reused palette" if writer.reused_palette else f"{writer.local_palettes} local palettes"
+    utils.msg(f"{label}: {round(writer.encode_seconds, 3)} seconds{size}, {pixels}% of pixels written{saved}, "
+              f"{writer.merged} repeated frames merged, {palette}")
+
+
 def apply_filters(frames: List[Image.Image]) -> List[Image.Image]:
-    if (config.filter == "none") and (not config.filterlist):
-        return frames
+    return list(stream_filters(frames))
+
 
-    new_frames = []
+def stream_filters(frames: Iterable[Image.Image]) -> Iterator[Image.Image]:
+    if not filters_enabled():
+        yield from frames
+        return
 
-    min_hue = 1
-    max_hue = 8
-    hue_step = 20
+    # Consecutive frames with the same filter are filtered as one batch
+    names = filter_names()
+    buffer = filters.FrameBuffer()
+    batch: List[Image.Image] = []
+    batch_filter = ""
+    pixels = 0
+    count = 0
 
-    hue_filters = [f"hue{i}" for i in range(min_hue, max_hue + 1)]
+    def run_batch() -> List[Image.Image]:
+        # The time of a batch is split between its frames
+        start = profiler.now()
+        ans = filters.apply_frames(batch, batch_filter, config.Internal.decode_scale, buffer)
+        share = (profiler.now() - start) / len(batch)
+
+        for i in range(len(batch)):
+            profiler.frame("filter", count + i, start + share * i, share, filter=batch_filter)
+
+        return ans
+
+    for frame in frames:
+        filtr = next(names)
+        full = (len(batch) >= FILTER_BATCH) or (pixels >= FILTER_BATCH_PIXELS)
+
+        if batch and ((filtr != batch_filter) or full):
+            yield from run_batch()
+            count += len(batch)
+            batch = []
+            pixels = 0
+
+        batch.append(frame)
+        batch_filter = filtr
+        pixels += frame.size[0] * frame.size[1]
+
+    if batch:
+        yield from run_batch()
+
+
+def filters_enabled() -> bool:
+    return (config.filter != "none") or bool(config.filterlist)
+
+
+def filter_names() -> Iterator[str]:
+    # Decide the filter of each frame
+    # This is kept apart from applying them since it uses the random state
+    hue_filters = [f"hue{i}" for i in range(filters.MIN_HUE, filters.MAX_HUE + 1)]
     all_filters = hue_filters + ["gray", "blur", "invert", "none"]
-    filters = []
+    options = []
 
     def get_filters() -> None:
-        nonlocal filters
+        nonlocal options
 
         if config.filteropts:
-            filters = config.filteropts.copy()
+            options = config.filteropts.copy()
         elif config.filter.startswith("anyhue"):
-            filters = hue_filters.copy()
+            options = hue_filters.copy()
         else:
-            filters = all_filters.copy()
+            options = all_filters.copy()
 
     def random_filter() -> str:
         assert isinstance(config.Internal.random_filters, random.Random)
-        filtr = config.Internal.random_filters.choice(filters)
+        filtr = config.Internal.random_filters.choice(options)
 
         if not config.repeatfilter:
             remove_filter(filtr)
@@ -377,25 +924,12 @@ def apply_filters(frames: List[Image.Image]) -> List[Image.Image]:
         return filtr
 
     def remove_filter(filtr: str) -> None:
-        if filtr in filters:
-            filters.remove(filtr)
+        if filtr in options:
+            options.remove(filtr)
 
-        if not filters:
+        if not options:
             get_filters()
 
-    def change_hue(frame: Image.Image, n: int) -> Image.Image:
-        hsv = frame.convert("HSV")
-        h, s, v = hsv.split()
-        h = h.point(lambda i: (i + hue_step * n) % 180)
-        new_frame = Image.merge("HSV", (h, s, v))
-
-        if frame.mode in ["RGBA", "LA"]:
-            new_frame = Image.merge("RGBA", (new_frame.split() + (frame.split()[3],)))
-        else:
-            new_frame = new_frame.convert("RGB")
-
-        return new_frame
-
     get_filters()
     filtr = config.filter
 
@@ -403,39 +937,17 @@ def apply_filters(frames: List[Image.Image]) -> List[Image.Image]:
         if config.filter == "random" or config.filter == "anyhue":
             filtr = random_filter()
 
-    for frame in frames:
+    while True:
         if config.filterlist:
             filtr = config.filterlist.pop(0)
         elif config.filter == "random2" or config.filter == "anyhue2":
             filtr = random_filter()
 
-        new_frame = None
-
-        if filtr.startswith("hue"):
-            for n in range(min_hue, max_hue + 1):
-                if filtr == f"hue{n}":
-                    new_frame = change_hue(frame, n)
-                    break
-
-        if new_frame is None:
-            if filtr in ["gray", "grey"]:
-                if frame.mode in ["RGBA", "LA"]:
-                    r, g, b, a = frame.split()
-                    gray_img = ImageOps.grayscale(frame.convert("RGB"))
-                    rgb_gray = ImageOps.colorize(gray_img, "black", "white")
-                    new_frame = Image.merge("RGBA", (rgb_gray.split() + (a,)))
-                else:
-                    new_frame = ImageOps.colorize(frame.convert("L"), "black", "white")
-            elif filtr == "blur":
-                new_frame = frame.filter(ImageFilter.BLUR)
-            elif filtr == "invert":
-                new_frame = ImageOps.invert(frame.convert("RGB"))
-            else:
-                new_frame = frame
+        yield filtr
 
-        new_frames.append(new_frame)
 
-    return new_frames
+def filter_frame(frame: Image.Image, filtr: str, scale: float = 1.0) -> Image.Image:
+    return filters.apply_frames([frame], filtr, scale)[0]
 
 
 def count_frames() -> None:
@@ -444,6 +956,8 @@ def count_frames() -> None:
 
     if config.framelist:
         config.frames = len(config.framelist)
+    elif config.grid:
+        config.frames = config.grid[0] * config.grid[1]
     elif config.words:
         num_words = len(config.words)
         config.frames = num_words if num_words > 0 else config.frames
@@ -451,61 +965,45 @@ def count_frames() -> None:
         config.frames = 3
 
 
-def rgb_or_rgba(array: npt.NDArray[np.float64]) -> str:
+def rgb_or_rgba(array: npt.NDArray[np.uint8]) -> str:
     if array.shape[2] == 4:
         return "RGBA"
     else:
         return "RGB"
 
 
-def to_pillow(array: npt.NDArray[np.float64]) -> Image.Image:
+def to_pillow(array: npt.NDArray[np.uint8]) -> Image.Image:
     mode = rgb_or_rgba(array)
     return Image.fromarray(array, mode=mode)
 
 
-def to_array(frame: Image.Image) -> npt.NDArray[np.float64]:
-    return np.array(frame)
-
-
-def to_array_all(frames: List[Image.Image]) -> List[npt.NDArray[np.float64]]:
-    return [to_array(frame) for frame in frames]
+def to_array(frame: Image.Image) -> npt.NDArray[np.uint8]:
+    # A read only view of the pixels that Pillow gives out, not another copy of it
+    return np.asarray(frame)
 
 
 def deep_fry(frames: List[Image.Image]) -> List[Image.Image]:
-    if not config.deepfry:
-        return frames
+    return list(stream_deep_fry(frames))
 
-    quality = 3
-    new_frames = []
 
-    for frame in frames:
-        stream = BytesIO()
-        frame = frame.convert("RGB")
-        frame.save(stream, format="JPEG", quality=quality)
-        new_frames.append(Image.open(stream))
-
-    return new_frames
+def stream_deep_fry(frames: Iterable[Image.Image]) -> Iterator[Image.Image]:
+    if not config.deepfry:
+        yield from frames
+        return
 
+    for i, frame in enumerate(frames):
+        start = profiler.now()
+        frame = fry_frame(frame)
+        profiler.frame("deepfry", i, start)
+        yield frame
 
-def append_frames(frames: List[Image.Image], mode: str) -> Image.Image:
-    widths, heights = zip(*(i.size for i in frames))
 
-    if mode == "vertical":
-        total_width = max(widths)
-        total_height = sum(heights)
-    elif mode == "horizontal":
-        total_width = sum(widths)
-        total_height = max(heights)
+def fry_frame(frame: Image.Image) -> Image.Image:
+    quality = 3
+    stream = BytesIO()
 
-    new_frame = Image.new("RGB", (total_width, total_height))
-    offset = 0
+    if frame.mode != "RGB":
+        frame = frame.convert("RGB")
 
-    for frame in frames:
-        if mode == "vertical":
-            new_frame.paste(frame, (0, offset))
-            offset += frame.size[1]
-        elif mode == "horizontal":
-            new_frame.paste(frame, (offset, 0))
-            offset += frame.size[0]
-
-    return new_frame
+    frame.save(stream, format="JPEG", quality=quality)
+    return Image.open(stream)
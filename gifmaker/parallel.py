@@ -0,0 +1,213 @@
+# Modules
+from .config import config
+from . import media
+
+# Libraries
+from PIL import Image  # type: ignore
+
+# Standard
+import itertools
+from collections import deque, OrderedDict
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import List, Dict, Tuple, Union, Iterable, Iterator, Deque, Any
+
+
+# An operation is a name and its argument, like ("filter", ("hue2", 1.0))
+Op = Tuple[str, Any]
+
+# A worker returns the mode and size of the frame it wrote
+Result = Tuple[str, Tuple[int, int]]
+
+# Shared memory blocks opened by a worker process, the oldest are closed first
+# Slots get a new block when they grow, so old names are never used again
+attached: "OrderedDict[str, shared_memory.SharedMemory]" = OrderedDict()
+
+# Blocks a worker keeps open, a few times the blocks that can be in flight
+MAX_ATTACHED = 64
+
+
+class Slot:
+    # A shared memory block that is reused for many frames
+    # It only gets replaced when a bigger frame comes
+
+    def __init__(self) -> None:
+        self.shm: Union[shared_memory.SharedMemory, None] = None
+
+    def ensure(self, size: int) -> shared_memory.SharedMemory:
+        if (self.shm is None) or (self.shm.size < size):
+            self.close()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+
+        return self.shm
+
+    def close(self) -> None:
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    if name in attached:
+        attached.move_to_end(name)
+        return attached[name]
+
+    # Workers share the resource tracker of the main process
+    # so the blocks are only unlinked once, by the main process
+    attached[name] = shared_memory.SharedMemory(name=name)
+
+    while len(attached) > MAX_ATTACHED:
+        _, shm = attached.popitem(last=False)
+
+        try:
+            shm.close()
+        except BufferError:
+            # A frame still uses it, the mapping goes away with the frame
+            pass
+
+    return attached[name]
+
+
+def run_ops(frame: Image.Image, ops: List[Op]) -> Image.Image:
+    for name, arg in ops:
+        if name == "filter":
+            frame = media.filter_frame(frame, *arg)
+        elif name == "deepfry":
+            frame = media.fry_frame(frame)
+        elif (name == "resize") and (frame.size != arg):
+            frame = frame.resize(arg)
+
+    return frame
+
+
+def work(src: str, dst: str, mode: str, size: Tuple[int, int], ops: List[Op]) -> Result:
+    # Runs in a worker process
+    # The frame is read from one block and the result is written to the other
+    buf = attach(src).buf
+    assert buf is not None
+    frame = Image.frombuffer(mode, size, buf, "raw", mode, 0, 1)
+    frame = run_ops(frame, ops)
+    data = frame.tobytes()
+    buf = attach(dst).buf
+    assert buf is not None
+    buf[:len(data)] = data
+    return frame.mode, frame.size
+
+
+class FramePool:
+    # Runs per frame operations on a pool of processes
+    # Frames travel through shared memory instead of being pickled
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def __enter__(self) -> "FramePool":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+    def map(self, tasks: Iterable[Tuple[Image.Image, List[Op]]]) -> Iterator[Image.Image]:
+        # Results come out in the same order as the tasks
+        # Only a few frames are in flight at once so memory stays bounded
+        window = self.workers * 2
+        slots = [(Slot(), Slot()) for _ in range(window)]
+        free = list(range(window))
+        pending: Deque[Tuple[Union[Future[Result], None], Union[Image.Image, None], int]] = deque()
+
+        def collect() -> Image.Image:
+            future, frame, index = pending.popleft()
+
+            if future is None:
+                assert isinstance(frame, Image.Image)
+                return frame
+
+            mode, size = future.result()
+            shm = slots[index][1].shm
+            assert shm is not None
+            buf = shm.buf
+            assert buf is not None
+            data = bytes(buf[:Image.getmodebands(mode) * size[0] * size[1]])
+            free.append(index)
+            return Image.frombytes(mode, size, data)
+
+        try:
+            for frame, ops in tasks:
+                if not ops:
+                    pending.append((None, frame, -1))
+                else:
+                    while not free:
+                        yield collect()
+
+                    index = free.pop()
+                    src, dst = slots[index]
+                    data = frame.tobytes()
+                    shm_src = src.ensure(len(data))
+                    buf = shm_src.buf
+                    assert buf is not None
+                    buf[:len(data)] = data
+                    out = frame.size
+
+                    for name, arg in ops:
+                        if name == "resize":
+                            out = arg
+
+                    # No supported mode has more than 4 bytes per pixel
+                    shm_dst = dst.ensure(out[0] * out[1] * 4)
+                    future = self.executor.submit(work, shm_src.name, shm_dst.name, frame.mode, frame.size, ops)
+                    pending.append((future, None, index))
+
+                while pending and (pending[0][0] is None):
+                    yield collect()
+
+            while pending:
+                yield collect()
+        finally:
+            for waiting, _, _ in pending:
+                if waiting is not None:
+                    waiting.cancel()
+
+            for src, dst in slots:
+                src.close()
+                dst.close()
+
+
+def stream_frames(frames: Iterable[Image.Image], pool: FramePool) -> Iterator[Image.Image]:
+    # Same stages as the serial pipeline
+    # Filters are picked here in frame order so the random state advances the same way
+    # Words use random colors and fonts so they are drawn in this process too
+    frames = iter(frames)
+
+    if not config.remake:
+        names = media.filter_names() if media.filters_enabled() else None
+
+        def tasks(frames: Iterator[Image.Image]) -> Iterator[Tuple[Image.Image, List[Op]]]:
+            for frame in frames:
+                ops: List[Op] = []
+
+                if names is not None:
+                    filtr = next(names)
+
+                    if filtr != "none":
+                        ops.append(("filter", (filtr, config.Internal.decode_scale)))
+
+                if config.deepfry:
+                    ops.append(("deepfry", None))
+
+                yield frame, ops
+
+        frames = media.stream_words(pool.map(tasks(frames)))
+
+    first = next(frames, None)
+
+    if first is None:
+        return
+
+    size = media.output_size(first.size)
+    resize: List[Op] = [("resize", size)] if size else []
+    yield from pool.map((frame, resize) for frame in itertools.chain([first], frames))
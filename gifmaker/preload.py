@@ -0,0 +1,12 @@
+# Loaded by the fork server of the server mode, before any job
+# Importing it fills the state that every job needs, once
+# Job processes are forked from there so they start with it
+
+# Modules
+from . import server
+
+# Standard
+from pathlib import Path
+
+
+server.setup(str(Path(__file__).parent))
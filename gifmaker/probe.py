@@ -0,0 +1,263 @@
+# Modules
+from . import utils
+
+# Standard
+import os
+import re
+import json
+import hashlib
+import subprocess
+from pathlib import Path
+from typing import List, Dict, Union, Iterable, Any
+
+
+# Indices saved by an older version are probed again
+VERSION = 2
+
+# Bytes read at once when hashing a file
+HASH_CHUNK = 1 << 20
+
+# What is known about an input file
+Info = Dict[str, Any]
+
+
+def index_path(path: Path) -> Union[Path, None]:
+    # Without the cache the index is only kept in memory
+    if not utils.use_cache():
+        return None
+
+    key = hashlib.sha1(str(path).encode()).hexdigest()
+    return Path(utils.cache_dir("probe"), f"{key}.json")
+
+
+def probe_video(path: Path) -> Info:
+    # Packets are listed without decoding them, but the whole file is read
+    # so it takes time that grows with the file size, the index keeps it for later runs
+    # The header that ffmpeg prints has the duration, size and fps
+    import imageio_ffmpeg  # type: ignore
+
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-i", str(path),
+           "-map", "0:v:0", "-c", "copy", "-f", "framecrc", "-"]
+
+    proc = subprocess.run(cmd, capture_output=True)
+    header = proc.stderr.decode(errors="replace")
+    info: Info = {"kind": "video", "fps": 0.0, "duration": 0.0, "nframes": 0,
+                  "width": 0, "height": 0, "codec": None, "keyframes": []}
+
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", header)
+
+    if match:
+        hours, minutes, seconds = match.groups()
+        info["duration"] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    for line in header.splitlines():
+        if ("Stream #" not in line) or ("Video:" not in line):
+            continue
+
+        codec = re.search(r"Video: (\w+)", line)
+        size = re.search(r", (\d+)x(\d+)", line)
+        fps = re.search(r", (\d+(?:\.\d+)?) fps", line)
+
+        if codec:
+            info["codec"] = codec.group(1)
+
+        if size:
+            info["width"], info["height"] = int(size.group(1)), int(size.group(2))
+
+        if fps:
+            info["fps"] = float(fps.group(1))
+
+        break
+
+    # ffmpeg turns rotated videos when decoding, so the size is turned too
+    rotate = re.search(r"rotate\s*:\s*(-?\d+)", header)
+
+    if rotate and (abs(int(rotate.group(1))) % 180 == 90):
+        info["width"], info["height"] = info["height"], info["width"]
+
+    # Packets come in decoding order, frames are numbered in presentation order
+    packets = []
+
+    for line in proc.stdout.decode(errors="replace").splitlines():
+        if line.startswith("#"):
+            continue
+
+        parts = [part.strip() for part in line.split(",")]
+
+        if len(parts) < 6:
+            continue
+
+        try:
+            pts = int(parts[2])
+        except ValueError:
+            continue
+
+        # Only packets that are not key frames have flags
+        packets.append((pts, not any(part.startswith("F=") for part in parts[6:])))
+
+    packets.sort(key=lambda packet: packet[0])
+    info["nframes"] = len(packets)
+    info["keyframes"] = [i for i, (_, key) in enumerate(packets) if key]
+    return info
+
+
+def probe_gif(path: Path) -> Info:
+    # The block structure is enough, no pixels are decoded
+    from .gifreader import GifReader
+
+    reader = GifReader(path)
+
+    try:
+        duration = sum(frame.duration for frame in reader.frames) / 1000
+        nframes = reader.count()
+
+        return {
+            "kind": "gif",
+            "fps": round(nframes / duration, 3) if duration else 0.0,
+            "duration": duration,
+            "nframes": nframes,
+            "width": reader.width,
+            "height": reader.height,
+            "codec": "gif",
+            "keyframes": [i for i, frame in enumerate(reader.frames) if frame.key],
+        }
+    finally:
+        reader.close()
+
+
+def probe_still(path: Path) -> Info:
+    # Opening an image only reads its header
+    from PIL import Image  # type: ignore
+
+    with Image.open(path) as image:
+        width, height = image.size
+        codec = image.format
+
+    return {"kind": "still", "fps": 0.0, "duration": 0.0, "nframes": 1,
+            "width": width, "height": height, "codec": codec, "keyframes": [0]}
+
+
+def probe_file(path: Path) -> Info:
+    ext = utils.get_extension(path)
+
+    if ext in ["jpg", "jpeg", "png"]:
+        return probe_still(path)
+    elif ext == "gif":
+        return probe_gif(path)
+    else:
+        return probe_video(path)
+
+
+class Index:
+    # What is known about an input file, saved as json in the cache directory
+    # It's only used while the file keeps the same size and modification time
+    # Frames that failed to decode are remembered as ranges so later runs don't try them again
+
+    def __init__(self, path: Path) -> None:
+        self.path = path.resolve()
+        stat = self.path.stat()
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.file = index_path(self.path)
+        self.info: Info = {}
+        self.bad: List[List[int]] = []
+        self.hash = ""
+        self.changed = False
+        self.load()
+
+    def load(self) -> None:
+        if self.file is None:
+            return
+
+        try:
+            with open(self.file) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        if not isinstance(data, dict):
+            return
+
+        if (data.get("version") != VERSION) or (data.get("size") != self.size) or (data.get("mtime") != self.mtime):
+            return
+
+        self.info = data.get("info") or {}
+        self.bad = data.get("bad") or []
+        self.hash = data.get("hash") or ""
+
+    def save(self) -> None:
+        if (not self.changed) or (self.file is None):
+            return
+
+        # Other processes never see half an index
+        try:
+            tmp = self.file.with_suffix(f".{os.getpid()}.tmp")
+
+            with open(tmp, "w") as file:
+                json.dump(self.to_dict(), file)
+
+            os.replace(tmp, self.file)
+            self.changed = False
+        except OSError:
+            pass
+
+    def get_info(self) -> Info:
+        if not self.info:
+            self.info = probe_file(self.path)
+            self.changed = True
+            self.save()
+
+        return self.info
+
+    def get_info_dict(self) -> Info:
+        # What --probe prints
+        return {"path": str(self.path), "size": self.size, **self.get_info(), "bad": self.bad}
+
+    def content_hash(self) -> str:
+        # The whole file is read once, then it's known while the file doesn't change
+        if not self.hash:
+            sha = hashlib.sha1()
+
+            with open(self.path, "rb") as file:
+                for chunk in iter(lambda: file.read(HASH_CHUNK), b""):
+                    sha.update(chunk)
+
+            self.hash = sha.hexdigest()
+            self.changed = True
+            self.save()
+
+        return self.hash
+
+    def is_bad(self, index: int) -> bool:
+        return any(start <= index <= end for start, end in self.bad)
+
+    def add_bad(self, indices: Iterable[int]) -> None:
+        # Ranges are inclusive and merged when they touch
+        new = [index for index in indices if not self.is_bad(index)]
+
+        if not new:
+            return
+
+        ranges = self.bad + [[index, index] for index in new]
+        ranges.sort()
+        merged: List[List[int]] = []
+
+        for start, end in ranges:
+            if merged and (start <= merged[-1][1] + 1):
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+
+        self.bad = merged
+        self.changed = True
+
+    def to_dict(self) -> Dict[str, Union[str, int, Info, List[List[int]]]]:
+        return {
+            "version": VERSION,
+            "path": str(self.path),
+            "size": self.size,
+            "mtime": self.mtime,
+            "info": self.info,
+            "bad": self.bad,
+            "hash": self.hash,
+        }
@@ -0,0 +1,175 @@
+# Standard
+import sys
+import json
+import time
+import resource
+import tracemalloc
+from pathlib import Path
+from typing import List, Dict, Union, Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .writers import Target
+
+
+def reset_peak() -> bool:
+    # Linux can reset the peak memory of a process
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss() -> float:
+    # Peak resident memory in MB
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Profiler:
+    # Collects the timings of the stages and of each frame
+    # Stages end where main.check_time is called
+    # Nothing is recorded unless it was started
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.path: Union[Path, None] = None
+        self.stats_path: Union[Path, None] = None
+        self.trace_path: Union[Path, None] = None
+        self.origin = 0.0
+        self.stage_start = 0.0
+        self.stages: List[Dict[str, Any]] = []
+        self.frames: Dict[int, Dict[str, Any]] = {}
+        self.events: List[Dict[str, Any]] = []
+        self.renders: List[Dict[str, Any]] = []
+        self.rows: Dict[str, int] = {"stages": 0}
+        self.cprofile: Any = None
+
+    def now(self) -> float:
+        return time.perf_counter()
+
+    def start(self, start_time: float, path: Union[Path, None],
+              stats_path: Union[Path, None], trace_path: Union[Path, None]) -> None:
+        # The start time comes from time.time so it's converted to the performance clock
+        self.__init__()  # type: ignore
+        self.enabled = True
+        self.path = path
+        self.stats_path = stats_path
+        self.trace_path = trace_path
+        self.origin = self.now() - (time.time() - start_time)
+        self.stage_start = self.origin
+        reset_peak()
+        tracemalloc.start()
+
+        if stats_path:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def micro(self, seconds: float) -> int:
+        # Microseconds since the start, used by the trace
+        return int((seconds - self.origin) * 1_000_000)
+
+    def stage(self, name: str) -> None:
+        if not self.enabled:
+            return
+
+        now = self.now()
+        traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+
+        self.stages.append({
+            "name": name,
+            "seconds": round(now - self.stage_start, 6),
+            "rss_peak_mb": round(peak_rss(), 1),
+            "tracemalloc_peak_mb": round(traced / (1024 * 1024), 2),
+        })
+
+        self.events.append({"name": name, "cat": "stage", "ph": "X", "pid": 1, "tid": 0,
+                            "ts": self.micro(self.stage_start), "dur": self.micro(now) - self.micro(self.stage_start)})
+
+        self.stage_start = now
+        reset_peak()
+
+    def frame(self, stage: str, index: int, start: float, seconds: Union[float, None] = None, **info: Any) -> None:
+        # The time of a frame in a stage, from start to now unless seconds is given
+        if not self.enabled:
+            return
+
+        if seconds is None:
+            seconds = self.now() - start
+
+        item = self.frames.setdefault(index, {"index": index, "seconds": {}})
+        item["seconds"][stage] = round(seconds, 6)
+        item.update(info)
+
+        # Each stage gets its own row in the trace
+        if stage not in self.rows:
+            self.rows[stage] = len(self.rows)
+
+        self.events.append({"name": f"{stage} {index}", "cat": stage, "ph": "X", "pid": 1, "tid": self.rows[stage],
+                            "ts": self.micro(start), "dur": int(seconds * 1_000_000), "args": info})
+
+    def render(self, fmt: str, encode: float, io: Union[float, None], **info: Any) -> None:
+        # Encoding and writing are measured apart when possible
+        if not self.enabled:
+            return
+
+        self.renders.append({
+            "format": fmt,
+            "encode_seconds": round(encode, 6),
+            "io_seconds": None if io is None else round(io, 6),
+            **info,
+        })
+
+    def finish(self, output: "Target") -> None:
+        if not self.enabled:
+            return
+
+        self.enabled = False
+        tracemalloc.stop()
+
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            assert self.stats_path is not None
+            self.cprofile.dump_stats(str(self.stats_path))
+
+        size = None
+
+        if isinstance(output, Path) and output.exists():
+            size = output.stat().st_size
+
+        if self.path:
+            report = {
+                "command": sys.argv,
+                "total_seconds": round(self.now() - self.origin, 6),
+                "rss_peak_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                "output": str(output) if isinstance(output, Path) else None,
+                "output_bytes": size,
+                "stages": self.stages,
+                "render": self.renders,
+                "frames": [self.frames[i] for i in sorted(self.frames)],
+            }
+
+            with open(self.path, "w") as file:
+                json.dump(report, file, indent=2)
+
+        if self.trace_path:
+            names = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}}
+                     for name, tid in self.rows.items()]
+
+            with open(self.trace_path, "w") as file:
+                json.dump({"traceEvents": names + self.events}, file)
+
+
+# Main profiler object
+profiler = Profiler()
@@ -0,0 +1,148 @@
+# Modules
+from .config import config
+from . import utils
+from . import media
+from . import writers
+from .profiler import profiler
+from .gifreader import GifReader
+
+# Standard
+import os
+import time
+import mmap
+import struct
+from pathlib import Path
+from typing import List, Tuple, Union, BinaryIO
+
+
+# A change to the file as the start and end of the replaced bytes, and the new bytes
+Splice = Tuple[int, int, bytes]
+
+
+def can_patch() -> bool:
+    # A gif that is remade into a gif of the same size only gets a new delay and loop
+    # Those are bytes in the control and loop blocks so the frames are not decoded
+    if (not config.remake) or (len(config.inputs) > 1) or config.framelist or config.crop:
+        return False
+
+    if (not config.input) or (utils.get_extension(config.input) != "gif"):
+        return False
+
+    if media.get_format() != "gif":
+        return False
+
+    if (not config.width) and (not config.height):
+        return True
+
+    # Resizing to the same size keeps the frames as they are
+    reader = GifReader(config.input)
+
+    try:
+        size = (reader.width, reader.height)
+    finally:
+        reader.close()
+
+    return media.resize_size(size) in [None, size]
+
+
+def control_block(delay: bytes) -> bytes:
+    # For frames that had none, nothing is transparent and nothing is disposed
+    return b"!\xf9\x04\x00" + delay + b"\x00\x00"
+
+
+def loop_block(loop: int) -> bytes:
+    return b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\x00"
+
+
+def splices(reader: GifReader, delay: int, loop: Union[int, None]) -> List[Splice]:
+    # The delay is in hundredths of a second, like the writer uses
+    value = struct.pack("<H", min(65535, int(delay / 10)))
+    ans: List[Splice] = []
+
+    if loop is None:
+        if reader.loop_start >= 0:
+            ans.append((reader.loop_start, reader.loop_end, b""))
+    elif reader.loop_start >= 0:
+        ans.append((reader.loop_start + 16, reader.loop_start + 18, struct.pack("<H", loop)))
+    else:
+        ans.append((reader.header_end, reader.header_end, loop_block(loop)))
+
+    for frame in reader.frames:
+        if frame.control_start >= 0:
+            ans.append((frame.control_start + 4, frame.control_start + 6, value))
+        else:
+            ans.append((frame.desc_start, frame.desc_start, control_block(value)))
+
+    # Blocks that were added need the newer version of the format
+    if any((end - start) != len(new) for start, end, new in ans):
+        ans.append((3, 6, b"89a"))
+
+    ans.sort(key=lambda splice: splice[0])
+    return ans
+
+
+def patch_file(path: Path, changes: List[Splice]) -> None:
+    # When nothing moves the bytes are written over the old ones
+    with open(path, "r+b") as file:
+        for start, _, data in changes:
+            file.seek(start)
+            file.write(data)
+
+
+def write_patched(file: BinaryIO, path: Path, changes: List[Splice]) -> None:
+    # The input is mapped so the parts that don't change go from the page cache to the output
+    with open(path, "rb") as source:
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+            pos = 0
+
+            for start, end, new in changes:
+                file.write(view[pos:start])
+                file.write(new)
+                pos = end
+
+            file.write(view[pos:])
+
+
+def patch() -> writers.Target:
+    # The output is the input with the delay and loop replaced
+    assert isinstance(config.input, Path)
+    begin = time.perf_counter()
+    loop = None if config.loop <= -1 else config.loop
+    reader = GifReader(config.input)
+
+    try:
+        changes = splices(reader, config.delay, loop)
+        frames = reader.count()
+    finally:
+        reader.close()
+
+    output = media.get_output()
+    same_size = all((end - start) == len(new) for start, end, new in changes)
+
+    if isinstance(output, Path) and output.exists() and output.samefile(config.input):
+        if same_size:
+            patch_file(output, changes)
+        else:
+            # The input can't be read while it's replaced
+            tmp = output.with_name(f"{output.name}.{os.getpid()}.tmp")
+
+            with open(tmp, "wb") as tmp_file:
+                write_patched(tmp_file, config.input, changes)
+
+            os.replace(tmp, output)
+    else:
+        file = writers.open_target(output)
+        write_patched(file, config.input, changes)
+        file.flush()
+
+        if isinstance(output, Path):
+            file.close()
+
+    seconds = time.perf_counter() - begin
+
+    if config.verbose:
+        label = utils.colortext("blue", "GIF")
+        utils.msg(f"{label}: {frames} frames patched in {round(seconds, 3)} seconds, nothing decoded")
+
+    profiler.render("gif", seconds, None, frames=frames, patched=True)
+    return output
@@ -0,0 +1,227 @@
+# Modules
+from .config import config
+from . import utils
+from . import words
+
+# Standard
+import io
+import os
+import sys
+import json
+import base64
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing import forkserver
+from pathlib import Path
+from multiprocessing.connection import Connection
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Union, Callable, BinaryIO, Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .writers import Target
+
+
+# A job has the same keys as a script, plus "id" and "reply"
+Job = Dict[str, Any]
+Reply = Dict[str, Any]
+
+# Renders the job that was loaded into the config
+Runner = Callable[[], "Target"]
+
+# Keys that are not arguments
+JOB_KEYS = ["id", "reply"]
+
+# Modules the fork server loads for every job
+# The last one fills the fonts and the word index once for all of them
+PRELOAD = ["media", "parallel", "server", "preload"]
+
+# Job processes come from the fork server
+context = multiprocessing.get_context("forkserver")
+
+
+class Channel:
+    # Where the replies of a client are written, one json object per line
+    # Jobs finish in any order so writes are locked
+
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.lock = threading.Lock()
+
+    def send(self, reply: Reply) -> None:
+        line = json.dumps(reply).encode() + b"\n"
+
+        with self.lock:
+            try:
+                self.file.write(line)
+                self.file.flush()
+            except (OSError, ValueError):
+                # The client went away
+                pass
+
+
+def warm() -> None:
+    # Jobs are forked from a fork server that loaded the libraries once
+    # It's a process without threads so forking there is safe, the server has threads and never forks
+    # It starts now, before any thread, so the first job doesn't wait for it
+    context.set_forkserver_preload([f"{__package__}.{name}" for name in PRELOAD])
+    forkserver.ensure_running()
+
+
+def setup(root: str) -> None:
+    # Runs once in the fork server when it imports the preload module
+    # Job processes get this state from there, not from the server
+    config.fill_root(str(Path(root, "main.py")))
+    config.get_manifest()
+    config.preload_fonts()
+    words.word_file(Path(root, "nouns.txt"))
+
+
+def child(job: Job, run: Runner, conn: Connection) -> None:
+    # Runs in a new process so every job starts from a clean config
+    # Messages are captured so errors can be sent back
+    random.seed()
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    reply: Reply = {"id": job.get("id"), "ok": False}
+    tmpdir = None
+
+    try:
+        data = {key: value for key, value in job.items() if key not in JOB_KEYS}
+
+        # The reply channel can't be shared with the output
+        data["stdout"] = False
+
+        if job.get("reply") == "bytes":
+            tmpdir = tempfile.mkdtemp(prefix="gifmaker_")
+            data["output"] = tmpdir
+
+        config.parse_args([], data)
+
+        # A job replies with a single output
+        if config.count > 1:
+            utils.exit("'count' can't be used in jobs")
+
+        output = run()
+
+        # Jobs never write to stdout so a rendered job has a path
+        if not isinstance(output, Path):
+            reply["error"] = "No frames"
+        elif tmpdir:
+            reply["data"] = base64.b64encode(output.read_bytes()).decode()
+            reply["ok"] = True
+        else:
+            reply["output"] = str(output)
+            reply["ok"] = True
+    except SystemExit as e:
+        message = e.code if isinstance(e.code, str) else sys.stderr.getvalue()
+        reply["error"] = message.strip().removeprefix("Exit: ") or "Failed"
+    except Exception as e:
+        reply["error"] = str(e) or type(e).__name__
+    finally:
+        log = sys.stderr.getvalue()
+        sys.stderr = stderr
+
+        if log and reply["ok"]:
+            stderr.write(log)
+
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    conn.send(reply)
+    conn.close()
+
+
+def run_job(job: Job, run: Runner, channel: Channel) -> None:
+    # The thread only waits for the reply
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=child, args=(job, run, sender))
+    process.start()
+    sender.close()
+
+    try:
+        reply = receiver.recv()
+    except EOFError:
+        reply = {"id": job.get("id"), "ok": False, "error": "The job process died"}
+
+    receiver.close()
+    process.join()
+    channel.send(reply)
+
+
+def read_jobs(file: BinaryIO, channel: Channel, executor: ThreadPoolExecutor, run: Runner) -> List[Future[None]]:
+    # Each line is a job, they run as soon as there's a free slot
+    pending: List[Future[None]] = []
+
+    for line in file:
+        if not line.strip():
+            continue
+
+        try:
+            job = json.loads(line)
+        except ValueError:
+            channel.send({"id": None, "ok": False, "error": "Invalid json"})
+            continue
+
+        if not isinstance(job, dict):
+            channel.send({"id": None, "ok": False, "error": "A job must be an object"})
+            continue
+
+        pending.append(executor.submit(run_job, job, run, channel))
+
+    return pending
+
+
+def serve_socket(path: Path, executor: ThreadPoolExecutor, run: Runner) -> None:
+    if path.exists():
+        path.unlink()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(path))
+    server.listen()
+    utils.msg(f"Listening on {path}")
+
+    def client(conn: socket.socket) -> None:
+        with conn, conn.makefile("rb") as reader, conn.makefile("wb") as writer:
+            # Keep the connection open until all its jobs replied
+            for future in read_jobs(reader, Channel(writer), executor, run):
+                future.result()
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=client, args=(conn,), daemon=True).start()
+    finally:
+        server.close()
+        path.unlink(missing_ok=True)
+
+
+def serve(argv: List[str], run: Runner) -> None:
+    parser = argparse.ArgumentParser(description="Run jobs sent as json lines")
+    parser.add_argument("--socket", type=str, help="Path of the unix socket to listen on. Else jobs are read from stdin")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="How many jobs can run at once")
+    args = parser.parse_args(argv)
+
+    if args.jobs < 1:
+        utils.exit("Value for 'jobs' is too low")
+        return
+
+    warm()
+
+    # Stop like with ctrl+c so the socket gets removed
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        try:
+            if args.socket:
+                serve_socket(Path(args.socket).expanduser().resolve(), executor, run)
+            else:
+                # Pending jobs finish before the executor closes
+                read_jobs(sys.stdin.buffer, Channel(sys.stdout.buffer), executor, run)
+        except KeyboardInterrupt:
+            pass
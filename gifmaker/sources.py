@@ -0,0 +1,567 @@
+# Modules
+from . import utils
+from . import framecache
+from .gifreader import GifReader
+from .probe import Index
+
+# Libraries
+import imageio  # type: ignore
+import numpy as np
+import numpy.typing as npt
+from PIL import Image  # type: ignore
+
+# Standard
+import os
+import math
+import bisect
+import time
+import hashlib
+import logging
+import contextvars
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Set, Tuple, Union, Callable, Iterable, Iterator, Any
+from itertools import islice
+
+
+Frame = npt.NDArray[np.uint8]
+
+# A region of a frame as x, y, width, height
+Box = Tuple[int, int, int, int]
+
+# Max threads used to open and decode many inputs at once
+MAX_THREADS = 8
+
+
+class Source:
+    # Base class for the objects that decode frames from an input file
+    # Frames are requested in batches so each source can pick the fastest way to read them
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.index = Index(path)
+        self.crop: Union[Box, None] = None
+        self.scale: Union[Tuple[int, int], None] = None
+
+    def size(self) -> Tuple[int, int]:
+        # The size of the frames before cropping or scaling, 0 if unknown
+        info = self.index.get_info()
+        return int(info.get("width") or 0), int(info.get("height") or 0)
+
+    def set_view(self, crop: Union[Box, None], scale: Union[Tuple[int, int], None]) -> None:
+        # Frames are cropped and then scaled to this size while decoding
+        self.crop = crop
+        self.scale = scale
+
+    def fit(self, frame: Frame) -> Frame:
+        # Sources that can't crop or scale while decoding do it right after
+        if self.crop:
+            x, y, w, h = self.crop
+            frame = frame[y:y + h, x:x + w]
+
+        if self.scale and ((frame.shape[1], frame.shape[0]) != self.scale):
+            frame = np.asarray(Image.fromarray(frame).resize(self.scale))
+
+        return frame
+
+    def count(self) -> int:
+        return 0
+
+    def fps(self) -> float:
+        return 0.0
+
+    def read(self, indices: List[int]) -> Dict[int, Union[Frame, None]]:
+        # Sources receive sorted unique indices
+        # Frames that fail to decode are returned as None
+        return {}
+
+    def time_to_index(self, seconds: float) -> int:
+        fps = self.fps()
+
+        if fps <= 0:
+            return 0
+
+        return int(round(seconds * fps))
+
+    def is_bad(self, index: int) -> bool:
+        return self.index.is_bad(index)
+
+    def add_bad(self, indices: Iterable[int]) -> None:
+        self.index.add_bad(indices)
+
+    def decode_failed(self, index: int) -> None:
+        # Only frames that exist are remembered, not draws past the end
+        if 0 <= index < self.count():
+            self.add_bad([index])
+
+    def decodes(self) -> List[Dict[str, Any]]:
+        # Sizes and time of the still images that were decoded
+        return []
+
+    def close(self) -> None:
+        self.index.save()
+
+
+class StillSource(Source):
+    # A single image, every index returns the same frame
+    # It's decoded when first read so it can be decoded smaller
+    # The frame is read only since it's handed out again for every index
+
+    def __init__(self, path: Path) -> None:
+        super().__init__(path)
+        self.image: Union[Frame, None] = None
+        self.decode: Dict[str, Any] = {}
+
+    def count(self) -> int:
+        return 1
+
+    def load(self) -> Frame:
+        if self.image is None:
+            start = time.perf_counter()
+
+            if self.crop or self.scale:
+                self.image = self.reduced()
+            else:
+                self.image = imageio.imread(self.path)
+                height, width = self.image.shape[:2]
+                self.decode = {"full": (width, height), "decoded": (width, height)}
+
+            self.image.flags.writeable = False
+            self.decode["seconds"] = time.perf_counter() - start
+
+        return self.image
+
+    def reduced(self) -> Frame:
+        # JPEG can decode at 1/2, 1/4 or 1/8 of the size with draft
+        # Then the crop is taken and reduced by a whole factor
+        # The result is resized to the exact size
+        with Image.open(self.path) as image:
+            full_w, full_h = image.size
+            x, y, w, h = self.crop or (0, 0, full_w, full_h)
+            scale_w, scale_h = self.scale or (w, h)
+
+            # Smallest draft that still covers the crop at the target size
+            image.draft("RGB", (math.ceil(scale_w * full_w / w), math.ceil(scale_h * full_h / h)))
+            ratio = image.width / full_w
+            self.decode = {"full": (full_w, full_h), "decoded": image.size}
+
+            mode = "RGBA" if ("A" in image.getbands()) or ("transparency" in image.info) else "RGB"
+            image = image.convert(mode)
+
+        box = (int(x * ratio), int(y * ratio), int(math.ceil((x + w) * ratio)), int(math.ceil((y + h) * ratio)))
+        box = (box[0], box[1], min(box[2], image.width), min(box[3], image.height))
+        factor = min((box[2] - box[0]) // scale_w, (box[3] - box[1]) // scale_h)
+
+        if factor >= 2:
+            image = image.reduce(factor, box)
+        else:
+            image = image.crop(box)
+
+        if image.size != (scale_w, scale_h):
+            image = image.resize((scale_w, scale_h))
+
+        return np.asarray(image)
+
+    def read(self, indices: List[int]) -> Dict[int, Union[Frame, None]]:
+        image = self.load()
+        return {index: image for index in indices}
+
+    def time_to_index(self, seconds: float) -> int:
+        return 0
+
+    def decodes(self) -> List[Dict[str, Any]]:
+        return [self.decode] if self.decode else []
+
+
+class GifSource(Source):
+    # Only the requested frames are composited, see GifReader
+
+    def __init__(self, path: Path) -> None:
+        super().__init__(path)
+        self.reader = GifReader(path)
+
+    def count(self) -> int:
+        return self.reader.count()
+
+    def read(self, indices: List[int]) -> Dict[int, Union[Frame, None]]:
+        frames = self.reader.read(indices)
+
+        for index, frame in frames.items():
+            if frame is None:
+                self.decode_failed(index)
+
+        if self.crop or self.scale:
+            return {index: None if frame is None else self.fit(frame) for index, frame in frames.items()}
+
+        return frames
+
+    def time_to_index(self, seconds: float) -> int:
+        return self.reader.time_to_index(seconds)
+
+    def close(self) -> None:
+        self.reader.close()
+        super().close()
+
+
+class VideoSource(Source):
+    # The ffmpeg reader seeks to the nearest keyframe when jumping far
+    # and decodes forward when the next index is close to the current one
+    # So reading indices in ascending order avoids restarting the stream
+    # The frame count and fps come from the probe index so the reader
+    # is only opened when frames are read
+
+    def __init__(self, path: Path) -> None:
+        super().__init__(path)
+        self.reader: Any = None
+
+    def get_reader(self) -> Any:
+        if self.reader is None:
+            if self.crop or self.scale:
+                # It warns that the size is not the size of the source
+                logging.getLogger("imageio_ffmpeg").setLevel(logging.ERROR)
+                self.reader = imageio.get_reader(self.path, output_params=["-vf", ",".join(self.filters())])
+            else:
+                self.reader = imageio.get_reader(self.path)
+
+        return self.reader
+
+    def filters(self) -> List[str]:
+        # ffmpeg crops and scales the frames before sending them
+        # They are converted to RGB last so only the smaller frames are converted
+        # The crop is exact, in the chroma planes it would be rounded to even pixels
+        ans: List[str] = []
+
+        if self.crop:
+            x, y, w, h = self.crop
+            ans.append(f"crop={w}:{h}:{x}:{y}:exact=1")
+
+        if self.scale:
+            w, h = self.scale
+            ans.append(f"scale={w}:{h}:flags=bicubic")
+
+        ans.append("format=rgb24")
+        return ans
+
+    def count(self) -> int:
+        nframes = self.index.get_info().get("nframes")
+
+        if nframes:
+            return int(nframes)
+
+        # The container doesn't list its packets, count them by decoding
+        return int(self.get_reader().count_frames())
+
+    def fps(self) -> float:
+        fps = self.index.get_info().get("fps")
+
+        if fps:
+            return float(fps)
+
+        return float(self.get_reader().get_meta_data().get("fps", 0))
+
+    def read(self, indices: List[int]) -> Dict[int, Union[Frame, None]]:
+        ans: Dict[int, Union[Frame, None]] = {}
+        reader = self.get_reader()
+
+        for index in indices:
+            try:
+                ans[index] = reader.get_data(index)
+            except (IndexError, OSError):
+                # Past the end of the stream or ffmpeg went away, it can work next time
+                ans[index] = None
+            except Exception:
+                ans[index] = None
+                self.decode_failed(index)
+
+        return ans
+
+    def close(self) -> None:
+        if self.reader is not None:
+            self.reader.close()
+
+        super().close()
+
+
+class MultiSource(Source):
+    # Many inputs joined into one index space, in the order they were given
+    # Each input keeps its own reader and they decode at the same time on threads
+    # ffmpeg decodes in its own process so threads are not held back by the GIL
+    # Timestamps refer to the first input
+
+    def __init__(self, paths: List[Path], cache: Union[framecache.FrameCache, None] = None) -> None:
+        self.path = paths[0]
+        self.crop = None
+        self.scale = None
+        self.pool = ThreadPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1, MAX_THREADS))
+        self.parts: List[Source] = self.map(lambda path: open_source(path, cache), paths)
+
+        # Probing can take a while so the inputs are counted at the same time too
+        counts = self.map(lambda part: part.count(), self.parts)
+        self.starts = [sum(counts[:i]) for i in range(len(counts))]
+        self.total = sum(counts)
+
+    def map(self, func: Callable[[Any], Any], items: Iterable[Any]) -> List[Any]:
+        # The threads see the configuration of the call that uses the source, like whether to save to the cache
+        context = contextvars.copy_context()
+        return list(self.pool.map(lambda item: context.copy().run(func, item), items))
+
+    def size(self) -> Tuple[int, int]:
+        return self.parts[0].size()
+
+    def set_view(self, crop: Union[Box, None], scale: Union[Tuple[int, int], None]) -> None:
+        # The crop is kept inside each input
+        # All the inputs are scaled to the same size, like the resize at the end would do
+        for part in self.parts:
+            size = part.size()
+            part.set_view(clip_box(crop, size) if crop else None, scale)
+
+    def count(self) -> int:
+        return self.total
+
+    def fps(self) -> float:
+        return self.parts[0].fps()
+
+    def time_to_index(self, seconds: float) -> int:
+        return self.parts[0].time_to_index(seconds)
+
+    def locate(self, index: int) -> Tuple[int, int]:
+        # The input and the index inside it
+        part = max(0, bisect.bisect_right(self.starts, index) - 1)
+        return part, index - self.starts[part]
+
+    def read(self, indices: List[int]) -> Dict[int, Union[Frame, None]]:
+        groups: Dict[int, List[int]] = {}
+
+        for index in indices:
+            if (index < 0) or (index >= self.total):
+                continue
+
+            groups.setdefault(self.locate(index)[0], []).append(index)
+
+        def read_part(part: int) -> Dict[int, Union[Frame, None]]:
+            start = self.starts[part]
+            frames = self.parts[part].read([index - start for index in groups[part]])
+            return {index + start: frame for index, frame in frames.items()}
+
+        ans: Dict[int, Union[Frame, None]] = {index: None for index in indices}
+
+        for frames in self.map(read_part, list(groups)):
+            ans.update(frames)
+
+        return ans
+
+    def is_bad(self, index: int) -> bool:
+        if (index < 0) or (index >= self.total):
+            return False
+
+        part, local = self.locate(index)
+        return self.parts[part].is_bad(local)
+
+    def add_bad(self, indices: Iterable[int]) -> None:
+        for index in indices:
+            if 0 <= index < self.total:
+                part, local = self.locate(index)
+                self.parts[part].add_bad([local])
+
+    def decodes(self) -> List[Dict[str, Any]]:
+        return [decode for part in self.parts for decode in part.decodes()]
+
+    def close(self) -> None:
+        for part in self.parts:
+            part.close()
+
+        self.pool.shutdown()
+
+
+class WrappedSource(Source):
+    # A source that reads its frames through another one
+
+    def __init__(self, source: Source) -> None:
+        self.source = source
+        self.path = source.path
+        self.index = source.index
+        self.crop = source.crop
+        self.scale = source.scale
+
+    def size(self) -> Tuple[int, int]:
+        return self.source.size()
+
+    def set_view(self, crop: Union[Box, None], scale: Union[Tuple[int, int], None]) -> None:
+        self.source.set_view(crop, scale)
+        super().set_view(crop, scale)
+
+    def count(self) -> int:
+        return self.source.count()
+
+    def fps(self) -> float:
+        return self.source.fps()
+
+    def time_to_index(self, seconds: float) -> int:
+        return self.source.time_to_index(seconds)
+
+    def read(self, indices: List[int]) -> Dict[int, Union[Frame, None]]:
+        return self.source.read(indices)
+
+    def is_bad(self, index: int) -> bool:
+        return self.source.is_bad(index)
+
+    def add_bad(self, indices: Iterable[int]) -> None:
+        self.source.add_bad(indices)
+
+    def decodes(self) -> List[Dict[str, Any]]:
+        return self.source.decodes()
+
+    def close(self) -> None:
+        self.source.close()
+
+
+class CachedSource(WrappedSource):
+    # Keeps every frame it decodes so reading it again is free
+    # Used to pick frames many times from one decode
+
+    def __init__(self, source: Source) -> None:
+        super().__init__(source)
+        self.frames: Dict[int, Union[Frame, None]] = {}
+
+    def read(self, indices: List[int]) -> Dict[int, Union[Frame, None]]:
+        missing = [index for index in indices if index not in self.frames]
+
+        if missing:
+            self.frames.update(self.source.read(missing))
+
+        return {index: self.frames.get(index) for index in indices}
+
+
+class StoredSource(WrappedSource):
+    # Frames are looked up in the frame cache directory before decoding them
+    # Only the frames that are not there are decoded, and then saved
+    # The key changes with the content of the file and with the decode view
+
+    def __init__(self, source: Source, cache: framecache.FrameCache) -> None:
+        super().__init__(source)
+        self.cache = cache
+
+    def key(self) -> str:
+        view = f"{framecache.VERSION}:{self.index.content_hash()}:{self.crop}:{self.scale}"
+        return hashlib.sha1(view.encode()).hexdigest()
+
+    def read(self, indices: List[int]) -> Dict[int, Union[Frame, None]]:
+        key = self.key()
+        ans: Dict[int, Union[Frame, None]] = {}
+        missing: List[int] = []
+
+        for index in indices:
+            frame = self.cache.get(key, index)
+
+            if frame is None:
+                missing.append(index)
+            else:
+                ans[index] = frame
+
+        if missing:
+            for index, frame in self.source.read(missing).items():
+                ans[index] = frame
+
+                if frame is not None:
+                    self.cache.put(key, index, frame)
+
+        return ans
+
+
+def clip_box(box: Box, size: Tuple[int, int]) -> Box:
+    # Keep a region inside a frame of this size, when the size is known
+    x, y, w, h = box
+
+    if size[0] and size[1]:
+        x = min(x, size[0] - 1)
+        y = min(y, size[1] - 1)
+        w = min(w, size[0] - x)
+        h = min(h, size[1] - y)
+
+    return x, y, w, h
+
+
+def open_sources(paths: List[Path], cache: Union[framecache.FrameCache, None] = None) -> Source:
+    if len(paths) == 1:
+        return open_source(paths[0], cache)
+
+    return MultiSource(paths, cache)
+
+
+def open_source(path: Path, cache: Union[framecache.FrameCache, None] = None) -> Source:
+    ext = utils.get_extension(path)
+    source: Source
+
+    if (ext == "jpg") or (ext == "jpeg") or (ext == "png"):
+        source = StillSource(path)
+    elif ext == "gif":
+        source = GifSource(path)
+    else:
+        source = VideoSource(path)
+
+    # Each input is kept apart in the frame cache
+    if cache:
+        return StoredSource(source, cache)
+
+    return source
+
+
+def resolve_indices(source: Source, items: List[Union[int, str]]) -> List[int]:
+    # Turn timestamps like 00:01:05 into frame indices
+    indices = []
+
+    for item in items:
+        if isinstance(item, str):
+            seconds = utils.parse_timestamp(item)
+            assert isinstance(seconds, float)
+            indices.append(source.time_to_index(seconds))
+        else:
+            indices.append(item)
+
+    return indices
+
+
+def stream(source: Source, draws: Iterable[int], num_frames: int, max_tries: int, batch_size: int = 0) -> Iterator[Frame]:
+    for _, frame in stream_items(source, draws, num_frames, max_tries, batch_size):
+        yield frame
+
+
+def stream_items(source: Source, draws: Iterable[int], num_frames: int, max_tries: int,
+                 batch_size: int = 0) -> Iterator[Tuple[int, Frame]]:
+    # Yield the first num_frames draws that decode successfully, in draw order, with their index
+    # Draws are pulled in batches only as needed so the RNG advances like a one-by-one read
+    # Each batch is decoded in ascending index order
+    # A batch size of 0 reads all the needed frames at once
+    failed: Set[int] = set()
+    it: Iterator[int] = iter(draws)
+    count = 0
+    tries = 0
+
+    while (count < num_frames) and (tries < max_tries):
+        need = min(num_frames - count, max_tries - tries)
+
+        if batch_size > 0:
+            need = min(need, batch_size)
+
+        batch = list(islice(it, need))
+
+        if not batch:
+            break
+
+        tries += len(batch)
+
+        # Frames known to fail still count as tries so the result is the same
+        # The sources remember the frames that failed to decode
+        missing = sorted(set(index for index in batch if (index not in failed) and (not source.is_bad(index))))
+        decoded = source.read(missing) if missing else {}
+
+        for index in batch:
+            frame = decoded.get(index)
+
+            if frame is None:
+                failed.add(index)
+                continue
+
+            count += 1
+            yield index, frame
+
@@ -1,4 +1,5 @@
 # Standard
+import os
 import re
 import sys
 import random
@@ -8,9 +9,6 @@ from pathlib import Path
 from datetime import datetime
 from typing import Dict, Union, Tuple
 
-# Libraries
-import webcolors  # type: ignore
-
 
 def random_string() -> str:
     vowels = "aeiou"
@@ -29,9 +27,21 @@ def get_extension(path: Path) -> str:
     return Path(path).suffix.lower().lstrip(".")
 
 
+class Exit(SystemExit):
+    # Exits with code 1 and keeps the message so callers that catch it don't need stderr
+
+    def __init__(self, message: str) -> None:
+        super().__init__(1)
+        self.message = message
+
+
 def exit(message: str) -> None:
-    msg(f"\nExit: {message}\n")
-    sys.exit(1)
+    from .config import config
+
+    if not config.Internal.quiet:
+        msg(f"\nExit: {message}\n")
+
+    raise Exit(message)
 
 
 def read_toml(path: Path) -> Union[Dict[str, str], None]:
@@ -51,10 +61,11 @@ def read_toml(path: Path) -> Union[Dict[str, str], None]:
 
 def random_color() -> Tuple[int, int, int]:
     from .config import config
-    assert isinstance(config.Internal.random_colors, random.Random)
+    rng = config.Internal.random_colors
+    assert isinstance(rng, random.Random)
 
-    def component():
-        return config.Internal.random_colors.randint(0, 255)
+    def component() -> int:
+        return rng.randint(0, 255)
 
     return component(), component(), component()
 
@@ -85,10 +96,13 @@ def dark_contrast(color: Tuple[int, int, int]) -> Tuple[int, int, int]:
 
 
 def random_digit(allow_zero: bool) -> int:
+    from .config import config
+    assert isinstance(config.Internal.random_digits, random.Random)
+
     if allow_zero:
-        return random.randint(0, 9)
+        return config.Internal.random_digits.randint(0, 9)
     else:
-        return random.randint(1, 9)
+        return config.Internal.random_digits.randint(1, 9)
 
 
 def get_date(fmt: str) -> str:
@@ -103,6 +117,9 @@ def add_alpha(rgb: Tuple[int, int, int], alpha: float) -> Tuple[int, int, int, i
 
 
 def color_name(name: str) -> Union[Tuple[int, int, int], None]:
+    # Only needed when a color is given by name
+    import webcolors  # type: ignore
+
     try:
         return tuple(webcolors.name_to_rgb(name))
     except BaseException:
@@ -116,6 +133,57 @@ def clean_lines(s: str) -> str:
     return cleaned.strip()
 
 
+def parse_timestamp(value: str) -> Union[float, None]:
+    # Formats like 65, 1:05, 00:01:05 and 00:01:05.5
+    parts = value.strip().split(":")
+
+    if (len(parts) > 3) or (not all(parts)):
+        return None
+
+    try:
+        nums = [float(part) for part in parts]
+    except ValueError:
+        return None
+
+    seconds = 0.0
+
+    for num in nums:
+        if num < 0:
+            return None
+
+        seconds = seconds * 60 + num
+
+    return seconds
+
+
+def frame_index(value: str) -> Union[int, str]:
+    # Frame indices are ints, timestamps are kept as strings
+    # and resolved once the fps of the input is known
+    value = value.strip()
+
+    if value.isdigit():
+        return int(value)
+
+    if (":" not in value) or (parse_timestamp(value) is None):
+        raise ValueError(f"Invalid frame: {value}")
+
+    return value
+
+
+def cache_dir(name: str) -> Path:
+    # Files that can be rebuilt at any time, like probes
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    path = Path(base, "gifmaker", name)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def use_cache() -> bool:
+    # Probes and word indices are only saved when this is true
+    from .config import config
+    return not config.nocache
+
+
 def divisible(number: int, by: int) -> int:
     while number % by != 0:
         number += 1
@@ -0,0 +1,204 @@
+# Modules
+from .config import config
+from . import utils
+from . import words
+from . import media
+from . import sources
+from .profiler import profiler
+
+# Standard
+import os
+import sys
+import random
+import multiprocessing
+from pathlib import Path
+from itertools import islice
+from multiprocessing.connection import Connection, wait
+from multiprocessing.process import BaseProcess
+from typing import List, Dict, Set, Tuple, Union, Any, cast
+
+
+# What a variant process sends back
+Reply = Dict[str, Any]
+
+# A variant process and where its reply comes from
+Running = Tuple[BaseProcess, Connection]
+
+# Variants are forked so they get the decoded frames without copying them
+context = multiprocessing.get_context("fork")
+
+# Frames decoded for all the variants, forked processes get them for free
+decoded: Dict[int, sources.Frame] = {}
+
+# Indices of the frames picked for each variant
+picked: List[List[int]] = []
+
+# Where each variant is saved
+outputs: List[Path] = []
+
+
+def set_variant(variant: int) -> None:
+    # Every random generator gets a seed made from the seeds and the variant
+    # The first variant uses the seeds as they are
+    config.set_random(variant)
+    random.seed(f"{config.seed}:{variant}")
+
+
+def variant_outputs(count: int) -> List[Path]:
+    # Numbered like name_001.gif, a directory gets a random name for all of them
+    assert isinstance(config.output, Path)
+    digits = len(str(count))
+
+    if utils.get_extension(config.output):
+        stem, ext = config.output.stem, config.output.suffix
+        parent = config.output.parent
+    else:
+        stem, ext = utils.random_string(), f".{config.format}"
+        parent = config.output
+
+    return [Path(parent, f"{stem}_{i + 1:0{digits}d}{ext}") for i in range(count)]
+
+
+def pick_frames(count: int) -> List[List[int]]:
+    # The draws of all the variants are decoded at once, in index order
+    # Then each variant picks its frames from what was decoded
+    # Only the decoded pixels are kept, each variant makes its images in its own process
+    global decoded
+
+    cache = media.frame_cache()
+    source = sources.CachedSource(media.open_source(cache))
+
+    # The number of frames is known once the source is open
+    assert isinstance(config.frames, int)
+
+    try:
+        indices: Set[int] = set()
+
+        for variant in range(count):
+            set_variant(variant)
+            indices.update(islice(media.frame_draws(source), config.frames))
+
+        source.read(sorted(index for index in indices if not source.is_bad(index)))
+        ans = []
+
+        for variant in range(count):
+            set_variant(variant)
+            ans.append(media.frame_indices(source))
+
+        decoded = {index: frame for index, frame in source.frames.items() if frame is not None}
+        return ans
+    finally:
+        media.close_source(source)
+        media.close_cache(cache)
+
+
+def make_variant(variant: int) -> Union[Path, None]:
+    # Runs in a forked process so every variant starts from the same config
+    set_variant(variant)
+    config.output = outputs[variant]
+    words.process_words()
+
+    if not picked[variant]:
+        return None
+
+    frames = list(media.pillow_frames(decoded[index] for index in picked[variant]))
+    frames = media.apply_filters(frames)
+    frames = media.deep_fry(frames)
+    frames = media.word_frames(frames)
+    frames = media.resize_frames(frames)
+    output = media.render(frames)
+
+    # Variants are always saved to files
+    assert isinstance(output, Path)
+    return output
+
+
+def child(variant: int, conn: Connection) -> None:
+    # Nothing is profiled in the variants
+    profiler.enabled = False
+    reply: Reply = {"variant": variant, "ok": False}
+
+    try:
+        output = make_variant(variant)
+
+        if output is None:
+            reply["error"] = "No frames"
+        else:
+            reply["output"] = str(output)
+            reply["ok"] = True
+    except SystemExit as e:
+        reply["error"] = str(e.code) if isinstance(e.code, str) else "Failed"
+    except Exception as e:
+        reply["error"] = str(e) or type(e).__name__
+
+    conn.send(reply)
+    conn.close()
+
+
+def start_variant(variant: int) -> Running:
+    # Forked from the main thread only, forking from other threads can copy held locks
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=child, args=(variant, sender))
+    process.start()
+    sender.close()
+    return process, receiver
+
+
+def finish_variant(variant: int, running: Running) -> Reply:
+    process, receiver = running
+
+    try:
+        reply: Reply = receiver.recv()
+    except EOFError:
+        reply = {"variant": variant, "ok": False, "error": "The variant process died"}
+
+    receiver.close()
+    process.join()
+    return reply
+
+
+def prepare(count: int) -> None:
+    # Frames are decoded once for all the variants
+    global picked, outputs
+
+    # Seeds are needed so the frames can be picked again in the same way
+    if config.seed is None:
+        config.seed = random.SystemRandom().randrange(1 << 32)
+
+    picked = pick_frames(count)
+    outputs = variant_outputs(count)
+
+
+def run(count: int) -> List[Path]:
+    # Every variant is made in its own process
+    # Paths are printed as soon as each variant is saved
+    workers = config.workers if config.workers > 1 else (os.cpu_count() or 1)
+    pending = iter(range(count))
+    running: Dict[Connection, Tuple[int, Running]] = {}
+    ans: List[Path] = []
+
+    def start_next() -> None:
+        variant = next(pending, None)
+
+        if variant is not None:
+            proc = start_variant(variant)
+            running[proc[1]] = (variant, proc)
+
+    for _ in range(min(count, workers)):
+        start_next()
+
+    while running:
+        for receiver in wait(list(running)):
+            variant, proc = running.pop(cast(Connection, receiver))
+            reply = finish_variant(variant, proc)
+
+            if reply["ok"]:
+                ans.append(Path(reply["output"]))
+                utils.respond(reply["output"])
+                sys.stdout.flush()
+            else:
+                utils.msg(f"Variant {variant + 1}: {reply['error']}")
+
+            start_next()
+
+    return ans
@@ -3,12 +3,40 @@ from .config import config
 from . import utils
 
 # Standard
+import os
 import re
+import sys
+import mmap
+import struct
 import random
-from typing import List, Any
+import hashlib
+import threading
+from io import BytesIO
+from array import array
+from collections import OrderedDict
+from typing import List, Dict, Set, Tuple, Union, Callable, BinaryIO, Any
 from pathlib import Path
 
 
+# Tags that can be used in words
+PATTERN_MULTI = re.compile(r"\[\s*(?:x(?P<number>\d+))?\s*\]$", re.IGNORECASE)
+PATTERN_RANDOM = re.compile(r"\[\s*(?P<word>randomx?)(?:\s+(?P<number>\d+))?\s*\]", re.IGNORECASE)
+PATTERN_NUMBER = re.compile(r"\[\s*(?P<word>number)(?:\s+(?P<number1>-?\d+)(?:\s+(?P<number2>-?\d+))?)?\s*\]", re.IGNORECASE)
+PATTERN_COUNT = re.compile(r"\[(?P<word>count)\]", re.IGNORECASE)
+PATTERN_DATE = re.compile(r"\[\s*(?P<word>date)(?:\s+(?P<format>.*))?\s*\]", re.IGNORECASE)
+
+# Placeholders for parsed tags, from the private use area of unicode
+MARKS = range(0xE000, 0xF900)
+
+# Lines that were parsed, oldest first
+# Shared by every configuration, so it's locked
+templates: "OrderedDict[str, Template]" = OrderedDict()
+templates_lock = threading.Lock()
+
+# Max number of parsed lines kept in memory
+MAX_TEMPLATES = 256
+
+
 def process_words() -> None:
     if config.remake or config.fillgen:
         return
@@ -31,86 +59,177 @@ def check_generators() -> None:
 
 
 def generate(line: str, multiple: bool = True) -> List[str]:
-    def randgen(word: str, num: int) -> List[str]:
-        items: List[str] = []
+    multi = 1
+
+    if multiple:
+        match_multi = re.search(PATTERN_MULTI, line)
 
-        for _ in range(num):
-            allow_zero = True
+        if match_multi:
+            multi = max(1, int(match_multi["number"]))
+            line = re.sub(PATTERN_MULTI, "", line).strip()
 
-            if num > 1:
-                if len(items) == 0:
-                    allow_zero = False
+    template = get_template(line)
+    return [template.render() for _ in range(multi)]
 
-            items.append(get_random(word, allow_zero))
 
-        return items
+def randgen(word: str, num: int) -> List[str]:
+    items: List[str] = []
 
-    def replace_random(match: re.Match[Any]) -> str:
-        num = None
+    for _ in range(num):
+        allow_zero = True
 
-        if match["number"]:
-            num = int(match["number"])
+        if num > 1:
+            if len(items) == 0:
+                allow_zero = False
 
-        if (num is None) or (num < 1):
-            num = 1
+        items.append(get_random(word, allow_zero))
 
-        return " ".join(randgen(match["word"], num))
+    return items
 
-    def replace_number(match: re.Match[Any]) -> str:
-        num1 = None
-        num2 = None
 
-        if match["number1"]:
-            num1 = int(match["number1"])
+def replace_random(match: re.Match[Any]) -> str:
+    num = None
 
-        if match["number2"]:
-            num2 = int(match["number2"])
+    if match["number"]:
+        num = int(match["number"])
 
-        if (num1 is not None) and (num2 is not None):
-            if num1 >= num2:
-                return ""
+    if (num is None) or (num < 1):
+        num = 1
 
-            assert isinstance(config.Internal.random_words, random.Random)
-            return str(config.Internal.random_words.randint(num1, num2))
+    return " ".join(randgen(match["word"], num))
 
-        if (num1 is None) or (num1 < 1):
-            num1 = 1
 
-        return "".join(randgen("number", num1))
+def replace_number(match: re.Match[Any]) -> str:
+    num1 = None
+    num2 = None
 
-    def replace_count(match: re.Match[Any]) -> str:
-        config.Internal.wordcount += 1
-        return str(config.Internal.wordcount)
+    if match["number1"]:
+        num1 = int(match["number1"])
 
-    def replace_date(match: re.Match[Any]) -> str:
-        fmt = match["format"] or "%H:%M:%S"
-        return utils.get_date(fmt)
+    if match["number2"]:
+        num2 = int(match["number2"])
 
-    multi = 1
-    new_lines: List[str] = []
-    pattern_multi = re.compile(r"\[\s*(?:x(?P<number>\d+))?\s*\]$", re.IGNORECASE)
+    if (num1 is not None) and (num2 is not None):
+        if num1 >= num2:
+            return ""
 
-    if multiple:
-        match_multi = re.search(pattern_multi, line)
+        assert isinstance(config.Internal.random_words, random.Random)
+        return str(config.Internal.random_words.randint(num1, num2))
 
-        if match_multi:
-            multi = max(1, int(match_multi["number"]))
-            line = re.sub(pattern_multi, "", line).strip()
+    if (num1 is None) or (num1 < 1):
+        num1 = 1
+
+    return "".join(randgen("number", num1))
+
+
+def replace_count(match: re.Match[Any]) -> str:
+    config.Internal.wordcount += 1
+    return str(config.Internal.wordcount)
+
+
+def replace_date(match: re.Match[Any]) -> str:
+    fmt = match["format"] or "%H:%M:%S"
+    return utils.get_date(fmt)
+
+
+# Tags are replaced in this order, each kind over the whole line
+PASSES: List[Tuple[re.Pattern[str], Callable[[re.Match[Any]], str]]] = [
+    (PATTERN_RANDOM, replace_random),
+    (PATTERN_NUMBER, replace_number),
+    (PATTERN_COUNT, replace_count),
+    (PATTERN_DATE, replace_date),
+]
+
+
+def expand(line: str, passes: List[Tuple[re.Pattern[str], Callable[[re.Match[Any]], str]]]) -> str:
+    # Replace the tags with regex passes
+    for pattern, replace in passes:
+        line = re.sub(pattern, replace, line)
+
+    return line
+
+
+class Template:
+    # A line parsed once into text and tags, each tag is left as a placeholder character
+    # Tags are filled in the same order the passes would replace them, so seeds give the same lines
+    # Lines where a tag could change how a later tag is read are expanded with the passes instead
+
+    def __init__(self, line: str) -> None:
+        self.line = line
+        self.tags: List[Tuple[Callable[[re.Match[Any]], str], re.Match[Any]]] = []
+        self.randoms = 0
+        self.text = line
+        self.randomized = line
+        self.static = not any(ord(c) in MARKS for c in line)
+
+        if self.static:
+            self.parse()
+
+    def parse(self) -> None:
+        def mark(match: re.Match[Any]) -> str:
+            # A tag that contains another tag depends on what that one becomes
+            if any(ord(c) in MARKS for c in match[0]) or (len(self.tags) >= len(MARKS)):
+                self.static = False
+                return str(match[0])
+
+            self.tags.append((replace, match))
+            return chr(MARKS[len(self.tags) - 1])
 
-    pattern_random = re.compile(r"\[\s*(?P<word>randomx?)(?:\s+(?P<number>\d+))?\s*\]", re.IGNORECASE)
-    pattern_number = re.compile(r"\[\s*(?P<word>number)(?:\s+(?P<number1>-?\d+)(?:\s+(?P<number2>-?\d+))?)?\s*\]", re.IGNORECASE)
-    pattern_count = re.compile(r"\[(?P<word>count)\]", re.IGNORECASE)
-    pattern_date = re.compile(r"\[\s*(?P<word>date)(?:\s+(?P<format>.*))?\s*\]", re.IGNORECASE)
+        text = self.line
 
-    for _ in range(multi):
-        new_line = line
-        new_line = re.sub(pattern_random, replace_random, new_line)
-        new_line = re.sub(pattern_number, replace_number, new_line)
-        new_line = re.sub(pattern_count, replace_count, new_line)
-        new_line = re.sub(pattern_date, replace_date, new_line)
-        new_lines.append(new_line)
+        for i, (pattern, replace) in enumerate(PASSES):
+            text = re.sub(pattern, mark, text)
 
-    return new_lines
+            if i == 0:
+                self.randoms = len(self.tags)
+                self.randomized = text
+
+        self.text = text
+
+        # A random word between brackets could complete a tag
+        for i in range(self.randoms):
+            pos = self.randomized.index(chr(MARKS[i]))
+            left = max(self.randomized.rfind("[", 0, pos), self.randomized.rfind("]", 0, pos))
+            right = [n for n in [self.randomized.find("[", pos), self.randomized.find("]", pos)] if n >= 0]
+
+            if (left >= 0) and (self.randomized[left] == "[") and right and (self.randomized[min(right)] == "]"):
+                self.static = False
+
+    def render(self) -> str:
+        if not self.static:
+            return expand(self.line, PASSES)
+
+        values: Dict[int, str] = {}
+
+        for i, (replace, match) in enumerate(self.tags[:self.randoms]):
+            values[MARKS[i]] = replace(match)
+
+        # Random words with brackets can make new tags, so the rest uses the passes
+        if any(("[" in value) or ("]" in value) for value in values.values()):
+            return expand(self.randomized.translate(values), PASSES[1:])
+
+        for i, (replace, match) in enumerate(self.tags[self.randoms:], self.randoms):
+            values[MARKS[i]] = replace(match)
+
+        return self.text.translate(values)
+
+
+def get_template(line: str) -> Template:
+    # Templates are parsed once per line, the least used ones are dropped
+    with templates_lock:
+        if line in templates:
+            templates.move_to_end(line)
+            return templates[line]
+
+    template = Template(line)
+
+    with templates_lock:
+        templates[line] = template
+
+        while len(templates) > MAX_TEMPLATES:
+            templates.popitem(last=False)
+
+    return template
 
 
 def check_repeat() -> None:
@@ -157,25 +276,300 @@ def check_empty() -> None:
     config.words = new_lines
 
 
-def random_word() -> str:
-    if not config.randomlist:
-        assert isinstance(config.randomfile, Path)
-        lines = config.randomfile.read_text().splitlines()
-        config.randomlist = [line.strip() for line in lines]
+# Start of each line, saved as unsigned 64 bit numbers
+OFFSET = struct.Struct("<Q")
+
+# Magic, version, file size, modification time, and number of lines
+INDEX_HEADER = struct.Struct("<4sIQQQ")
+INDEX_MAGIC = b"GMWI"
+INDEX_VERSION = 1
+
+# Offsets written at once while building an index
+INDEX_CHUNK = 1 << 16
+
+# A list of words or a word file
+Words = Union[List[str], "WordFile"]
+
+
+class WordFile:
+    # The lines of a word file, read through a memory map
+    # The start of every line is saved in an index in the cache directory
+    # The index is only built again when the file changes
+    # Without the cache the index is built in memory and nothing is saved
+
+    def __init__(self, path: Path) -> None:
+        self.path = path.resolve()
+        stat = self.path.stat()
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.count = 0
+        self.data: Union[mmap.mmap, None] = None
+        self.index: Union[mmap.mmap, bytes, None] = None
+
+        if self.size == 0:
+            return
+
+        with open(self.path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.index = self.load_index()
+
+        if self.index is None:
+            utils.exit(f"Failed to index {self.path}")
+
+    def index_paths(self) -> List[Path]:
+        # In the cache directory, next to the file only when asked for
+        # so files like the nouns of the package don't get an index beside them
+        paths = []
+
+        if config.localindex:
+            paths.append(self.path.with_name(f".{self.path.name}.idx"))
+
+        if utils.use_cache():
+            key = hashlib.sha1(str(self.path).encode()).hexdigest()
+            paths.append(Path(utils.cache_dir("words"), f"{key}.idx"))
+
+        return paths
 
-    if not config.Internal.randwords:
-        config.Internal.randwords = config.randomlist.copy()
+    def load_index(self) -> Union[mmap.mmap, bytes, None]:
+        for path in self.index_paths():
+            index = self.open_index(path)
 
-    if not config.Internal.randwords:
+            if index is not None:
+                return index
+
+        if not utils.use_cache():
+            return self.memory_index()
+
+        for path in self.index_paths():
+            if self.build_index(path):
+                index = self.open_index(path)
+
+                if index is not None:
+                    return index
+
+        return None
+
+    def open_index(self, path: Path) -> Union[mmap.mmap, None]:
+        try:
+            with open(path, "rb") as file:
+                index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        if not self.check_index(index):
+            index.close()
+            return None
+
+        return index
+
+    def check_index(self, index: Union[mmap.mmap, bytes]) -> bool:
+        try:
+            magic, version, size, mtime, count = INDEX_HEADER.unpack_from(index, 0)
+        except struct.error:
+            return False
+
+        length = INDEX_HEADER.size + (count + 1) * OFFSET.size
+        valid = (magic == INDEX_MAGIC) and (version == INDEX_VERSION)
+
+        if (not valid) or (size != self.size) or (mtime != self.mtime) or (len(index) != length):
+            return False
+
+        self.count = count
+        return True
+
+    def write_index(self, file: BinaryIO) -> None:
+        # Offsets are written in chunks so building doesn't need memory for all of them
+        # The end of the file is saved too so every line has a start and an end
+        assert self.data is not None
+        data = self.data
+        count = 0
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.size, self.mtime, 0))
+        chunk = array("Q")
+        start = 0
+
+        while start < self.size:
+            chunk.append(start)
+            count += 1
+            end = data.find(b"\n", start)
+            start = self.size if end < 0 else end + 1
+
+            if len(chunk) >= INDEX_CHUNK:
+                file.write(chunk_bytes(chunk))
+                chunk = array("Q")
+
+        chunk.append(self.size)
+        file.write(chunk_bytes(chunk))
+        file.seek(0)
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.size, self.mtime, count))
+
+    def build_index(self, path: Path) -> bool:
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+        try:
+            with open(tmp, "wb") as file:
+                self.write_index(file)
+
+            os.replace(tmp, path)
+            return True
+        except OSError:
+            try:
+                tmp.unlink()
+            except OSError:
+                pass
+
+            return False
+
+    def memory_index(self) -> Union[bytes, None]:
+        buffer = BytesIO()
+        self.write_index(buffer)
+        index = buffer.getvalue()
+        return index if self.check_index(index) else None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> str:
+        assert (self.data is not None) and (self.index is not None)
+
+        if (i < 0) or (i >= self.count):
+            raise IndexError(i)
+
+        start = OFFSET.unpack_from(self.index, INDEX_HEADER.size + i * OFFSET.size)[0]
+        end = OFFSET.unpack_from(self.index, INDEX_HEADER.size + (i + 1) * OFFSET.size)[0]
+        return self.data[start:end].decode(errors="replace").strip()
+
+
+def chunk_bytes(chunk: "array[int]") -> bytes:
+    # Indices are little endian on every machine
+    if sys.byteorder != "little":
+        chunk.byteswap()
+
+    return chunk.tobytes()
+
+
+class Sampler:
+    # Draws words without replacement in the same order as picking from a list
+    # and removing the first copy of the picked word, so seeds give the same words
+    # Removed positions are counted in a Fenwick tree, each draw takes O(log n)
+    # Only the nodes that changed are kept, so memory grows with the draws, not with the list
+    # When every word was drawn it starts again
+
+    def __init__(self, words: Words) -> None:
+        self.words = words
+        self.size = len(words)
+        self.top = 1 << max(self.size.bit_length() - 1, 0)
+        self.left = self.size
+        self.removed: Dict[int, int] = {}
+        self.drawn: Set[int] = set()
+        self.copies: Union[Dict[str, List[int]], None] = None
+
+    def find(self, k: int) -> int:
+        # Position of the k-th word that is left
+        # A node of the tree covers i & -i positions, minus the ones removed
+        pos = 0
+        step = self.top
+
+        while step:
+            node = pos + step
+
+            if node <= self.size:
+                count = step - self.removed.get(node, 0)
+
+                if count <= k:
+                    pos = node
+                    k -= count
+
+            step >>= 1
+
+        return pos
+
+    def remove(self, pos: int) -> None:
+        self.drawn.add(pos)
+        node = pos + 1
+
+        while node <= self.size:
+            self.removed[node] = self.removed.get(node, 0) + 1
+            node += node & -node
+
+    def first_copy(self, pos: int, word: str) -> int:
+        # The list removed the first copy of a word that was left, not the picked one
+        if self.copies is None:
+            self.copies = duplicates(self.words)
+
+        for copy in self.copies.get(word, []):
+            if copy not in self.drawn:
+                return copy
+
+        return pos
+
+    def draw(self, rng: random.Random) -> str:
+        if self.left == 0:
+            self.left = self.size
+            self.removed.clear()
+            self.drawn.clear()
+
+        # Same draw as rng.choice on the words that are left
+        pos = self.find(rng.randrange(self.left))
+        word = self.words[pos]
+        self.remove(self.first_copy(pos, word))
+        self.left -= 1
+        return word
+
+
+def duplicates(words: Words) -> Dict[str, List[int]]:
+    # Positions of the words that are in the list more than once
+    # Word files can be too big to look at every line, a repeated line there
+    # is removed where it was picked, which only changes the order of its copies
+    if isinstance(words, WordFile):
+        return {}
+
+    positions: Dict[str, List[int]] = {}
+
+    for i, word in enumerate(words):
+        positions.setdefault(word, []).append(i)
+
+    return {word: found for word, found in positions.items() if len(found) > 1}
+
+
+def word_file(path: Path) -> WordFile:
+    # Word files are only opened once
+    key = str(path.resolve())
+
+    with config.Internal.word_lock:
+        if key not in config.Internal.word_files:
+            config.Internal.word_files[key] = WordFile(path)
+
+        return config.Internal.word_files[key]
+
+
+def word_source() -> Words:
+    if config.randomlist:
+        return config.randomlist
+
+    assert isinstance(config.randomfile, Path)
+    return word_file(config.randomfile)
+
+
+def random_word() -> str:
+    words = word_source()
+
+    if not len(words):
         return ""
 
     assert isinstance(config.Internal.random_words, random.Random)
-    w = config.Internal.random_words.choice(config.Internal.randwords)
+    rng = config.Internal.random_words
+
+    if config.repeatrandom:
+        return words[rng.randrange(len(words))]
+
+    sampler = config.Internal.word_sampler
 
-    if not config.repeatrandom:
-        config.Internal.randwords.remove(w)
+    if (sampler is None) or (sampler.words is not words):
+        sampler = Sampler(words)
+        config.Internal.word_sampler = sampler
 
-    return w
+    return sampler.draw(rng)
 
 
 def get_random(rand: str, allow_zero: bool) -> str:
@@ -0,0 +1,823 @@
+# Libraries
+import imageio_ffmpeg  # type: ignore
+import numpy as np
+import numpy.typing as npt
+from PIL import Image  # type: ignore
+
+# Standard
+import os
+import sys
+import time
+import zlib
+import struct
+import threading
+import subprocess
+from io import BytesIO
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Tuple, Union, BinaryIO, Deque, Any
+
+
+# Palette indices, own palette if any, and packed colors for comparing
+Quantized = Tuple[npt.NDArray[np.uint8], Union[bytes, None], npt.NDArray[np.uint32]]
+
+# Where an output goes, a file path, an open file like a buffer, or stdout when None
+Target = Union[Path, BinaryIO, None]
+
+# Bytes read at once from ffmpeg when the video goes to an open file
+PIPE_CHUNK = 1 << 16
+
+
+def open_target(path: Target) -> BinaryIO:
+    # No path means stdout, open files are used as they are
+    if path is None:
+        sys.stdout.flush()
+        return sys.stdout.buffer
+
+    if not isinstance(path, Path):
+        return path
+
+    return open(path, "wb")
+
+
+# Palette index left free for transparent pixels
+TRANSPARENT = 255
+
+# Frames used to build the global palette
+PALETTE_SAMPLES = 8
+
+# Pixels taken from each sample frame
+SAMPLE_PIXELS = 256 * 256
+
+# Mean error per channel above which a frame gets its own palette
+LOCAL_PALETTE_ERROR = 8.0
+
+# Marks transparent pixels when comparing frames
+CLEAR = 1 << 24
+
+
+def make_palette(frames: List[Image.Image]) -> bytes:
+    # One palette for many frames, built from small copies of them
+    samples = []
+
+    for frame in frames:
+        frame = frame.convert("RGB")
+        scale = min(1.0, (SAMPLE_PIXELS / (frame.width * frame.height)) ** 0.5)
+
+        if scale < 1:
+            frame = frame.resize((max(1, int(frame.width * scale)), max(1, int(frame.height * scale))))
+
+        samples.append(np.asarray(frame).reshape(-1, 3))
+
+    pixels = np.concatenate(samples).reshape(1, -1, 3)
+    quantized = Image.fromarray(pixels, mode="RGB").quantize(colors=TRANSPARENT, dither=Image.Dither.NONE)
+    return full_palette(quantized)
+
+
+def full_palette(image: Image.Image) -> bytes:
+    # Palettes always have 256 colors so the transparent index exists
+    palette = bytes(image.getpalette() or [])[:TRANSPARENT * 3]
+    return palette + bytes(768 - len(palette))
+
+
+def packed_colors(colors: npt.NDArray[np.int32]) -> npt.NDArray[np.uint32]:
+    # Each palette color as one number so frames are compared with a single lookup
+    return ((colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]).astype(np.uint32)
+
+
+def image_data(data: bytes) -> bytes:
+    # The compressed pixels of the only frame in a gif file
+    pos = 13
+
+    if data[10] & 0x80:
+        pos += 3 * (2 ** ((data[10] & 7) + 1))
+
+    while data[pos:pos + 1] == b"!":
+        pos += 2
+
+        while data[pos] != 0:
+            pos += data[pos] + 1
+
+        pos += 1
+
+    flags = data[pos + 9]
+    pos += 10
+
+    if flags & 0x80:
+        pos += 3 * (2 ** ((flags & 7) + 1))
+
+    return data[pos:].rstrip(b";")
+
+
+class GifWriter:
+    # Writes a gif one frame at a time so frames don't have to be kept in memory
+    # Frames share one palette made from the first frames, or from samples given with sample()
+    # Frames that don't fit that palette well get their own
+    # Only the box that changed since the previous frame is written
+    # and the pixels that didn't change inside it are transparent
+    # Frames that don't change at all make the previous frame last longer
+    # Once a frame has transparency, every frame after it is written whole and cleared
+    # Quantizing and compressing run on a pool of threads
+    # With measure, frames are also compressed whole to know how many bytes were saved
+
+    def __init__(self, path: Target, delay: int, loop: Union[int, None],
+                 threads: int = 1, palette_path: Union[Path, None] = None,
+                 palette: Union[bytes, None] = None, measure: bool = False) -> None:
+        self.path = path
+        self.file = open_target(path)
+        self.delay = delay
+        self.loop = loop
+        self.threads = max(1, threads)
+        self.window = self.threads * 2
+        self.palette_path = palette_path
+        self.size = (0, 0)
+        self.frames = 0
+        self.encode_seconds = 0.0
+        self.io_seconds = 0.0
+        self.palette: Union[bytes, None] = None
+        self.palette_image: Union[Image.Image, None] = None
+        self.colors: Union[npt.NDArray[np.int32], None] = None
+        self.packed: Union[npt.NDArray[np.uint32], None] = None
+        self.alpha = False
+        self.display: Union[npt.NDArray[np.uint32], None] = None
+        self.buffer: List[Image.Image] = []
+        self.quantized: Deque[Tuple[bool, Future[Quantized]]] = deque()
+        self.entries: Deque[Dict[str, Any]] = deque()
+        self.pool: Union[ThreadPoolExecutor, None] = None
+        self.pixels_written = 0
+        self.merged = 0
+        self.local_palettes = 0
+        self.reused_palette = False
+        self.measure = measure
+        self.last: Union[Tuple[npt.NDArray[np.uint8], Union[bytes, None]], None] = None
+        self.whole: Deque[Future[bytes]] = deque()
+        self.bytes_written = 0
+        self.whole_bytes = 0
+
+        if palette:
+            # Like the palette of the gif that is being remade
+            self.palette = (palette + bytes(768))[:768]
+            self.reused_palette = True
+        elif palette_path and palette_path.exists():
+            data = palette_path.read_bytes()
+
+            if len(data) == 768:
+                self.palette = data
+                self.reused_palette = True
+
+    def write(self, data: bytes) -> None:
+        start = time.perf_counter()
+        self.file.write(data)
+        self.io_seconds += time.perf_counter() - start
+
+    def write_header(self) -> None:
+        width, height = self.size
+        assert self.palette is not None
+
+        # Global color table with 256 colors
+        self.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0xF7, 0, 0) + self.palette)
+
+        if self.loop is not None:
+            self.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", self.loop) + b"\x00")
+
+    def sample(self, frames: List[Image.Image]) -> None:
+        # Build the palette from frames spread over the whole animation
+        if (self.palette is not None) or (not frames):
+            return
+
+        step = max(1, len(frames) // PALETTE_SAMPLES)
+        self.palette = make_palette(frames[::step][:PALETTE_SAMPLES])
+        self.save_palette()
+
+    def save_palette(self) -> None:
+        if (not self.palette_path) or self.reused_palette or (self.palette is None):
+            return
+
+        # Other processes never see half a palette
+        try:
+            tmp = self.palette_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_bytes(self.palette)
+            os.replace(tmp, self.palette_path)
+        except OSError:
+            pass
+
+    def start(self) -> None:
+        # The palette is known, frames can be encoded from now on
+        if self.palette is None:
+            self.palette = make_palette(self.buffer)
+            self.save_palette()
+
+        # The last color is a copy of the first so no pixel takes the transparent index
+        palette = self.palette[:TRANSPARENT * 3] + self.palette[:3]
+        self.palette_image = Image.new("P", (1, 1))
+        self.palette_image.putpalette(palette)
+        self.colors = np.frombuffer(palette, dtype=np.uint8).reshape(256, 3).astype(np.int32)
+        self.packed = packed_colors(self.colors)
+        self.alpha = any(has_alpha(frame) for frame in self.buffer)
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.write_header()
+        buffer = self.buffer
+        self.buffer = []
+
+        for frame in buffer:
+            self.push(frame)
+
+    def append(self, frame: Image.Image) -> None:
+        begin = time.perf_counter()
+        io = self.io_seconds
+
+        if (self.frames == 0) and (not self.buffer):
+            self.size = frame.size
+        elif frame.size != self.size:
+            frame = frame.resize(self.size)
+
+        if self.pool is None:
+            self.buffer.append(frame)
+
+            if (self.palette is not None) or (len(self.buffer) >= PALETTE_SAMPLES):
+                self.start()
+        else:
+            self.push(frame)
+
+        self.encode_seconds += (time.perf_counter() - begin) - (self.io_seconds - io)
+
+    def push(self, frame: Image.Image) -> None:
+        assert self.pool is not None
+
+        if (not self.alpha) and (frame.mode != "RGB"):
+            if has_alpha(frame):
+                self.alpha = True
+            else:
+                frame = frame.convert("RGB")
+
+        # Each frame keeps the transparency state from when it was pushed
+        # so frames that are still queued are encoded the same with any number of threads
+        self.quantized.append((self.alpha, self.pool.submit(self.quantize, frame, self.alpha)))
+        self.frames += 1
+
+        while len(self.quantized) > self.window:
+            self.next_delta()
+
+    def quantize(self, frame: Image.Image, alpha: bool) -> "Quantized":
+        # Runs on the pool
+        assert (self.palette_image is not None) and (self.colors is not None) and (self.packed is not None)
+        rgb = frame if frame.mode == "RGB" else frame.convert("RGB")
+        indices = np.array(rgb.quantize(palette=self.palette_image, dither=Image.Dither.NONE))
+        indices[indices == TRANSPARENT] = 0
+        local = None
+        table = self.packed
+
+        # Check a part of the pixels to see if the palette fits
+        # Only that part is looked up as colors, the rest stays as indices
+        sample = indices[::4, ::4]
+        error = np.abs(self.colors[sample] - np.asarray(rgb)[::4, ::4]).mean() if indices.size else 0
+
+        if error > LOCAL_PALETTE_ERROR:
+            own = rgb.quantize(colors=TRANSPARENT, dither=Image.Dither.NONE)
+            local = full_palette(own)
+            indices = np.array(own)
+            table = packed_colors(np.frombuffer(local, dtype=np.uint8).reshape(256, 3).astype(np.int32))
+
+        packed = table[indices]
+
+        if alpha and (frame.mode == "RGBA"):
+            clear = np.asarray(frame)[..., 3] < 128
+            indices[clear] = TRANSPARENT
+            packed[clear] = CLEAR
+
+        return indices, local, packed
+
+    def next_delta(self) -> None:
+        # Runs in order, compares a frame with what is on screen
+        assert self.pool is not None
+        alpha, future = self.quantized.popleft()
+        indices, local, packed = future.result()
+        height, width = indices.shape
+        box = (0, 0, width, height)
+        crop = indices
+
+        if self.measure:
+            self.whole.append(self.pool.submit(self.encode, indices, local))
+
+            while self.whole and self.whole[0].done():
+                self.whole_bytes += len(self.whole.popleft().result())
+
+        if alpha and self.entries and (self.entries[-1]["disposal"] == 1):
+            self.clear_last()
+
+        if (self.display is not None) and (not alpha):
+            changed = packed != self.display
+
+            if not changed.any():
+                # Show the previous frame for longer instead
+                self.entries[-1]["delay"] += self.delay
+                self.merged += 1
+                return
+
+            rows = np.flatnonzero(changed.any(axis=1))
+            cols = np.flatnonzero(changed.any(axis=0))
+            top, bottom = int(rows[0]), int(rows[-1]) + 1
+            left, right = int(cols[0]), int(cols[-1]) + 1
+            box = (left, top, right - left, bottom - top)
+            crop = indices[top:bottom, left:right].copy()
+            crop[~changed[top:bottom, left:right]] = TRANSPARENT
+
+        self.display = packed
+        self.last = (indices, local)
+        self.pixels_written += box[2] * box[3]
+
+        # Frames with transparency clear their area before the next one
+        self.entries.append({
+            "box": box,
+            "local": local,
+            "delay": self.delay,
+            "disposal": 2 if alpha else 1,
+            "data": self.pool.submit(self.encode, crop, local),
+        })
+
+        if local:
+            self.local_palettes += 1
+
+        # The last frame is kept so it can still last longer
+        while len(self.entries) > self.window:
+            self.write_entry(self.entries.popleft())
+
+    def clear_last(self) -> None:
+        # The first frame with transparency came after frames that were drawn over each other
+        # The last of those is written whole and cleared so nothing shows through the new frame
+        assert (self.pool is not None) and (self.last is not None)
+        entry = self.entries[-1]
+        indices, local = self.last
+        height, width = indices.shape
+        self.pixels_written += width * height - entry["box"][2] * entry["box"][3]
+        entry["box"] = (0, 0, width, height)
+        entry["disposal"] = 2
+        entry["data"] = self.pool.submit(self.encode, indices, local)
+
+    def encode(self, indices: npt.NDArray[np.uint8], local: Union[bytes, None]) -> bytes:
+        # Runs on the pool, Pillow compresses the pixels
+        assert self.palette is not None
+        image = Image.fromarray(np.ascontiguousarray(indices), mode="P")
+        image.putpalette(local or self.palette)
+        stream = BytesIO()
+        image.save(stream, format="GIF", optimize=False, interlace=False)
+        return image_data(stream.getvalue())
+
+    def write_entry(self, entry: Dict[str, Any]) -> None:
+        left, top, width, height = entry["box"]
+        delay = min(65535, int(entry["delay"] / 10))
+        control = b"!\xf9\x04" + struct.pack("<BHB", (entry["disposal"] << 2) | 1, delay, TRANSPARENT) + b"\x00"
+        flags = 0
+        local = b""
+
+        if entry["local"]:
+            flags = 0x87
+            local = entry["local"]
+
+        desc = b"," + struct.pack("<HHHHB", left, top, width, height, flags)
+        data = entry["data"].result()
+        self.bytes_written += len(data)
+        self.write(control + desc + local + data)
+
+    def close(self) -> None:
+        begin = time.perf_counter()
+        io = self.io_seconds
+
+        if self.pool is None:
+            if self.buffer:
+                self.start()
+            else:
+                # Nothing was added, write an empty gif
+                self.size = (1, 1)
+                self.palette = bytes(768)
+                self.write_header()
+
+        while self.quantized:
+            self.next_delta()
+
+        while self.entries:
+            self.write_entry(self.entries.popleft())
+
+        while self.whole:
+            self.whole_bytes += len(self.whole.popleft().result())
+
+        self.write(b";")
+        self.file.flush()
+
+        if self.pool is not None:
+            self.pool.shutdown()
+
+        if isinstance(self.path, Path):
+            self.file.close()
+
+        self.encode_seconds += (time.perf_counter() - begin) - (self.io_seconds - io)
+
+    def pixel_ratio(self) -> float:
+        # Part of the full frames that was written
+        total = self.frames * self.size[0] * self.size[1]
+        return self.pixels_written / total if total else 1.0
+
+    def byte_ratio(self) -> Union[float, None]:
+        # Compressed frame data next to the same frames compressed whole, only with measure
+        if (not self.measure) or (not self.whole_bytes):
+            return None
+
+        return self.bytes_written / self.whole_bytes
+
+
+def has_alpha(frame: Image.Image) -> bool:
+    if frame.mode != "RGBA":
+        return False
+
+    return bool((np.asarray(frame)[..., 3] < 128).any())
+
+
+# Codecs of each video format, the first one is the default
+VIDEO_CODECS = {
+    "mp4": ["libx264", "libx265"],
+    "webm": ["libvpx", "libvpx-vp9"],
+}
+
+# Pixel formats that can be used, the ones with "a" keep the alpha
+PIXEL_FORMATS = ["yuv420p", "yuv422p", "yuv444p", "yuva420p"]
+
+# The x264 presets mapped to the deadline and cpu-used of vpx
+VPX_PRESETS = {
+    "ultrafast": ("realtime", 8),
+    "superfast": ("realtime", 6),
+    "veryfast": ("good", 5),
+    "faster": ("good", 4),
+    "fast": ("good", 3),
+    "medium": ("good", 2),
+    "slow": ("good", 1),
+    "slower": ("good", 0),
+    "veryslow": ("best", 0),
+}
+
+
+class VideoWriter:
+    # Pipes raw frames into an ffmpeg process as they are produced
+    # The output can be a file or stdout
+    # For an open file like a buffer, a thread copies what ffmpeg writes into it
+
+    def __init__(self, path: Target, fmt: str, fps: float, codec: Union[str, None] = None,
+                 preset: Union[str, None] = None, crf: Union[int, None] = None,
+                 threads: Union[int, None] = None, pixel_format: str = "yuv420p") -> None:
+        self.path = path
+        self.fmt = fmt
+        self.fps = fps
+        self.codec = codec or VIDEO_CODECS[fmt][0]
+        self.preset = preset
+        self.crf = crf
+        self.threads = threads
+        self.pixel_format = pixel_format
+
+        # Formats with alpha get rgba frames
+        self.mode = "RGBA" if pixel_format.startswith("yuva") else "RGB"
+        self.size = (0, 0)
+        self.process: Union[subprocess.Popen[bytes], None] = None
+        self.reader: Union[threading.Thread, None] = None
+        self.frames = 0
+
+        # ffmpeg encodes and writes the file itself
+        # Time spent sending frames and waiting for it counts as encoding
+        self.encode_seconds = 0.0
+        self.io_seconds: Union[float, None] = None
+
+    def codec_args(self) -> List[str]:
+        args = ["-vcodec", self.codec]
+
+        # Without these the defaults of ffmpeg are used
+        if self.codec in ["libx264", "libx265"]:
+            if self.crf is not None:
+                args += ["-crf", str(self.crf)]
+
+            if self.preset:
+                args += ["-preset", self.preset]
+        else:
+            if self.crf is not None:
+                # Constant quality, the bitrate is not limited
+                args += ["-crf", str(self.crf), "-b:v", "0"]
+
+            if self.preset:
+                deadline, cpu_used = VPX_PRESETS[self.preset]
+                args += ["-deadline", deadline, "-cpu-used", str(cpu_used)]
+
+            if self.codec == "libvpx-vp9":
+                # Encode rows of tiles in parallel
+                args += ["-row-mt", "1"]
+
+        if self.threads:
+            args += ["-threads", str(self.threads)]
+
+        return args
+
+    def start(self) -> None:
+        width, height = self.size
+        pix_fmt = "rgba" if self.mode == "RGBA" else "rgb24"
+
+        cmd = [imageio_ffmpeg.get_ffmpeg_exe(), "-y",
+               "-f", "rawvideo", "-vcodec", "rawvideo",
+               "-s", f"{width}x{height}", "-pix_fmt", pix_fmt,
+               "-r", f"{self.fps:.02f}", "-i", "-", "-an"]
+
+        cmd += self.codec_args()
+        cmd += ["-pix_fmt", self.pixel_format]
+
+        # Most codecs need sizes divisible by 16
+        if (width % 16) or (height % 16):
+            out_w = width + (-width % 16)
+            out_h = height + (-height % 16)
+            cmd += ["-vf", f"scale={out_w}:{out_h}"]
+
+        if isinstance(self.path, Path):
+            cmd += ["-v", "warning", str(self.path)]
+            stdout: Union[BinaryIO, int, None] = None
+        else:
+            if self.fmt == "mp4":
+                # The mp4 index can't be written at the start of a pipe
+                cmd += ["-movflags", "frag_keyframe+empty_moov"]
+
+            cmd += ["-f", self.fmt, "-v", "warning", "pipe:1"]
+
+            if self.path is None:
+                sys.stdout.flush()
+                stdout = sys.stdout.buffer
+            else:
+                stdout = subprocess.PIPE
+
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=stdout)
+
+        if stdout == subprocess.PIPE:
+            self.reader = threading.Thread(target=self.copy_output, daemon=True)
+            self.reader.start()
+
+    def copy_output(self) -> None:
+        # ffmpeg blocks when its pipe is full so it's read while frames are sent
+        assert (self.process is not None) and (self.process.stdout is not None)
+        assert (self.path is not None) and (not isinstance(self.path, Path))
+        pipe, file = self.process.stdout, self.path
+
+        for chunk in iter(lambda: pipe.read(PIPE_CHUNK), b""):
+            file.write(chunk)
+
+        pipe.close()
+
+    def append(self, frame: Image.Image) -> None:
+        if self.process is None:
+            self.size = frame.size
+            self.start()
+        elif frame.size != self.size:
+            frame = frame.resize(self.size)
+
+        if frame.mode != self.mode:
+            frame = frame.convert(self.mode)
+
+        assert self.process is not None
+        assert self.process.stdin is not None
+        data = frame.tobytes()
+        start = time.perf_counter()
+        self.process.stdin.write(data)
+        self.encode_seconds += time.perf_counter() - start
+        self.frames += 1
+
+    def close(self) -> None:
+        if self.process is None:
+            return
+
+        assert self.process.stdin is not None
+        start = time.perf_counter()
+        self.process.stdin.close()
+        code = self.process.wait()
+
+        if self.reader is not None:
+            self.reader.join()
+
+        self.encode_seconds += time.perf_counter() - start
+
+        if code != 0:
+            raise IOError("ffmpeg failed to write the video")
+
+
+# PNG files start with this
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Bytes of rows filtered at once, this bounds the temporary arrays
+FILTER_BYTES = 1 << 22
+
+
+def png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+
+def png_filter(rows: npt.NDArray[np.uint8], above: npt.NDArray[np.uint8], bpp: int) -> npt.NDArray[np.uint8]:
+    # Rows are flat bytes, above is the row before the first one
+    # Each row gets the filter with the smallest sum of absolute values, like libpng does
+    x = rows.astype(np.int16)
+    b = np.concatenate([above[None].astype(np.int16), x[:-1]])
+    a = np.zeros_like(x)
+    a[:, bpp:] = x[:, :-bpp]
+    c = np.zeros_like(b)
+    c[:, bpp:] = b[:, :-bpp]
+
+    p = a + b - c
+    pa, pb, pc = np.abs(p - a), np.abs(p - b), np.abs(p - c)
+    paeth = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+
+    # Average is left out, like Pillow does
+    options = np.stack([x, x - a, x - b, x - paeth]).astype(np.uint8)
+    scores = np.abs(options.view(np.int8).astype(np.int32)).sum(axis=2)
+    best = scores.argmin(axis=0)
+    kinds = np.array([0, 1, 2, 4], dtype=np.uint8)[best]
+
+    ans = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    ans[:, 0] = kinds
+    ans[:, 1:] = options[best, np.arange(rows.shape[0])]
+    return ans
+
+
+class StripWriter:
+    # Frames joined into one image, without ever having the whole image in memory
+    # A band is a row of frames, placed left to right, and bands go top to bottom
+    # With a cell size every frame gets the same space, like a grid
+    # PNG rows are filtered and compressed as soon as a band is complete
+    # A few rows are copied from the frames at a time, so a wide band is never whole in memory
+    # When the height is not known the header is fixed at the end, so that needs a file
+    # Pillow can't write JPEG in parts, so it's joined into one image first
+
+    def __init__(self, path: Target, fmt: str, mode: str, columns: int, width: int,
+                 height: Union[int, None] = None, cell: Union[Tuple[int, int], None] = None) -> None:
+        self.path = path
+        self.fmt = fmt
+        self.mode = mode if fmt == "png" else "RGB"
+        self.channels = len(self.mode)
+        self.columns = columns
+        self.width = width
+        self.height = height
+        self.cell = cell
+        self.band: List[Image.Image] = []
+        self.rows = 0
+        self.frames = 0
+        self.file: Union[BinaryIO, None] = None
+        self.canvas: Union[Image.Image, None] = None
+        self.above = np.zeros(width * self.channels, dtype=np.uint8)
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 15, 9, zlib.Z_FILTERED)
+        self.encode_seconds = 0.0
+        self.io_seconds = 0.0
+
+    def append(self, frame: Image.Image) -> None:
+        if frame.mode != self.mode:
+            frame = frame.convert(self.mode)
+
+        self.band.append(frame)
+        self.frames += 1
+
+        if len(self.band) >= self.columns:
+            self.write_band()
+
+    def band_height(self) -> int:
+        if self.cell:
+            height = self.cell[1]
+        else:
+            height = max(frame.size[1] for frame in self.band)
+
+        if self.height is not None:
+            height = min(height, self.height - self.rows)
+
+        return height
+
+    def band_rows(self, top: int, bottom: int) -> npt.NDArray[np.uint8]:
+        # Only these rows of the band are copied from the frames
+        rows = np.zeros((bottom - top, self.width, self.channels), dtype=np.uint8)
+        left = 0
+
+        for i, frame in enumerate(self.band):
+            if self.cell:
+                left = i * self.cell[0]
+
+            w = min(frame.size[0], self.width - left)
+            h = min(frame.size[1], bottom) - top
+
+            if (w > 0) and (h > 0):
+                rows[:h, left:left + w] = np.asarray(frame.crop((0, top, w, top + h)))
+
+            left += frame.size[0]
+
+        return rows
+
+    def write_band(self) -> None:
+        if not self.band:
+            return
+
+        height = self.band_height()
+
+        # JPEG is joined into one image anyway
+        if self.fmt == "jpg":
+            step = max(1, height)
+        else:
+            step = max(1, FILTER_BYTES // (self.width * self.channels))
+
+        for top in range(0, height, step):
+            self.write_rows(self.band_rows(top, min(height, top + step)))
+
+        self.band = []
+
+    def write_rows(self, band: npt.NDArray[np.uint8]) -> None:
+        if not len(band):
+            return
+
+        start = time.perf_counter()
+
+        if self.fmt == "jpg":
+            if self.canvas is None:
+                assert self.height is not None
+                self.canvas = Image.new(self.mode, (self.width, self.height))
+
+            self.canvas.paste(Image.fromarray(band, mode=self.mode), (0, self.rows))
+            self.rows += len(band)
+            self.encode_seconds += time.perf_counter() - start
+            return
+
+        if self.file is None:
+            self.start()
+
+        flat = band.reshape(len(band), -1)
+        step = max(1, FILTER_BYTES // flat.shape[1])
+        data = []
+
+        for i in range(0, len(flat), step):
+            rows = flat[i:i + step]
+            data.append(self.compressor.compress(png_filter(rows, self.above, self.channels).tobytes()))
+            self.above = rows[-1]
+
+        self.rows += len(band)
+        self.encode_seconds += time.perf_counter() - start
+        self.write_data(b"".join(data))
+
+    def header(self) -> bytes:
+        color = 6 if self.mode == "RGBA" else 2
+        return png_chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height or 0, 8, color, 0, 0, 0))
+
+    def start(self) -> None:
+        start = time.perf_counter()
+        self.file = open_target(self.path)
+        self.file.write(PNG_SIGNATURE + self.header())
+        self.io_seconds += time.perf_counter() - start
+
+    def write_data(self, data: bytes) -> None:
+        if not data:
+            return
+
+        assert self.file is not None
+        start = time.perf_counter()
+        self.file.write(png_chunk(b"IDAT", data))
+        self.io_seconds += time.perf_counter() - start
+
+    def close(self) -> None:
+        self.write_band()
+
+        # Cells that got no frame are left empty
+        if (self.height is not None) and (self.rows < self.height) and self.frames:
+            self.write_rows(np.zeros((self.height - self.rows, self.width, self.channels), dtype=np.uint8))
+
+        if self.canvas is not None:
+            start = time.perf_counter()
+            buffer = BytesIO()
+            self.canvas.save(buffer, format="JPEG")
+            self.canvas = None
+            self.encode_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            file = open_target(self.path)
+            file.write(buffer.getvalue())
+
+            if isinstance(self.path, Path):
+                file.close()
+
+            self.io_seconds += time.perf_counter() - start
+            return
+
+        if self.file is None:
+            return
+
+        start = time.perf_counter()
+        data = self.compressor.flush()
+        self.encode_seconds += time.perf_counter() - start
+        self.write_data(data)
+        start = time.perf_counter()
+        self.file.write(png_chunk(b"IEND", b""))
+
+        if self.height is None:
+            # The height is known now
+            self.height = self.rows
+            self.file.seek(len(PNG_SIGNATURE))
+            self.file.write(self.header())
+            self.file.seek(0, os.SEEK_END)
+
+        if isinstance(self.path, Path):
+            self.file.close()
+        else:
+            self.file.flush()
+
+        self.file = None
+        self.io_seconds += time.perf_counter() - start
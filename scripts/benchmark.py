@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+# This measures the time of each stage of the program on a synthetic corpus
+# The corpus is generated once with imageio-ffmpeg and kept in the cache directory
+# Results can be saved as json and compared with a previous run
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from typing import List, Dict, Any, Callable, Union
+
+here = Path(__file__).resolve()
+parent = here.parent.parent
+sys.path.insert(0, str(parent))
+
+import numpy as np  # noqa: E402
+import imageio_ffmpeg  # type: ignore # noqa: E402
+from PIL import Image  # type: ignore # noqa: E402
+
+from gifmaker.config import config  # noqa: E402
+from gifmaker import utils  # noqa: E402
+from gifmaker import words  # noqa: E402
+from gifmaker import media  # noqa: E402
+from gifmaker.profiler import reset_peak, peak_rss  # noqa: E402
+
+# Name, kind, width, height, and number of frames
+# Quick runs only use the entries marked as quick
+corpus: List[Dict[str, Any]] = [
+    {"name": "480p_short.mp4", "kind": "video", "size": (854, 480), "frames": 72, "quick": True},
+    {"name": "480p_long.mp4", "kind": "video", "size": (854, 480), "frames": 1440, "quick": False},
+    {"name": "1080p_short.mp4", "kind": "video", "size": (1920, 1080), "frames": 72, "quick": True},
+    {"name": "1080p_long.mp4", "kind": "video", "size": (1920, 1080), "frames": 720, "quick": False},
+    {"name": "4k_short.mp4", "kind": "video", "size": (3840, 2160), "frames": 48, "quick": False},
+    {"name": "large.gif", "kind": "gif", "size": (800, 600), "frames": 300, "quick": True},
+    {"name": "still.png", "kind": "still", "size": (6000, 4000), "frames": 1, "quick": False},
+    {"name": "still.jpg", "kind": "still", "size": (6000, 4000), "frames": 1, "quick": True},
+]
+
+filters = ["hue1", "hue5", "gray", "blur", "invert"]
+formats = ["gif", "webm", "mp4", "png", "jpg"]
+fps = 24
+
+
+def synthetic_frame(width: int, height: int, index: int) -> np.ndarray:
+    # Moving gradients and a square, with some noise so codecs have work to do
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[..., 0] = (x + index * 4) % 256
+    frame[..., 1] = (y + index * 2) % 256
+    frame[..., 2] = ((x + y) / 2 + index * 3) % 256
+    side = max(8, min(width, height) // 5)
+    left = (index * 13) % max(1, width - side)
+    top = (index * 7) % max(1, height - side)
+    frame[top:top + side, left:left + side] = (255, 255, 255)
+    rng = np.random.default_rng(index)
+    noise = rng.integers(0, 24, size=(height, width, 1), dtype=np.uint8)
+    return np.clip(frame.astype(np.int16) + noise - 12, 0, 255).astype(np.uint8)
+
+
+def make_input(path: Path, item: Dict[str, Any]) -> None:
+    width, height = item["size"]
+    tmp = path.with_name(f"tmp_{path.name}")
+
+    if item["kind"] == "video":
+        writer = imageio_ffmpeg.write_frames(str(tmp), (width, height), fps=fps, codec="libx264",
+                                             output_params=["-f", "mp4"], macro_block_size=8)
+        writer.send(None)
+
+        for i in range(item["frames"]):
+            writer.send(synthetic_frame(width, height, i).tobytes())
+
+        writer.close()
+    elif item["kind"] == "gif":
+        frames = [Image.fromarray(synthetic_frame(width, height, i)).quantize(colors=256)
+                  for i in range(item["frames"])]
+
+        frames[0].save(tmp, format="GIF", save_all=True, append_images=frames[1:], duration=40, loop=0)
+    else:
+        fmt = "PNG" if path.suffix == ".png" else "JPEG"
+        Image.fromarray(synthetic_frame(width, height, 0)).save(tmp, format=fmt)
+
+    os.replace(tmp, path)
+
+
+def make_corpus(directory: Path, items: List[Dict[str, Any]]) -> None:
+    for item in items:
+        path = Path(directory, item["name"])
+
+        if not path.exists():
+            print(f"Generating {path}", file=sys.stderr)
+            make_input(path, item)
+
+
+def measure(results: List[Dict[str, Any]], name: str, stage: str, num: int, func: Callable[[], Any]) -> Any:
+    reset_peak()
+    start = time.perf_counter()
+    ans = func()
+    seconds = time.perf_counter() - start
+
+    results.append({
+        "input": name,
+        "stage": stage,
+        "frames": num,
+        "seconds": round(seconds, 4),
+        "fps": round(num / seconds, 2) if seconds > 0 else None,
+        "peak_rss_mb": round(peak_rss(), 1),
+    })
+
+    print(f"{name:<16} {stage:<16} {seconds:>8.3f}s {num:>5} frames", file=sys.stderr)
+    return ans
+
+
+def configure(path: Path, output: Path, num_frames: int, width: int) -> None:
+    config.reset()
+
+    config.parse_args(["--input", str(path), "--output", str(output), "--frames", str(num_frames),
+                       "--words", "Benchmark [number 1 999]", "--fillwords", "--bgcolor", "0,0,0",
+                       "--width", str(width), "--seed", "1"])
+
+    words.process_words()
+
+
+def copies(frames: List[Image.Image]) -> List[Image.Image]:
+    return [frame.copy() for frame in frames]
+
+
+def loaded(frames: List[Image.Image]) -> List[Image.Image]:
+    # Deep fry returns frames that are decoded when first used, so they are decoded here
+    for frame in frames:
+        frame.load()
+
+    return frames
+
+
+def run_input(results: List[Dict[str, Any]], path: Path, num_frames: int, width: int) -> None:
+    name = path.name
+    output = Path(tempfile.mkdtemp(prefix="gifmaker_bench_"))
+
+    try:
+        configure(path, output, num_frames, width)
+        frames = measure(results, name, "get_frames", num_frames, media.get_frames)
+        num = len(frames)
+
+        # Stages change frames in place so each one gets copies, made outside the timing
+        for filtr in filters:
+            config.filter = filtr
+            batch = copies(frames)
+            measure(results, name, f"filter_{filtr}", num, lambda: media.apply_filters(batch))
+
+        config.filter = "none"
+        config.deepfry = True
+        batch = copies(frames)
+        measure(results, name, "deep_fry", num, lambda: loaded(media.deep_fry(batch)))
+        config.deepfry = False
+
+        batch = copies(frames)
+        measure(results, name, "word_frames", num, lambda: media.word_frames(batch))
+
+        # Frames are decoded at the output size, so resize gets frames decoded at full size
+        config.width = None
+        full = media.get_frames()
+        config.width = width
+        batch = copies(full)
+        resized = measure(results, name, "resize_frames", len(full), lambda: media.resize_frames(batch))
+
+        for fmt in formats:
+            config.format = fmt
+            batch = copies(resized)
+            out = measure(results, name, f"render_{fmt}", num, lambda: media.render(batch))
+
+            if isinstance(out, Path) and out.exists():
+                results[-1]["output_bytes"] = out.stat().st_size
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+
+
+def git_commit() -> Union[str, None]:
+    try:
+        proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=parent, capture_output=True, text=True)
+        return proc.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(old_path: Path, results: List[Dict[str, Any]]) -> None:
+    with open(old_path) as file:
+        old = json.load(file)
+
+    before = {(r["input"], r["stage"]): r for r in old["results"]}
+
+    print(f"\nCompared with {old.get('commit')}:")
+
+    for r in results:
+        prev = before.get((r["input"], r["stage"]))
+
+        if (not prev) or (not r["seconds"]):
+            continue
+
+        ratio = prev["seconds"] / r["seconds"]
+        print(f"{r['input']:<16} {r['stage']:<16} {prev['seconds']:>8.3f}s -> {r['seconds']:>8.3f}s  x{ratio:.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure each stage on a synthetic corpus")
+    parser.add_argument("--corpus", type=str, help="Directory of the corpus. Defaults to the cache directory")
+    parser.add_argument("--quick", action="store_true", help="Only use the small inputs")
+    parser.add_argument("--inputs", type=str, help="Only use these inputs, separated by commas")
+    parser.add_argument("--frames", type=int, default=24, help="Frames to extract from each input")
+    parser.add_argument("--width", type=int, default=480, help="Width used by the resize stage")
+    parser.add_argument("--json", type=str, help="Save the results to this file")
+    parser.add_argument("--compare", type=str, help="A previous json file to compare with")
+    args = parser.parse_args()
+
+    directory = Path(args.corpus) if args.corpus else utils.cache_dir("corpus")
+    directory.mkdir(parents=True, exist_ok=True)
+    items = [item for item in corpus if item["quick"] or not args.quick]
+
+    if args.inputs:
+        names = [name.strip() for name in args.inputs.split(",")]
+        items = [item for item in corpus if item["name"] in names]
+
+    make_corpus(directory, items)
+    config.fill_root(str(Path(parent, "gifmaker", "main.py")))
+    config.get_manifest()
+    results: List[Dict[str, Any]] = []
+
+    for item in items:
+        run_input(results, Path(directory, item["name"]), args.frames, args.width)
+
+    data = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "peak_reset": reset_peak(),
+        "frames": args.frames,
+        "results": results,
+    }
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(data, file, indent=2)
+
+    if args.compare:
+        compare(Path(args.compare), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# This measures how long the program takes to start on each entry path
+# It uses python -X importtime to see what gets imported
+# Paths that don't make media must not load the media libraries
+# Exits with an error if that happens or if a time budget is exceeded
+
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+from typing import List, Dict, Any
+
+here = Path(__file__).resolve()
+parent = here.parent.parent
+
+# Modules that are slow to import
+heavy = ["numpy", "PIL", "imageio", "imageio_ffmpeg", "webcolors"]
+
+# Name, arguments, stdin, and if heavy modules are allowed
+paths: List[Dict[str, Any]] = [
+    {"name": "version", "args": ["--version"], "heavy": False},
+    {"name": "arguments", "args": ["--arguments"], "heavy": False},
+    {"name": "error", "args": ["--output", "/tmp/gifmaker"], "heavy": False},
+    {"name": "serve", "args": ["serve"], "heavy": True},
+    {"name": "render", "args": ["--input", "media/image.jpg", "--output", "/tmp/gifmaker/startup.png",
+                                "--frames", "1", "--width", "50"], "heavy": True},
+]
+
+
+def parse_imports(text: str) -> Dict[str, int]:
+    # Cumulative microseconds of each imported module
+    ans: Dict[str, int] = {}
+
+    for line in text.splitlines():
+        if not line.startswith("import time:"):
+            continue
+
+        parts = line.split("|")
+
+        if len(parts) != 3:
+            continue
+
+        try:
+            ans[parts[2].strip()] = int(parts[1])
+        except ValueError:
+            continue
+
+    return ans
+
+
+def measure(path: Dict[str, Any], runs: int) -> Dict[str, Any]:
+    cmd = [sys.executable, "-X", "importtime", "-m", "gifmaker.main"] + path["args"]
+    times = []
+    imports: Dict[str, int] = {}
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run(cmd, cwd=parent, input=b"", capture_output=True)
+        times.append((time.perf_counter() - start) * 1000)
+        imports = parse_imports(proc.stderr.decode(errors="replace"))
+
+    loaded = [name for name in heavy if name in imports]
+
+    return {
+        "name": path["name"],
+        "median_ms": round(statistics.median(times), 1),
+        "min_ms": round(min(times), 1),
+        "gifmaker_import_ms": round(sum(v for k, v in imports.items() if k.startswith("gifmaker")) / 1000, 1),
+        "heavy_modules": loaded,
+        "heavy_allowed": path["heavy"],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure the startup time of each entry path")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per entry path")
+    parser.add_argument("--budget", type=float, default=0, help="Max median ms for the paths without media")
+    parser.add_argument("--json", type=str, help="Save the results to this file")
+    args = parser.parse_args()
+
+    results = [measure(path, args.runs) for path in paths]
+    failed = False
+
+    for r in results:
+        line = f"{r['name']:<10} {r['median_ms']:>8} ms (min {r['min_ms']} ms)"
+
+        if r["heavy_modules"]:
+            line += f" loads {', '.join(r['heavy_modules'])}"
+
+        if r["heavy_modules"] and (not r["heavy_allowed"]):
+            line += " <- should not load media libraries"
+            failed = True
+
+        if args.budget and (not r["heavy_allowed"]) and (r["median_ms"] > args.budget):
+            line += f" <- over the budget of {args.budget} ms"
+            failed = True
+
+        print(line)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()